@@ -0,0 +1,402 @@
+import asyncio
+import fcntl
+import json
+import os
+import re
+import socket
+import threading
+import time
+import uuid
+import logging
+from collections import OrderedDict
+from typing import List, Optional
+
+from fastapi import HTTPException, Query
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field
+
+from instrumentation import BATCH_ITEMS
+
+# Batch jobs for backend/main.py.
+# POST /batch/generate_response/ takes a list of /generate_response/ payloads and answers them
+# through the same pipeline with at most `concurrency` items in flight, streaming one NDJSON
+# line per item as soon as it finishes (in completion order, with the index of its item) and a
+# summary line at the end. The job runs on its own task, so a dropped connection does not stop
+# it: GET /batch/{job_id}/results?offset=N resumes the stream after the N lines already read.
+# With BATCH_STORE_DIR set, jobs are kept on disk as well. The process running a job holds
+# the lock on its <id>.lock file and records its host and pid in <id>.json. Other processes
+# (pre-fork workers, replicas sharing the directory) asked for the job follow its results on
+# disk. A job whose lock is free while it is still running was cut short by a restart or a crash,
+# and the next process that is asked for it carries on with its unfinished items.
+
+logger = logging.getLogger(__name__)
+
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8"))  # items in flight per job unless the request asks for another number
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "32"))
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "10000"))
+BATCH_MAX_JOBS = int(os.getenv("BATCH_MAX_JOBS", "100"))  # jobs kept in memory; finished ones are dropped first, oldest first
+BATCH_THROTTLE_RETRIES = int(os.getenv("BATCH_THROTTLE_RETRIES", "3"))  # times an item answered with 429 is retried after Retry-After
+BATCH_STORE_DIR = os.getenv("BATCH_STORE_DIR")  # when set, each job and its results are persisted there
+BATCH_FOLLOW_POLL_S = float(os.getenv("BATCH_FOLLOW_POLL_S", "1"))  # how often a job running in another process is re-read from disk
+
+# Job IDs may come from clients and name files, so they are kept filename-safe
+_job_id = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+
+class BatchJob:
+    """
+    The items of one batch and the results of those that finished, in the order they finished.
+    """
+
+    def __init__(self, job_id, items, concurrency, results=(), status="running"):
+        self.id = job_id
+        self.items = items  # request payloads, as dicts
+        self.concurrency = concurrency
+        self.results = list(results)
+        self.status = status  # running, completed, cancelled or failed
+        self.error = None  # why a failed job stopped
+        self.created_at = time.time()
+        self.owner = None  # {"host", "pid"} of the process running the job, when it is on disk
+        self._changed = asyncio.Condition()
+        self._record_lock = threading.Lock()
+        self._task = None
+        self._lock_file = None  # held while this process runs the job
+
+    def summary(self):
+        failed = sum(1 for result in self.results if "error" in result)
+        summary = {"jobId": self.id, "status": self.status, "items": len(self.items),
+                   "finished": len(self.results), "failed": failed}
+        if self.error is not None:
+            summary["error"] = self.error
+        return summary
+
+    async def run(self, answer, store=None):
+        """
+        Answer the items that have no result yet, `concurrency` at a time.
+        """
+        done = {result["index"] for result in self.results}
+        pending = iter([i for i in range(len(self.items)) if i not in done])
+
+        async def worker():
+            # Workers share the iterator, so each takes the next item as soon as it is free
+            for index in pending:
+                result = await self._answer(answer, index)
+                if store is not None:
+                    await asyncio.to_thread(self._record, store, result)
+                else:
+                    self.results.append(result)
+                await self._notify()
+
+        start = time.perf_counter()
+        workers = [asyncio.ensure_future(worker()) for _ in range(max(1, min(self.concurrency, len(self.items))))]
+        try:
+            await asyncio.gather(*workers)
+            self.status = "completed"
+            logger.info("Batch job finished", extra={"job": self.id, "items": len(self.items),
+                                                     "seconds": round(time.perf_counter() - start, 3)})
+        except asyncio.CancelledError:
+            self.status = "cancelled"
+        except Exception as e:
+            # Items report their own errors, so this is the job's machinery (the store) failing;
+            # the job must still end, or its streams would wait for it forever
+            logger.exception("Batch job failed", extra={"job": self.id})
+            self.status = "failed"
+            self.error = str(e)
+        finally:
+            # gather leaves the other workers running when one of them raises
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            if store is not None:
+                try:
+                    await asyncio.to_thread(store.save, self)
+                except Exception:
+                    logger.exception("Could not save batch job", extra={"job": self.id})
+                store.release(self)
+            await self._notify()
+
+    def _record(self, store, result):
+        # The lock keeps the lines of <id>.jsonl in the order of self.results, which offsets count
+        with self._record_lock:
+            store.append(self.id, result)
+            self.results.append(result)
+
+    async def follow(self, store):
+        """
+        Keep up with a job another process runs, from its files, until it stops or its lock is
+        free. Returns whether the job still has to be run.
+        """
+        while self.status == "running":
+            if store.claim(self):
+                return True
+            await asyncio.sleep(BATCH_FOLLOW_POLL_S)
+            self.status, self.error, results = await asyncio.to_thread(store.read, self.id, len(self.results))
+            self.results.extend(results)
+            await self._notify()
+        return False
+
+    async def _answer(self, answer, index):
+        for attempt in range(BATCH_THROTTLE_RETRIES + 1):
+            try:
+                result = await answer(self.items[index])
+                BATCH_ITEMS.labels("ok").inc()
+                return {"index": index, **result}
+            except HTTPException as e:
+                if e.status_code == 429 and attempt < BATCH_THROTTLE_RETRIES:
+                    # A batch can wait for the providers; a single request would have to give up
+                    BATCH_ITEMS.labels("retried").inc()
+                    await asyncio.sleep(float((e.headers or {}).get("Retry-After", 1)))
+                    continue
+                error = {"index": index, "error": e.detail, "status": e.status_code}
+            except ValueError as e:
+                error = {"index": index, "error": str(e), "status": 400}
+            except Exception as e:
+                logger.exception("Batch item failed", extra={"job": self.id, "index": index})
+                error = {"index": index, "error": str(e), "status": 500}
+            BATCH_ITEMS.labels("error").inc()
+            return error
+
+    async def _notify(self):
+        async with self._changed:
+            self._changed.notify_all()
+
+    async def stream(self, offset=0):
+        """
+        NDJSON lines of the results from the offset-th one on, as they come, then the summary.
+        """
+        while True:
+            async with self._changed:
+                await self._changed.wait_for(lambda: len(self.results) > offset or self.status != "running")
+            while offset < len(self.results):
+                yield json.dumps(self.results[offset]) + "\n"
+                offset += 1
+            if self.status != "running" and offset >= len(self.results):
+                break
+        yield json.dumps(self.summary()) + "\n"
+
+
+class BatchStore:
+    """
+    A job on disk: its items, status and owner in <id>.json, one result per line in <id>.jsonl,
+    appended as the items finish, and <id>.lock, locked by the process running the job.
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.owner = {"host": socket.gethostname(), "pid": os.getpid()}
+        os.makedirs(store_dir, exist_ok=True)
+
+    def _path(self, job_id, suffix):
+        return os.path.join(self.store_dir, f"{job_id}{suffix}")
+
+    def claim(self, job) -> bool:
+        """
+        Take the job's lock for this process, unless another process holds it.
+        """
+        if job._lock_file is not None:
+            return True
+        f = open(self._path(job.id, ".lock"), "a")
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            f.close()
+            return False
+        job._lock_file = f
+        # Pre-fork workers inherit the store from the parent, so the pid is read now
+        job.owner = {**self.owner, "pid": os.getpid()}
+        return True
+
+    def release(self, job):
+        if job._lock_file is not None:
+            job._lock_file.close()
+            job._lock_file = None
+
+    def save(self, job):
+        tmp_path = self._path(job.id, f".json.{os.getpid()}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump({"items": job.items, "concurrency": job.concurrency, "status": job.status, "error": job.error,
+                       "owner": job.owner}, f)
+        os.replace(tmp_path, self._path(job.id, ".json"))
+
+    def append(self, job_id, result):
+        with open(self._path(job_id, ".jsonl"), "a") as f:
+            f.write(json.dumps(result) + "\n")
+
+    def read(self, job_id, start=0):
+        """
+        The job's status and error, and its complete result lines from the start-th on; a line
+        still being written (or cut off by a crash) is left out.
+        """
+        with open(self._path(job_id, ".json")) as f:
+            data = json.load(f)
+        results = []
+        if os.path.exists(self._path(job_id, ".jsonl")):
+            with open(self._path(job_id, ".jsonl")) as f:
+                lines = f.readlines()[start:]
+            for line in lines:
+                if not line.endswith("\n"):
+                    break
+                try:
+                    results.append(json.loads(line))
+                except ValueError:
+                    break
+        return data["status"], data.get("error"), results
+
+    def load(self, job_id) -> Optional[BatchJob]:
+        if not os.path.exists(self._path(job_id, ".json")):
+            return None
+        with open(self._path(job_id, ".json")) as f:
+            data = json.load(f)
+        _, _, results = self.read(job_id)
+        job = BatchJob(job_id, data["items"], data["concurrency"], results, data["status"])
+        job.error = data.get("error")
+        job.owner = data.get("owner")
+        return job
+
+    def repair(self, job):
+        """
+        Re-read the job and rewrite <id>.jsonl with its results, dropping a last line cut off when the process
+        running the job died, so new results append cleanly and that item runs again.
+        Only the owner of the job's lock may call this.
+        """
+        job.status, job.error, job.results = self.read(job.id)
+        with open(self._path(job.id, ".jsonl"), "w") as f:
+            f.writelines(json.dumps(result) + "\n" for result in job.results)
+
+
+class BatchJobs:
+    def __init__(self, max_jobs=BATCH_MAX_JOBS, store_dir=BATCH_STORE_DIR):
+        self.max_jobs = max_jobs
+        self.store = BatchStore(store_dir) if store_dir else None
+        self.jobs = OrderedDict()
+
+    def create(self, items, answer, concurrency=None, job_id=None) -> BatchJob:
+        """
+        Start a job answering the items with answer(item), a coroutine.
+        """
+        running = sum(1 for job in self.jobs.values() if job.status == "running")
+        if running >= self.max_jobs:
+            raise HTTPException(status_code=503, detail="Too many batch jobs are running; try again later.")
+        concurrency = max(1, min(concurrency or BATCH_CONCURRENCY, BATCH_MAX_CONCURRENCY))
+        job = BatchJob(job_id or uuid.uuid4().hex, items, concurrency)
+        if self.store is not None:
+            if not self.store.claim(job):
+                raise HTTPException(status_code=409, detail=f"Batch job {job.id} is being created by another process.")
+            self.store.save(job)
+        self._add(job)
+        job._task = asyncio.ensure_future(job.run(answer, self.store))
+        return job
+
+    def get(self, job_id, answer) -> Optional[BatchJob]:
+        """
+        Return the job, loading it from disk if needed. A loaded job that has not finished is
+        followed while another process runs it, and resumed here once nobody does.
+        """
+        job = self.jobs.get(job_id)
+        if job is None and self.store is not None and _job_id.match(job_id):
+            job = self.store.load(job_id)
+            if job is not None:
+                self._add(job)
+                if job.status == "running":
+                    job._task = asyncio.ensure_future(self._resume(job, answer))
+        return job
+
+    async def _resume(self, job, answer):
+        if not await job.follow(self.store):
+            return
+        await asyncio.to_thread(self.store.repair, job)
+        if job.status != "running":
+            # The owner finished between the last read and the claim
+            self.store.release(job)
+            await job._notify()
+            return
+        logger.info("Resuming batch job", extra={"job": job.id, "finished": len(job.results), "items": len(job.items)})
+        await job.run(answer, self.store)
+
+    def cancel(self, job_id) -> Optional[BatchJob]:
+        """
+        Stop a running job. Items already being answered finish, but their results are dropped.
+        Only the process running the job can stop it.
+        """
+        job = self.jobs.get(job_id)
+        if job is not None and job.status == "running" and self.store is not None and job._lock_file is None:
+            raise HTTPException(status_code=409, detail=f"Batch job {job_id} is running in another process ({job.owner}).")
+        if job is not None and job._task is not None:
+            job._task.cancel()
+        return job
+
+    def _add(self, job):
+        self.jobs[job.id] = job
+        finished = [job_id for job_id, j in self.jobs.items() if j.status != "running"]
+        for job_id in finished[:max(0, len(self.jobs) - self.max_jobs)]:
+            del self.jobs[job_id]
+
+
+batch_jobs = BatchJobs()
+
+
+def add_batch_routes(app, item_model, answer):
+    """
+    Add the batch endpoints to app. item_model is the payload of one item, and answer(item) the
+    coroutine behind the single-item endpoint, raising HTTPException for an error status.
+    """
+    class BatchRequest(BaseModel):
+        items: List[item_model]
+        concurrency: Optional[int] = None
+        # Sending the ID of an existing job again resumes its stream instead of starting a new job
+        jobId: Optional[str] = None
+        offset: int = Field(0, ge=0)
+
+    async def answer_item(item):
+        return await answer(item_model.model_validate(item))
+
+    def stream(job, offset):
+        return StreamingResponse(job.stream(offset), media_type="application/x-ndjson", headers={"X-Batch-Job-ID": job.id})
+
+    def existing(job_id):
+        job = batch_jobs.get(job_id, answer_item)
+        if job is None:
+            raise HTTPException(status_code=404, detail=f"No batch job {job_id}")
+        return job
+
+    @app.post("/batch/generate_response/")
+    async def batch_generate_response(request: BatchRequest):
+        """
+        Answer every item like /generate_response/ and stream the results as NDJSON, one
+        {"index": i, "response": ..., "iterationCount": ..., "repairCount": ..., "stopReason": ...}
+        or {"index": i, "error": ..., "status": ...} per item in the order they finish, then
+        {"jobId": ..., "status": ..., "items": ..., "finished": ..., "failed": ...}, with "error"
+        when the job itself failed.
+        The job ID is also in the X-Batch-Job-ID header.
+        """
+        if request.jobId is not None:
+            if not _job_id.match(request.jobId):
+                raise HTTPException(status_code=400, detail="jobId may only contain letters, digits, '-' and '_' (at most 64).")
+            job = batch_jobs.get(request.jobId, answer_item)
+            if job is not None:
+                return stream(job, request.offset)
+        if not request.items:
+            raise HTTPException(status_code=400, detail="A batch needs at least one item.")
+        if len(request.items) > BATCH_MAX_ITEMS:
+            raise HTTPException(status_code=400, detail=f"A batch may have at most {BATCH_MAX_ITEMS} items.")
+        items = [item.model_dump(mode="json", exclude_none=True) for item in request.items]
+        job = batch_jobs.create(items, answer_item, request.concurrency, request.jobId)
+        return stream(job, 0)
+
+    @app.get("/batch/{job_id}")
+    async def batch_status(job_id: str):
+        return existing(job_id).summary()
+
+    @app.get("/batch/{job_id}/results")
+    async def batch_results(job_id: str, offset: int = Query(0, ge=0)):
+        """
+        Stream the results of a job from the offset-th line on, waiting for the items still running.
+        """
+        job = existing(job_id)
+        return stream(job, offset)
+
+    @app.delete("/batch/{job_id}")
+    async def cancel_batch(job_id: str):
+        existing(job_id)
+        batch_jobs.cancel(job_id)
+        return {"cancelled": job_id}
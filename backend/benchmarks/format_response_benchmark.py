@@ -0,0 +1,137 @@
+"""
+Correctness and speed of the single-pass format_response.
+
+Checks the shared formatter against the golden outputs in format_response_golden.json
+and against the original chain of re.sub / str.replace passes on random responses, then
+times both on long numbered responses like the "exactly 50 points" case the prompts use.
+
+Usage (from the backend directory):
+    python -m benchmarks.format_response_benchmark --points 5000
+    python -m benchmarks.format_response_benchmark --regenerate-golden
+"""
+import argparse
+import json
+import os
+import random
+import re
+import time
+
+from response_service.formatting import format_response
+
+GOLDEN_PATH = os.path.join(os.path.dirname(__file__), "format_response_golden.json")
+
+GOLDEN_INPUTS = [
+    ("Here are the points:\n1. First point. It has two sentences.\n2. Second point.\n3. Third point.", True),
+    ("Here are the points:\n1. First point. It has two sentences.\n2. Second point.\n3. Third point.", False),
+    ("Intro text (1) alpha (2) beta (3) gamma", True),
+    ("**Bold title**\n* first bullet\n* second bullet with *emphasis*", True),
+    ("Note: this is a colon. And a sentence.\tTabbed.  Double spaced.", False),
+    ("Version 3.14. Pi is 3.14159. Items 10. and 11. follow.", False),
+    ("1. a\n\n\n   2. b\r\n3. c  \n  4. d", True),
+    ("* bullet one\n* bullet two\n- dash three", True),
+    ("Stray * asterisk and ** unmatched and ***triple*** ones*", False),
+    ("   leading and trailing whitespace   \n\n", False),
+    ("No points here at all, just text", True),
+    ("Header 2024\n\n1.First without space\n2. Second: with colon: nested\n12. Twelfth.", True),
+    ("a.1. b 1*2. c (10) d", False),
+    ("", True),
+]
+
+
+def legacy_format_response(response, has_structure_constraint):
+    # The formatter as it was before the single-pass rewrite, kept as the reference
+    if has_structure_constraint:
+        match = re.search(r'^(?:\s*\d+\.\s+|\s*[-*]\s+|\s*\(\d+\))', response, re.MULTILINE)
+        if match:
+            response = response[match.start():]
+    response = re.sub(r'\((\d+)\)', r'\1.', response)
+    response = re.sub(r'\*\*(.*?)\*\*', r'\1', response)
+    response = re.sub(r'\*(.*?)\*', r'\1', response)
+    response = re.sub(r'(\d+\.\s)', r'\n\1', response)
+    response = response.replace('. ', '.\n\n')
+    response = response.replace(': ', ':\n\n')
+    response = re.sub(r"(\.\s)", r".\n\n", response)
+    response = response.replace("* ", "\n- ").replace("*", "")
+    response = re.sub(r'(\n\s*)+', r'\n', response)
+    return response.strip()
+
+
+def random_response(rng, length):
+    # Built from the characters the formatting rules care about, so odd combinations come up often
+    pieces = ["1", "2", "10", ".", ". ", ":", ": ", "*", "* ", "**", "(", ")", "(3)", "\n", "\n\n", " ", "  ",
+              "\t", "\r\n", "-", "- ", "word", "Word", "x", " ", "٣"]
+    return "".join(rng.choice(pieces) for _ in range(length))
+
+
+def long_response(points, seed=0):
+    rng = random.Random(seed)
+    words = ["solar", "energy", "**grid**", "battery", "storage", "*demand*", "peak", "cost", "policy", "market"]
+    lines = ["Here is a detailed answer with the requested structure:", ""]
+    for i in range(1, points + 1):
+        sentences = [" ".join(rng.choice(words) for _ in range(rng.randint(5, 12))).capitalize() + "." for _ in range(rng.randint(1, 3))]
+        lines.append(f"{i}. Point {i}: " + " ".join(sentences))
+        if rng.random() < 0.2:
+            lines.append(f"* A bullet under point {i}")
+    return "\n".join(lines)
+
+
+def check_golden():
+    with open(GOLDEN_PATH) as f:
+        cases = json.load(f)
+    failures = [case for case in cases if format_response(case["input"], case["has_structure_constraint"]) != case["expected"]]
+    print(f"golden: {len(cases) - len(failures)}/{len(cases)} match")
+    return not failures
+
+
+def check_fuzz(cases, seed=0):
+    rng = random.Random(seed)
+    for i in range(cases):
+        text = random_response(rng, rng.randint(0, 60))
+        structure = rng.random() < 0.5
+        if format_response(text, structure) != legacy_format_response(text, structure):
+            print(f"fuzz: mismatch on case {i}: {text!r}")
+            return False
+    print(f"fuzz: {cases} random responses match the legacy formatter")
+    return True
+
+
+def time_call(fn, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--points", type=int, default=5000, help="Numbered points in the long response")
+    parser.add_argument("--fuzz", type=int, default=20000, help="Random responses compared with the legacy formatter")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per measurement; the best is reported")
+    parser.add_argument("--regenerate-golden", action="store_true", help="Rewrite the golden file from the legacy formatter")
+    args = parser.parse_args()
+
+    if args.regenerate_golden:
+        cases = [
+            {"input": text, "has_structure_constraint": structure, "expected": legacy_format_response(text, structure)}
+            for text, structure in GOLDEN_INPUTS
+        ]
+        with open(GOLDEN_PATH, "w") as f:
+            json.dump(cases, f, indent=2)
+        print(f"Wrote {len(cases)} golden cases to {GOLDEN_PATH}")
+        return
+
+    if not (check_golden() and check_fuzz(args.fuzz)):
+        raise SystemExit(1)
+
+    print(f"{'points':>8}{'KB':>10}{'legacy ms':>12}{'single ms':>12}{'speedup':>10}")
+    for points in (50, 500, args.points):
+        text = long_response(points)
+        legacy = time_call(lambda: legacy_format_response(text, True), args.repeat)
+        single = time_call(lambda: format_response(text, True), args.repeat)
+        print(f"{points:>8}{len(text) / 1024:>10.1f}{legacy * 1000:>12.2f}{single * 1000:>12.2f}{legacy / single:>9.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+"""
+Offline load test of the LLM endpoints against stand-in providers.
+
+Runs backend/main.py in-process (through httpx's ASGI transport) with the Gemini and
+OpenRouter clients replaced by the scripted or recorded stand-ins in mock_providers.py,
+and reports throughput, p50/p95/p99 latency and provider calls per scenario. Nothing
+leaves the machine, so runs are reproducible for a given --seed.
+
+Scenarios:
+    generate_response      POST /generate_response/ (constrained generation + correction loop)
+    generate_valid_response POST /generate_valid_response/ (dual-model pipeline)
+    knowledge_graph        POST /api/generate-knowledge-graph
+    knowledge_graph_stream POST /api/generate-knowledge-graph/stream (token streaming)
+    batch_generate_response POST /batch/generate_response/ with --batch-items items per request
+
+Usage (from the backend directory):
+    python -m benchmarks.load_test --requests 50 --concurrency 8 --latency-ms 300
+    python -m benchmarks.load_test --scenarios generate_response --miss-rate 0.5 --failure-rate 0.05
+    python -m benchmarks.load_test --recording recorded_responses.json --json results.json
+    PROMPT_CACHE_MIN_TOKENS=0 python -m benchmarks.load_test  # exercise the prompt caches with the short stand-in prompts
+    python -m benchmarks.load_test --scenarios batch_generate_response --requests 4 --concurrency 1 --batch-concurrency 16
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", default="generate_response,generate_valid_response,knowledge_graph,knowledge_graph_stream",
+                        help="Comma-separated scenarios to run")
+    parser.add_argument("--requests", type=int, default=40, help="Measured requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=4, help="Requests in flight at once")
+    parser.add_argument("--warmup", type=int, default=2, help="Unmeasured requests run first per scenario")
+    parser.add_argument("--latency-ms", type=float, default=300.0, help="Latency of each provider call")
+    parser.add_argument("--jitter-ms", type=float, default=50.0, help="Uniform +/- jitter on the provider latency")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Share of provider calls that fail")
+    parser.add_argument("--miss-rate", type=float, default=0.3, help="Share of scripted answers that break one constraint")
+    parser.add_argument("--stream-chunk-chars", type=int, default=40, help="Characters per streamed chunk")
+    parser.add_argument("--chunk-latency-ms", type=float, default=15.0, help="Latency between streamed chunks")
+    parser.add_argument("--points", type=int, default=10, help="Points required by the structure constraint")
+    parser.add_argument("--kg-sentences", type=int, default=40, help="Sentences in the knowledge-graph input")
+    parser.add_argument("--batch-items", type=int, default=20, help="Items per batch request")
+    parser.add_argument("--batch-concurrency", type=int, default=8, help="Items of a batch answered at once")
+    parser.add_argument("--kg-engine", default="llm", help="KG_ENGINE for the run; 'llm' always reaches the provider")
+    parser.add_argument("--recording", help="JSON file of recorded responses to replay (see mock_providers.py)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="Also write the results to this file")
+    return parser.parse_args()
+
+
+def constrained_payload(rng, points):
+    topics = ["solar power", "electric cars", "urban farming", "heat pumps", "wind energy"]
+    return {
+        "question": f"Explain the benefits of {rng.choice(topics)} (request {rng.randrange(10 ** 6)}).",
+        "logicalGroups": [
+            {"operator": "AND", "constraints": [
+                {"type": "structure", "value": str(points)},
+                {"type": "word_inclusion", "value": "sustainable"},
+            ]},
+            {"operator": "NOT", "constraints": [{"type": "word_inclusion", "value": "cheap"}]},
+        ],
+    }
+
+
+def knowledge_graph_payload(rng, sentences):
+    subjects = ["Marie Curie", "The Eiffel Tower", "Python", "The Amazon river", "Ada Lovelace", "Tokyo"]
+    relations = ["was born in", "is located in", "was designed by", "flows through", "worked with", "is the capital of"]
+    objects = ["Warsaw", "Paris", "Guido van Rossum", "Brazil", "Charles Babbage", "Japan"]
+    text = " ".join(
+        f"{rng.choice(subjects)} {rng.choice(relations)} {rng.choice(objects)}." for _ in range(sentences)
+    )
+    return {"response": text}
+
+
+def percentile(sorted_values, q):
+    # Nearest-rank percentile
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, int(round(q / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+async def run_scenario(client, path, make_payload, args, stats, stream=False):
+    async def send(payload):
+        start = time.perf_counter()
+        if stream:
+            async with client.stream("POST", path, json=payload) as response:
+                body = b"".join([chunk async for chunk in response.aiter_bytes()])
+            ok = response.status_code == 200 and b'"error"' not in body
+        else:
+            response = await client.post(path, json=payload)
+            ok = response.status_code == 200
+        return time.perf_counter() - start, ok
+
+    for _ in range(args.warmup):
+        await send(make_payload())
+    stats.reset()
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+    payloads = [make_payload() for _ in range(args.requests)]
+
+    async def limited(payload):
+        async with semaphore:
+            return await send(payload)
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*(limited(p) for p in payloads))
+    wall = time.perf_counter() - start
+
+    latencies = sorted(seconds for seconds, _ in results)
+    calls = stats.snapshot()
+    # A cache hit is part of the call that used the cache, not a call of its own
+    provider_calls = sum(count for (_, kind), count in calls.items() if kind not in ("failure", "cache_hit"))
+    return {
+        "requests": len(results),
+        "errors": sum(1 for _, ok in results if not ok),
+        "wall_s": wall,
+        "throughput_rps": len(results) / wall if wall else 0.0,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "provider_calls": provider_calls,
+        "provider_calls_per_request": provider_calls / len(results) if results else 0.0,
+        "provider_calls_by_kind": {f"{provider}.{kind}": count for (provider, kind), count in sorted(calls.items())},
+    }
+
+
+async def run(args):
+    # Settings read at import time must be in place before the app is imported
+    os.environ.setdefault("GOOGLE_API_KEY", "offline-benchmark")
+    os.environ.setdefault("OPENROUTER_API_KEY", "offline-benchmark")
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    # The providers' per-minute limits would dominate a short run; set PROVIDER_RATE_LIMITS to measure them
+    os.environ.setdefault("PROVIDER_RATE_LIMITS", "")
+    # Injected failures hit single calls, not a quota, so a failed route is not kept off
+    os.environ.setdefault("PROVIDER_COOLDOWN_S", "0")
+    os.environ["KG_ENGINE"] = args.kg_engine
+
+    import httpx
+
+    from benchmarks.mock_providers import (
+        MockGeminiClient, MockOpenRouterClient, ProviderBehaviour, ProviderStats, Responder,
+        install_model_stand_ins, load_recording, patch_providers,
+    )
+
+    install_model_stand_ins()
+    from main import app
+
+    behaviour = ProviderBehaviour(
+        latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, failure_rate=args.failure_rate,
+        miss_rate=args.miss_rate, stream_chunk_chars=args.stream_chunk_chars,
+        chunk_latency_ms=args.chunk_latency_ms, seed=args.seed,
+    )
+    responder = Responder(behaviour, load_recording(args.recording) if args.recording else None)
+    stats = ProviderStats()
+    patch_providers(MockGeminiClient(behaviour, responder, stats), MockOpenRouterClient(behaviour, responder, stats))
+
+    rng = random.Random(args.seed)
+    scenarios = {
+        "generate_response": ("/generate_response/", lambda: constrained_payload(rng, args.points), False),
+        "generate_valid_response": ("/generate_valid_response/", lambda: constrained_payload(rng, args.points), False),
+        "knowledge_graph": ("/api/generate-knowledge-graph", lambda: knowledge_graph_payload(rng, args.kg_sentences), False),
+        "knowledge_graph_stream": ("/api/generate-knowledge-graph/stream", lambda: knowledge_graph_payload(rng, args.kg_sentences), True),
+        "batch_generate_response": ("/batch/generate_response/", lambda: {
+            "items": [constrained_payload(rng, args.points) for _ in range(args.batch_items)],
+            "concurrency": args.batch_concurrency,
+        }, True),
+    }
+
+    results = {}
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=None) as client:
+        for name in args.scenarios.split(","):
+            name = name.strip()
+            if name not in scenarios:
+                raise SystemExit(f"Unknown scenario {name!r}; choose from {', '.join(scenarios)}")
+            path, make_payload, stream = scenarios[name]
+            results[name] = await run_scenario(client, path, make_payload, args, stats, stream)
+    return results
+
+
+def main():
+    args = parse_args()
+    results = asyncio.run(run(args))
+
+    print(f"provider latency {args.latency_ms:.0f}+/-{args.jitter_ms:.0f} ms, failure rate {args.failure_rate}, "
+          f"miss rate {args.miss_rate}, concurrency {args.concurrency}")
+    print(f"{'scenario':<25}{'reqs':>6}{'errors':>8}{'req/s':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'calls/req':>11}")
+    for name, r in results.items():
+        print(f"{name:<25}{r['requests']:>6}{r['errors']:>8}{r['throughput_rps']:>9.2f}"
+              f"{r['p50_ms']:>10.0f}{r['p95_ms']:>10.0f}{r['p99_ms']:>10.0f}{r['provider_calls_per_request']:>11.2f}")
+        print(f"{'':<25}{', '.join(f'{k}={v}' for k, v in r['provider_calls_by_kind'].items())}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"settings": vars(args), "results": results}, f, indent=2)
+        print(f"Wrote {args.json}")
+
+
+if __name__ == "__main__":
+    main()
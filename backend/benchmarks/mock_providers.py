@@ -0,0 +1,398 @@
+"""
+Stand-in Gemini and OpenRouter clients for offline benchmarks.
+
+The clients answer like the real SDKs (generate_content, generate_content_stream, aio,
+caches, chat.completions.create) with responses that are replayed from a recording or scripted
+from the rules in the prompt, after a configurable latency. Failures can be injected at a
+given rate and streamed responses are cut into chunks with their own latency, so the retry
+loop, the dual-model pipeline and KG extraction can be measured without API keys.
+
+A recording is a JSON list of {"match": "...", "responses": ["...", ...]} entries. The first
+entry whose "match" appears in the prompt answers it, cycling through its responses, which
+is enough to replay a captured correction sequence. Prompts no entry matches are scripted.
+"""
+import asyncio
+import json
+import random
+import re
+import sys
+import threading
+import time
+import types
+from collections import Counter, OrderedDict
+from types import SimpleNamespace
+
+_points_rule = re.compile(r"must have exactly (\d+) points")
+_include_rule = re.compile(r"must include the word '([^']+)'")
+_exclude_rule = re.compile(r"must not include the word '([^']+)'")
+_kg_text = re.compile(r"Text:\n(.*?)\n\nTriples:", re.DOTALL)
+_sentence = re.compile(r"[^.!?\n]+")
+# The analysis prompts of response_service/llm_service.py and llm_service2.py; the fixed part of
+# the first is its system instruction
+_analysis_request = re.compile(r"^(?:Here is a response and a list of constraints|What about this response\?)")
+
+_filler = ["renewable", "energy", "supply", "grid", "storage", "demand", "cost", "policy", "market", "growth"]
+
+
+class MockProviderError(RuntimeError):
+    """
+    Raised by a stand-in client for an injected failure, like a 429 or 503 from the provider.
+    The provider gateway treats it as a 429 and fails over.
+    """
+    status_code = 429
+
+
+class ProviderBehaviour:
+    """
+    How a stand-in provider answers: latency per call, extra latency per streamed chunk, the
+    share of calls that fail and the share of scripted answers that miss one of their rules,
+    which is what sends a request into the correction loop.
+    """
+
+    def __init__(self, latency_ms=300.0, jitter_ms=50.0, failure_rate=0.0, miss_rate=0.3,
+                 stream_chunk_chars=40, chunk_latency_ms=15.0, seed=0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.failure_rate = failure_rate
+        self.miss_rate = miss_rate
+        self.stream_chunk_chars = stream_chunk_chars
+        self.chunk_latency_ms = chunk_latency_ms
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def random(self):
+        with self._lock:
+            return self._rng.random()
+
+    def delay(self):
+        with self._lock:
+            jitter = self._rng.uniform(-self.jitter_ms, self.jitter_ms)
+        return max(0.0, self.latency_ms + jitter) / 1000
+
+    def maybe_fail(self, provider):
+        if self.failure_rate and self.random() < self.failure_rate:
+            raise MockProviderError(f"{provider}: injected failure (503 Service Unavailable)")
+
+
+class ProviderStats:
+    """
+    Thread-safe call counter per (provider, kind), where kind is "call", "stream" or "failure".
+    """
+
+    def __init__(self):
+        self._counts = Counter()
+        self._lock = threading.Lock()
+
+    def count(self, provider, kind):
+        with self._lock:
+            self._counts[(provider, kind)] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._counts)
+
+    def reset(self):
+        with self._lock:
+            self._counts.clear()
+
+
+class Responder:
+    """
+    Produce the text of an answer for a prompt, from the recording when an entry matches and
+    from the prompt's own rules otherwise.
+    """
+
+    def __init__(self, behaviour, recording=None):
+        self.behaviour = behaviour
+        self.recording = recording or []
+        self._replayed = Counter()
+        # Correction turns only restate the rules that failed, so the rules seen for each
+        # question are remembered and the next answer keeps satisfying the others
+        self._rules = OrderedDict()
+        self._lock = threading.Lock()
+
+    def respond(self, system, turns):
+        prompt = "\n\n".join(turns)
+        for index, entry in enumerate(self.recording):
+            if entry["match"] in prompt or entry["match"] in system:
+                with self._lock:
+                    replay = self._replayed[index]
+                    self._replayed[index] += 1
+                return entry["responses"][replay % len(entry["responses"])]
+
+        if "knowledge graph" in system:
+            return self.triples(turns[-1])
+        if _analysis_request.match(turns[-1]) or _analysis_request.match(system):
+            return self.analysis(turns[-1])
+        return self.answer(turns[0], system + "\n" + prompt)
+
+    def rules_for(self, question, text):
+        # The history may append a note about omitted attempts to the question
+        key = question.split("\n\n(Note:")[0]
+        with self._lock:
+            rules = self._rules.pop(key, {"points": None, "include": set(), "exclude": set()})
+            self._rules[key] = rules
+            if len(self._rules) > 1000:
+                self._rules.popitem(last=False)
+            points = _points_rule.findall(text)
+            if points:
+                rules["points"] = int(points[-1])
+            rules["include"].update(_include_rule.findall(text))
+            rules["exclude"].update(_exclude_rule.findall(text))
+            return rules["points"], set(rules["include"]), set(rules["exclude"])
+
+    def answer(self, question, text):
+        points, include, exclude = self.rules_for(question, text)
+        include -= exclude
+        if self.behaviour.random() < self.behaviour.miss_rate:
+            # Miss one rule, the way a real model occasionally does
+            if points and (not include or self.behaviour.random() < 0.5):
+                points += 1 if self.behaviour.random() < 0.5 else -1
+            elif include:
+                include.pop()
+
+        words = [w for w in _filler if w not in exclude] or ["point"]
+        extra = sorted(include)
+        count = max(points or 3, 1)
+        lines = ["Here is the answer:"]
+        for i in range(count):
+            sentence = " ".join(words[(i + j) % len(words)] for j in range(6))
+            if extra:
+                sentence += " " + extra[i % len(extra)]
+            lines.append(f"{i + 1}. {sentence.capitalize()}.")
+        if extra and count < len(extra):
+            lines.append(" ".join(extra))
+        return "\n".join(lines)
+
+    def analysis(self, prompt):
+        return (
+            "STRENGTHS:\n- The response addresses the question.\n\n"
+            "WEAKNESSES:\n- It does not follow every constraint listed.\n\n"
+            "POTENTIAL IMPROVEMENTS:\n- Revise the response so each listed constraint holds.\n\n"
+            "ANALYSIS OF QUESTIONS:\n- None identified."
+        )
+
+    def triples(self, prompt):
+        match = _kg_text.search(prompt)
+        text = match.group(1) if match else prompt
+        lines = []
+        for sentence in _sentence.findall(text):
+            words = sentence.split()
+            if len(words) >= 3:
+                lines.append(f"({words[0]}, {' '.join(words[1:-1])}, {words[-1]})")
+        return "\n".join(lines)
+
+
+def _text(part_holder):
+    # Contents may be types.Content, plain strings or OpenAI-style message dicts
+    if isinstance(part_holder, str):
+        return part_holder
+    if isinstance(part_holder, dict):
+        return part_holder.get("content") or ""
+    return "".join(part.text or "" for part in part_holder.parts or [])
+
+
+def _tokens(text):
+    return len(text) // 4 + 1
+
+
+def _gemini_response(text, prompt_tokens, cached_tokens=0):
+    candidates_tokens = _tokens(text)
+    return SimpleNamespace(
+        text=text,
+        candidates=[SimpleNamespace(content=SimpleNamespace(parts=[SimpleNamespace(text=text)]))],
+        usage_metadata=SimpleNamespace(
+            prompt_token_count=prompt_tokens,
+            cached_content_token_count=cached_tokens,
+            candidates_token_count=candidates_tokens,
+            total_token_count=prompt_tokens + candidates_tokens,
+        ),
+    )
+
+
+class _GeminiCaches:
+    """
+    caches.create and caches.delete: a cached content holds a system instruction that
+    generate_content calls then reference by name.
+    """
+
+    def __init__(self, owner):
+        self.owner = owner
+        self.contents = {}
+        self._ids = iter(range(1, 1 << 62))
+        self._lock = threading.Lock()
+
+    def create(self, model, config):
+        self.owner.stats.count("gemini", "cache_create")
+        system = config.system_instruction
+        with self._lock:
+            name = f"cachedContents/mock-{next(self._ids)}"
+            self.contents[name] = system if isinstance(system, str) else _text(system)
+        return SimpleNamespace(name=name, model=model)
+
+    def delete(self, name):
+        with self._lock:
+            self.contents.pop(name, None)
+
+
+class _GeminiModels:
+    def __init__(self, owner):
+        self.owner = owner
+
+    def _prepare(self, contents, config):
+        contents = contents if isinstance(contents, list) else [contents]
+        turns = [_text(c) for c in contents]
+        cached_tokens = 0
+        cache_name = getattr(config, "cached_content", None)
+        if cache_name:
+            self.owner.stats.count("gemini", "cache_hit")
+            system = self.owner.caches.contents[cache_name]
+            cached_tokens = _tokens(system)
+        else:
+            system = getattr(config, "system_instruction", None) or ""
+            if not isinstance(system, str):
+                system = _text(system)
+        prompt_tokens = _tokens(system) + sum(_tokens(t) for t in turns)
+        return self.owner.responder.respond(system, turns), prompt_tokens, cached_tokens
+
+    def generate_content(self, model, contents, config=None):
+        behaviour = self.owner.behaviour
+        self.owner.stats.count("gemini", "call")
+        time.sleep(behaviour.delay())
+        try:
+            behaviour.maybe_fail("gemini")
+        except MockProviderError:
+            self.owner.stats.count("gemini", "failure")
+            raise
+        text, prompt_tokens, cached_tokens = self._prepare(contents, config)
+        return _gemini_response(text, prompt_tokens, cached_tokens)
+
+    def generate_content_stream(self, model, contents, config=None):
+        behaviour = self.owner.behaviour
+        self.owner.stats.count("gemini", "stream")
+        time.sleep(behaviour.delay())
+        try:
+            behaviour.maybe_fail("gemini")
+        except MockProviderError:
+            self.owner.stats.count("gemini", "failure")
+            raise
+        text, prompt_tokens, cached_tokens = self._prepare(contents, config)
+        size = max(behaviour.stream_chunk_chars, 1)
+        for start in range(0, len(text), size):
+            if start:
+                time.sleep(behaviour.chunk_latency_ms / 1000)
+            # Like the SDK, only the last chunk's usage covers the whole stream
+            yield _gemini_response(text[start:start + size], prompt_tokens, cached_tokens)
+
+
+class _AsyncGeminiModels(_GeminiModels):
+    async def generate_content(self, model, contents, config=None):
+        behaviour = self.owner.behaviour
+        self.owner.stats.count("gemini", "call")
+        await asyncio.sleep(behaviour.delay())
+        try:
+            behaviour.maybe_fail("gemini")
+        except MockProviderError:
+            self.owner.stats.count("gemini", "failure")
+            raise
+        text, prompt_tokens, cached_tokens = self._prepare(contents, config)
+        return _gemini_response(text, prompt_tokens, cached_tokens)
+
+
+class MockGeminiClient:
+    """
+    Stands in for genai.Client: models.generate_content, models.generate_content_stream,
+    aio.models.generate_content and caches.
+    """
+
+    def __init__(self, behaviour, responder, stats):
+        self.behaviour = behaviour
+        self.responder = responder
+        self.stats = stats
+        self.models = _GeminiModels(self)
+        self.aio = SimpleNamespace(models=_AsyncGeminiModels(self))
+        self.caches = _GeminiCaches(self)
+
+
+class _OpenRouterCompletions:
+    def __init__(self, owner):
+        self.owner = owner
+
+    def create(self, model, messages, **kwargs):
+        owner = self.owner
+        owner.stats.count("openrouter", "call")
+        time.sleep(owner.behaviour.delay())
+        try:
+            owner.behaviour.maybe_fail("openrouter")
+        except MockProviderError:
+            owner.stats.count("openrouter", "failure")
+            raise
+        system = "\n".join(_text(m) for m in messages if m.get("role") == "system")
+        turns = [_text(m) for m in messages if m.get("role") != "system"]
+        text = owner.responder.respond(system, turns)
+        prompt_tokens = _tokens(system) + sum(_tokens(t) for t in turns)
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=text))],
+            usage=SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=_tokens(text)),
+        )
+
+
+class MockOpenRouterClient:
+    """
+    Stands in for the OpenAI client pointed at OpenRouter: chat.completions.create.
+    """
+
+    def __init__(self, behaviour, responder, stats):
+        self.behaviour = behaviour
+        self.responder = responder
+        self.stats = stats
+        self.chat = SimpleNamespace(completions=_OpenRouterCompletions(self))
+
+
+def load_recording(path):
+    """
+    Read a recording file; a single "response" is accepted in place of "responses".
+    """
+    with open(path) as f:
+        entries = json.load(f)
+    return [
+        {"match": entry["match"], "responses": entry.get("responses") or [entry["response"]]}
+        for entry in entries
+    ]
+
+
+def install_model_stand_ins():
+    """
+    Register placeholder image, STT and TTS service modules so backend/main.py can be imported
+    without loading Stable Diffusion, Whisper or the TTS model. Their functions raise if called;
+    the LLM scenarios never reach them.
+    """
+    from constraint_plan import LogicalGroup
+
+    def unavailable(name):
+        def call(*args, **kwargs):
+            raise RuntimeError(f"{name} is not available in the offline benchmark")
+        return call
+
+    stand_ins = {
+        "image_service.image_service": ["generate_valid_image"],
+        "stt_service.STT_service": ["speech_to_text"],
+        "tts_service.TTS_service": ["text_to_speech", "split_into_chunks", "synthesize_pcm", "wav_stream_header"],
+    }
+    for module_name, functions in stand_ins.items():
+        module = types.ModuleType(module_name)
+        module.LogicalGroup = LogicalGroup
+        for function in functions:
+            setattr(module, function, unavailable(function))
+        sys.modules[module_name] = module
+
+
+def patch_providers(gemini, openrouter):
+    """
+    Put the stand-ins behind the provider gateway, which every module that calls a provider
+    goes through, so rate limiting, single flight and failover are part of the measurement.
+    """
+    from providers import provider_gateway
+
+    provider_gateway.providers["gemini"].client = gemini
+    provider_gateway.providers["openrouter"].client = openrouter
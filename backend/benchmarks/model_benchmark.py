@@ -0,0 +1,241 @@
+"""
+CPU cost of each model engine on its own: Whisper (transcribe_array), VITS (text_to_speech),
+Stable Diffusion (generate_image) and CLIP (validate_image).
+
+Every engine is loaded from its service module in a fresh process, so the peak RSS
+reported for it is that engine's alone. Workloads are fixed-seed: synthetic audio of a
+few lengths for STT, texts of a few word counts for TTS, step counts for SD and constraint
+counts for CLIP. Each workload is timed at every thread count given, to show how the
+engine scales with cores.
+
+Results can be saved as a baseline and later runs compared against it; any latency more
+than --tolerance slower than the baseline is reported and makes the command exit with 1.
+
+Usage (from the backend directory):
+    python -m benchmarks.model_benchmark --engines stt,tts,clip --threads 1,2,4
+    python -m benchmarks.model_benchmark --engines sd --sd-steps 5,10 --save-baseline benchmarks/model_baseline.json
+    python -m benchmarks.model_benchmark --baseline benchmarks/model_baseline.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import statistics
+import sys
+import time
+
+import numpy as np
+
+ENGINES = ("stt", "tts", "sd", "clip")
+
+WORDS = ("the quick brown fox jumps over a lazy dog while seven wizards quietly "
+         "judge boxing matches near the old river bank every sunny morning").split()
+CLIP_OBJECTS = ["cat", "dog", "car", "tree", "house", "boat", "bicycle", "mountain", "flower", "chair"]
+
+
+def parse_list(value, cast=int):
+    return [cast(item) for item in value.split(",") if item.strip()]
+
+
+def peak_rss_bytes():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024  # kilobytes on Linux
+
+
+def synthetic_speech(seconds, sampling_rate=16000, seed=0):
+    """
+    Voiced, syllable-like bursts separated by short pauses, as the 16 kHz float array load_audio
+    decodes uploads into. It is not real speech, but it exercises VAD and Whisper the same way
+    every run.
+    """
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * sampling_rate)) / sampling_rate
+    pitch = 120 + 30 * np.sin(2 * np.pi * 0.3 * t)
+    phase = 2 * np.pi * np.cumsum(pitch) / sampling_rate
+    voiced = sum(np.sin(k * phase) / k for k in range(1, 6))
+    syllables = np.clip(np.sin(2 * np.pi * 4 * t), 0, None)
+    pauses = (np.floor(t / 1.5) % 3 != 2)  # a pause every few words
+    signal = voiced * syllables * pauses + 0.01 * rng.standard_normal(t.size)
+    return (signal / np.abs(signal).max() * 0.5).astype(np.float32)
+
+
+def fixed_text(words, seed=0):
+    rng = np.random.default_rng(seed)
+    chosen = [WORDS[i] for i in rng.integers(0, len(WORDS), size=words)]
+    # Sentences of about twelve words, like a typical assistant answer
+    sentences = [" ".join(chosen[i:i + 12]).capitalize() + "." for i in range(0, len(chosen), 12)]
+    return " ".join(sentences)
+
+
+def clip_plan(constraints):
+    from constraint_plan import compile_plan
+    return compile_plan([{"operator": "AND", "constraints": [
+        {"type": "object_inclusion", "value": CLIP_OBJECTS[i % len(CLIP_OBJECTS)]} for i in range(constraints)
+    ]}])
+
+
+def fixed_image(seed=0, size=512):
+    from PIL import Image
+    rng = np.random.default_rng(seed)
+    return Image.fromarray(rng.integers(0, 256, size=(size, size, 3), dtype=np.uint8))
+
+
+def build_workloads(engine, args):
+    """
+    Return [(workload label, units of work, unit name, callable)] for the engine, importing
+    its service module (and so loading the model) on the way.
+    """
+    if engine == "stt":
+        # The engine is measured on decoded audio: uploads are decoded as webm by ffmpeg, which
+        # is the browser's recording format and not something to synthesize here
+        from stt_service.STT_service import transcribe_array
+        workloads = []
+        for seconds in args.stt_seconds:
+            audio = synthetic_speech(seconds, seed=args.seed)
+            workloads.append((f"{seconds}s audio", seconds, "audio s", lambda audio=audio: transcribe_array(audio, 16000)))
+        return workloads
+    if engine == "tts":
+        from tts_service.TTS_service import text_to_speech
+        return [
+            (f"{words} words", words, "words", lambda text=fixed_text(words, args.seed): text_to_speech(text, False))
+            for words in args.tts_words
+        ]
+    if engine == "sd":
+        from image_service.image_service import generate_image
+        prompt = "A high-quality, realistic image of a red bicycle, and a peaceful, vibrant atmosphere."
+        return [
+            (f"{steps} steps", steps, "steps", lambda steps=steps: generate_image(prompt, steps=steps, seed=args.seed))
+            for steps in args.sd_steps
+        ]
+    if engine == "clip":
+        from image_service.image_service import validate_image
+        image = fixed_image(args.seed)
+        return [
+            (f"{count} constraints", 1, "images", lambda plan=clip_plan(count): validate_image(image, plan))
+            for count in args.clip_constraints
+        ]
+    raise ValueError(f"Unknown engine {engine!r}; choose from {', '.join(ENGINES)}")
+
+
+def run_engine(engine, args):
+    """
+    Load one engine and time its workloads at every thread count. Runs in a child process.
+    """
+    import torch
+
+    rss_before_load = peak_rss_bytes()
+    load_start = time.perf_counter()
+    workloads = build_workloads(engine, args)
+    load_seconds = time.perf_counter() - load_start
+    rss_after_load = peak_rss_bytes()
+
+    results = []
+    for threads in args.threads:
+        torch.set_num_threads(threads)
+        for label, units, unit_name, run in workloads:
+            for _ in range(args.warmup):
+                run()
+            timings = []
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                run()
+                timings.append(time.perf_counter() - start)
+            median = statistics.median(timings)
+            results.append({
+                "engine": engine,
+                "workload": label,
+                "threads": threads,
+                "latency_s": round(median, 4),
+                "best_s": round(min(timings), 4),
+                "throughput": round(units / median, 3),
+                "throughput_unit": f"{unit_name}/s",
+            })
+    return {
+        "engine": engine,
+        "load_s": round(load_seconds, 2),
+        "rss_before_load_mb": round(rss_before_load / 2 ** 20, 1),
+        "rss_after_load_mb": round(rss_after_load / 2 ** 20, 1),
+        "peak_rss_mb": round(peak_rss_bytes() / 2 ** 20, 1),
+        "results": results,
+    }
+
+
+def compare(report, baseline, tolerance):
+    """
+    Return the workloads whose latency is more than `tolerance` slower than in the baseline.
+    """
+    previous = {
+        (r["engine"], r["workload"], r["threads"]): r["latency_s"]
+        for engine in baseline["engines"] for r in engine["results"]
+    }
+    regressions = []
+    for engine in report["engines"]:
+        for r in engine["results"]:
+            before = previous.get((r["engine"], r["workload"], r["threads"]))
+            if before and r["latency_s"] > before * (1 + tolerance):
+                regressions.append((r, before))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--engines", default=",".join(ENGINES), help="Comma-separated engines: stt, tts, sd, clip")
+    parser.add_argument("--threads", default="1,2,4", help="Comma-separated torch thread counts")
+    parser.add_argument("--stt-seconds", default="5,15,30", help="Audio lengths for STT")
+    parser.add_argument("--tts-words", default="12,50,200", help="Text lengths for TTS")
+    parser.add_argument("--sd-steps", default="5,10,25", help="Denoising step counts for Stable Diffusion")
+    parser.add_argument("--clip-constraints", default="1,4,8", help="Constraint counts for CLIP validation")
+    parser.add_argument("--repeat", type=int, default=3, help="Timed runs per workload; the median is reported")
+    parser.add_argument("--warmup", type=int, default=1, help="Untimed runs before each workload")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--baseline", help="Compare against this baseline JSON")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="Allowed slowdown against the baseline")
+    parser.add_argument("--save-baseline", help="Write this run as the new baseline JSON")
+    parser.add_argument("--output", help="Optional path to write the results as JSON")
+    args = parser.parse_args()
+
+    args.threads = parse_list(args.threads)
+    args.stt_seconds = parse_list(args.stt_seconds, float)
+    args.tts_words = parse_list(args.tts_words)
+    args.sd_steps = parse_list(args.sd_steps)
+    args.clip_constraints = parse_list(args.clip_constraints)
+
+    # The models are CPU-only here so the numbers size CPU nodes, and each engine gets a fresh
+    # spawned process so its peak RSS is not mixed with the engines measured before it
+    os.environ.setdefault("CUDA_VISIBLE_DEVICES", "")
+    context = multiprocessing.get_context("spawn")
+    report = {"cpu_count": os.cpu_count(), "seed": args.seed, "engines": []}
+    for engine in parse_list(args.engines, str):
+        with context.Pool(1) as pool:
+            report["engines"].append(pool.apply(run_engine, (engine, args)))
+
+    print(f"{'engine':<8}{'workload':<18}{'threads':>8}{'latency s':>11}{'best s':>9}{'throughput':>14}  unit")
+    for engine in report["engines"]:
+        for r in engine["results"]:
+            print(f"{r['engine']:<8}{r['workload']:<18}{r['threads']:>8}{r['latency_s']:>11.3f}{r['best_s']:>9.3f}"
+                  f"{r['throughput']:>14.2f}  {r['throughput_unit']}")
+    print(f"\n{'engine':<8}{'load s':>8}{'RSS before MB':>15}{'RSS loaded MB':>15}{'peak RSS MB':>13}")
+    for engine in report["engines"]:
+        print(f"{engine['engine']:<8}{engine['load_s']:>8}{engine['rss_before_load_mb']:>15}"
+              f"{engine['rss_after_load_mb']:>15}{engine['peak_rss_mb']:>13}")
+
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, "w") as f:
+                json.dump(report, f, indent=2)
+            print(f"Wrote {path}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for r, before in regressions:
+            print(f"REGRESSION {r['engine']} {r['workload']} @ {r['threads']} threads: "
+                  f"{r['latency_s']:.3f}s vs {before:.3f}s baseline")
+        if regressions:
+            raise SystemExit(1)
+        print(f"No regressions beyond {args.tolerance:.0%} against {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+"""
+Memory cost of each extra worker, with and without the pre-fork launcher.
+
+Starts the app once per (mode, worker count), waits until it answers and its memory has
+settled, then reads the memory of the master and every worker from /proc:
+    uvicorn  - `uvicorn main:app --workers N`, every worker loads its own models
+    prefork  - `python prefork.py --workers N`, the master loads them once and forks
+The cost of an extra worker is the growth of the total PSS (shared pages counted once
+across the processes) from one worker to N, divided by N - 1. Peak RSS is each
+process's high-water mark. Linux only.
+
+Usage (from the backend directory):
+    python -m benchmarks.prefork_memory --workers 4 --app main:app
+    python -m benchmarks.prefork_memory --modes prefork --workers 2 --requests 5
+"""
+import argparse
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import httpx
+
+from prefork import process_memory
+
+
+def descendants(pid):
+    """
+    pid and all its descendants, from the parent links in /proc.
+    """
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                # The command name may contain spaces; the parent PID follows the closing parenthesis
+                parent = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(parent, []).append(int(entry))
+    found, pending = [], [pid]
+    while pending:
+        current = pending.pop()
+        found.append(current)
+        pending.extend(children.get(current, []))
+    return found
+
+
+def total_memory(pids):
+    total = {"rss": 0, "pss": 0, "uss": 0, "peak_rss": 0}
+    per_process = []
+    for pid in pids:
+        try:
+            memory = process_memory(pid)
+        except OSError:
+            continue  # exited between listing and reading
+        per_process.append({"pid": pid, **memory})
+        for key in total:
+            total[key] += memory[key]
+    return total, per_process
+
+
+def start(mode, app, workers, port):
+    if mode == "prefork":
+        command = [sys.executable, "prefork.py", "--app", app, "--workers", str(workers), "--port", str(port)]
+    else:
+        command = [sys.executable, "-m", "uvicorn", app, "--workers", str(workers), "--port", str(port)]
+    return subprocess.Popen(command, stdout=subprocess.DEVNULL, start_new_session=True)
+
+
+def wait_until_settled(process, port, timeout, settle_s=5.0):
+    # Answering requests means at least one worker is up; with plain uvicorn the others may
+    # still be loading, so also wait until the total RSS stops growing
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"The server exited with status {process.returncode} while starting")
+        try:
+            if httpx.get(f"http://127.0.0.1:{port}/metrics", timeout=2).status_code == 200:
+                break
+        except httpx.HTTPError:
+            pass
+        time.sleep(1)
+    else:
+        raise TimeoutError("The server did not answer in time")
+
+    previous = -1
+    while time.monotonic() < deadline:
+        rss = total_memory(descendants(process.pid))[0]["rss"]
+        if previous > 0 and abs(rss - previous) < 0.01 * previous:
+            return
+        previous = rss
+        time.sleep(settle_s)
+    raise TimeoutError("Memory did not settle in time")
+
+
+def measure(mode, app, workers, port, timeout, requests):
+    process = start(mode, app, workers, port)
+    try:
+        wait_until_settled(process, port, timeout)
+        # A few requests so every worker has served something and touched its pages
+        for _ in range(requests * workers):
+            httpx.get(f"http://127.0.0.1:{port}/metrics", timeout=10)
+        total, per_process = total_memory(descendants(process.pid))
+        return {"mode": mode, "workers": workers, "total": total, "processes": per_process}
+    finally:
+        os.killpg(process.pid, signal.SIGTERM)
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            os.killpg(process.pid, signal.SIGKILL)
+            process.wait()
+
+
+def mb(value):
+    return value / 2 ** 20
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--app", default="main:app")
+    parser.add_argument("--modes", default="uvicorn,prefork", help="Comma-separated: uvicorn, prefork")
+    parser.add_argument("--workers", type=int, default=4, help="Worker count compared with a single worker")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--timeout", type=float, default=900, help="Seconds allowed for the models to load")
+    parser.add_argument("--requests", type=int, default=3, help="Requests per worker before measuring")
+    parser.add_argument("--output", help="Optional path to write the results as JSON")
+    args = parser.parse_args()
+
+    results = []
+    for mode in args.modes.split(","):
+        for workers in (1, args.workers):
+            result = measure(mode.strip(), args.app, workers, args.port, args.timeout, args.requests)
+            results.append(result)
+            total = result["total"]
+            print(f"{mode:<8} {workers} worker(s): PSS {mb(total['pss']):.0f} MB, RSS {mb(total['rss']):.0f} MB, "
+                  f"USS {mb(total['uss']):.0f} MB, largest peak RSS {mb(max(p['peak_rss'] for p in result['processes'])):.0f} MB")
+
+    print(f"\n{'mode':<10}{'PSS 1 MB':>10}{'PSS N MB':>10}{'per extra worker MB':>22}")
+    for one, many in zip(results[::2], results[1::2]):
+        extra = (many["total"]["pss"] - one["total"]["pss"]) / max(args.workers - 1, 1)
+        print(f"{one['mode']:<10}{mb(one['total']['pss']):>10.0f}{mb(many['total']['pss']):>10.0f}{mb(extra):>22.0f}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
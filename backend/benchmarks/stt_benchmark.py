@@ -0,0 +1,141 @@
+"""
+Compare speech-to-text engines on the bundled sample set.
+
+Reports the real-time factor (processing time / audio duration) and the word error
+rate of each engine so the speed/accuracy trade-off can be chosen explicitly.
+
+Usage (from the backend directory):
+    python -m benchmarks.stt_benchmark --engines transformers,transformers-int8,ctranslate2 --model-size small
+
+The sample set lives in benchmarks/stt_samples/manifest.json. Audio for any sample
+without a WAV file is rendered from its reference text with the TTS service on the
+first run (--synthesize), so the set stays reproducible without shipping recordings.
+"""
+import argparse
+import json
+import os
+import re
+import time
+
+import librosa
+
+SAMPLES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "stt_samples")
+
+
+def normalize_words(text):
+    """
+    Lowercase, drop punctuation and split into words for WER scoring.
+    """
+    return re.sub(r"[^a-z0-9' ]+", " ", text.lower()).split()
+
+
+def word_errors(reference, hypothesis):
+    """
+    Word-level Levenshtein distance between reference and hypothesis.
+    """
+    ref = normalize_words(reference)
+    hyp = normalize_words(hypothesis)
+    previous = list(range(len(hyp) + 1))
+    for i, ref_word in enumerate(ref, start=1):
+        current = [i] + [0] * len(hyp)
+        for j, hyp_word in enumerate(hyp, start=1):
+            current[j] = min(
+                previous[j] + 1,  # deletion
+                current[j - 1] + 1,  # insertion
+                previous[j - 1] + (ref_word != hyp_word),  # substitution
+            )
+        previous = current
+    return previous[-1], len(ref)
+
+
+def load_samples(synthesize):
+    """
+    Load the sample manifest and the audio for each sample, rendering missing audio if asked.
+    """
+    with open(os.path.join(SAMPLES_DIR, "manifest.json")) as f:
+        manifest = json.load(f)
+
+    samples = []
+    for sample in manifest["samples"]:
+        path = os.path.join(SAMPLES_DIR, f"{sample['id']}.wav")
+        if not os.path.exists(path):
+            if not synthesize:
+                raise FileNotFoundError(f"Missing {path}; rerun with --synthesize to render it.")
+            from tts_service.TTS_service import text_to_speech
+            with open(path, "wb") as f:
+                f.write(text_to_speech(sample["text"], False))
+        audio_array, _ = librosa.load(path, sr=manifest["sampling_rate"])
+        samples.append({"id": sample["id"], "text": sample["text"], "array": audio_array})
+    return samples, manifest["sampling_rate"]
+
+
+def run_engine(engine, samples, sampling_rate, batch_size, chunk_length_s):
+    """
+    Transcribe every sample one at a time and score the results.
+    """
+    # Warm-up so one-off initialization does not count against the first sample
+    engine.transcribe_batch([{"array": samples[0]["array"], "sampling_rate": sampling_rate}], batch_size, chunk_length_s)
+
+    total_audio = 0.0
+    total_time = 0.0
+    total_errors = 0
+    total_words = 0
+    for sample in samples:
+        start = time.perf_counter()
+        result = engine.transcribe_batch([{"array": sample["array"], "sampling_rate": sampling_rate}], batch_size, chunk_length_s)[0]
+        total_time += time.perf_counter() - start
+        total_audio += len(sample["array"]) / sampling_rate
+        errors, words = word_errors(sample["text"], result["text"])
+        total_errors += errors
+        total_words += words
+
+    return {
+        "engine": engine.name,
+        "model": engine.model_id,
+        "audio_seconds": round(total_audio, 2),
+        "processing_seconds": round(total_time, 2),
+        "rtf": round(total_time / total_audio, 3),
+        "wer": round(total_errors / max(total_words, 1), 4),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--engines", default="transformers,transformers-int8", help="Comma-separated STT engines to compare")
+    parser.add_argument("--model-size", default=os.getenv("STT_MODEL_SIZE", "large-v3-turbo"))
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--chunk-length", type=int, default=30)
+    parser.add_argument("--synthesize", action="store_true", help="Render missing sample audio with the TTS service")
+    parser.add_argument("--output", help="Optional path to write the results as JSON")
+    args = parser.parse_args()
+
+    engine_names = [name.strip() for name in args.engines.split(",") if name.strip()]
+
+    # The service module loads its configured engine at import time, so point it at the first one
+    os.environ["STT_ENGINE"] = engine_names[0]
+    os.environ["STT_MODEL_SIZE"] = args.model_size
+    from stt_service import STT_service
+
+    samples, sampling_rate = load_samples(args.synthesize)
+
+    results = []
+    for name in engine_names:
+        if name == STT_service.engine.name:
+            engine = STT_service.engine
+        else:
+            STT_service.engine = None  # release the previous engine before loading the next one
+            engine = STT_service.load_engine(name, args.model_size)
+            STT_service.engine = engine
+        results.append(run_engine(engine, samples, sampling_rate, args.batch_size, args.chunk_length))
+
+    print(f"{'engine':<20}{'model':<32}{'audio s':>10}{'proc s':>10}{'RTF':>8}{'WER':>8}")
+    for r in results:
+        print(f"{r['engine']:<20}{r['model']:<32}{r['audio_seconds']:>10}{r['processing_seconds']:>10}{r['rtf']:>8}{r['wer']:>8}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""
+Throughput of the streaming triple parser on large LLM outputs.
+
+Generates synthetic extraction outputs in each supported style, feeds them to
+TripleStreamParser in token-sized pieces (as a provider stream would) and in one
+piece, and compares against the single regex parse_triples used to run.
+
+Usage (from the backend directory):
+    python -m benchmarks.triple_parser_benchmark --triples 20000
+"""
+import argparse
+import json
+import random
+import re
+import time
+
+from triple_parser import TripleStreamParser
+
+LEGACY_PATTERN = re.compile(r"\(([^,]+),\s*([^,]+),\s*([^\)]+)\)")
+
+WORDS = ["solar", "panel", "energy", "grid", "battery", "city", "river", "company", "protein", "cell",
+         "engine", "network", "model", "planet", "orbit", "law", "market", "water", "carbon", "forest"]
+RELATIONS = ["contains", "produces", "located in", "part of", "depends on", "regulates", "supplies"]
+
+
+def random_entity(rng):
+    entity = " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 3))).title()
+    # Some entities carry the commas and parentheses the old regex could not handle
+    if rng.random() < 0.1:
+        entity += f", {rng.choice(WORDS).title()}"
+    elif rng.random() < 0.1:
+        entity += f" ({rng.choice(WORDS)})"
+    return entity
+
+
+def build_output(style, count, seed=0):
+    rng = random.Random(seed)
+    triples = [(random_entity(rng), rng.choice(RELATIONS), random_entity(rng)) for _ in range(count)]
+    if style == "tuples":
+        lines = [f'("{a}", {r}, "{b}")' for a, r, b in triples]
+    elif style == "jsonl":
+        lines = [json.dumps([a, r, b]) for a, r, b in triples]
+    else:
+        lines = ["| Entity 1 | Relation | Entity 2 |", "|---|---|---|"]
+        lines += [f"| {a} | {r} | {b} |" for a, r, b in triples]
+    return "\n".join(lines), triples
+
+
+def token_pieces(text, seed=0):
+    # Provider streams arrive in small, irregular pieces of a few characters
+    rng = random.Random(seed)
+    pieces = []
+    i = 0
+    while i < len(text):
+        step = rng.randint(2, 12)
+        pieces.append(text[i:i + step])
+        i += step
+    return pieces
+
+
+def time_call(fn, repeat):
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def parse_streamed(pieces):
+    parser = TripleStreamParser()
+    triples = []
+    for piece in pieces:
+        triples.extend(parser.feed(piece))
+    return triples + parser.close()
+
+
+def parse_whole(text):
+    parser = TripleStreamParser()
+    return parser.feed(text) + parser.close()
+
+
+def parse_legacy(text):
+    return [[g.strip() for g in m.groups()] for m in LEGACY_PATTERN.finditer(text)]
+
+
+def check_last_line():
+    """
+    Provider output is stripped, so the last line has no newline; its triple must still be parsed
+    in every style, whole or streamed.
+    """
+    for style in ("tuples", "jsonl", "table"):
+        text, expected = build_output(style, 3)
+        assert not text.endswith("\n")
+        for mode, triples in (("whole", parse_whole(text)), ("streamed", parse_streamed(token_pieces(text)))):
+            if triples != [list(t) for t in expected]:
+                raise SystemExit(f"{style} ({mode}): expected {expected}, parsed {triples}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--triples", type=int, default=20000, help="Triples per generated output")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per measurement; the best is reported")
+    args = parser.parse_args()
+
+    check_last_line()
+    print(f"{'style':<8}{'mode':<10}{'MB/s':>10}{'triples/s':>14}{'recovered':>12}")
+    for style in ("tuples", "jsonl", "table"):
+        text, expected = build_output(style, args.triples)
+        pieces = token_pieces(text)
+        size_mb = len(text.encode()) / 1e6
+
+        runs = [("streamed", lambda: parse_streamed(pieces)), ("whole", lambda: parse_whole(text))]
+        if style == "tuples":
+            runs.append(("legacy", lambda: parse_legacy(text)))
+
+        for mode, fn in runs:
+            seconds, triples = time_call(fn, args.repeat)
+            correct = sum(1 for got, want in zip(triples, expected) if got == list(want))
+            print(f"{style:<8}{mode:<10}{size_mb / seconds:>10.1f}{len(triples) / seconds:>14.0f}{correct / len(expected):>12.1%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+"""
+The constraint schema shared by every service, and the plan a request's constraints compile into.
+
+A request's logical groups are compiled once into a ConstraintPlan holding everything the
+services derive from them: the system prompt, the response validators, the CLIP phrases and
+the Stable Diffusion prompt. Plans are cached by a hash of the groups' content, so a request
+with the same constraints as an earlier one reuses its plan.
+"""
+import hashlib
+import json
+import os
+import re
+import threading
+import logging
+from collections import OrderedDict
+from typing import Literal, Tuple
+
+from pydantic import BaseModel, ConfigDict, model_validator
+
+logger = logging.getLogger(__name__)
+
+PLAN_CACHE_SIZE = int(os.getenv("PLAN_CACHE_SIZE", "1024"))  # compiled plans kept, least recently used dropped first
+
+_numbered_point = re.compile(r'^\s*\d+\.\s+', re.MULTILINE)
+_bullet_point = re.compile(r'^\s*[-*]\s+', re.MULTILINE)
+_parenthetical_point = re.compile(r'\(\d+\)')
+
+
+class Constraint(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
+    type: Literal["structure", "word_inclusion", "word_exclusion", "object_inclusion", "color_inclusion"]
+    value: str
+
+    @model_validator(mode="after")
+    def check_value(self):
+        if self.type == "structure":
+            if not self.value.strip().isdigit() or int(self.value) < 1:
+                raise ValueError("A structure constraint needs a positive number of points.")
+        elif not self.value.strip():
+            raise ValueError(f"A {self.type} constraint needs a value.")
+        return self
+
+
+class LogicalGroup(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
+    operator: Literal["AND", "OR", "NOT"]
+    constraints: Tuple[Constraint, ...]
+
+
+def count_points(response) -> int:
+    """
+    Number of points in a response, in order of preference: "1. " lines, "- " or "* " lines, "(1)".
+    """
+    numbered_points = _numbered_point.findall(response)
+    if numbered_points:
+        return len(numbered_points)
+    bullet_points = _bullet_point.findall(response)
+    if bullet_points:
+        return len(bullet_points)
+    return len(_parenthetical_point.findall(response))
+
+
+def compile_check(constraint):
+    """
+    Return a check of the constraint against (lowercased response, point count), or None for
+    constraint types that only apply to images.
+    """
+    if constraint.type == "structure":
+        target = int(constraint.value)
+        return lambda lowered, points: points == target
+    if constraint.type == "word_inclusion":
+        word = constraint.value.strip().lower()
+        return lambda lowered, points: word in lowered
+    if constraint.type == "word_exclusion":
+        word = constraint.value.strip().lower()
+        return lambda lowered, points: word not in lowered
+    return None
+
+
+def format_constraints(logicalGroups):
+    """
+    Format the constraints into a readable string, grouped by logical operators.
+    """
+    if not logicalGroups:
+        return "No constraints provided. Answer the question naturally."
+    formatted_constraints = []
+    for group in logicalGroups:
+        for constraint in group.constraints:
+            if constraint.type == "structure" and group.operator == "AND":
+                formatted_constraints.append(f"- The response must have exactly {constraint.value} points.")
+            elif constraint.type == "word_inclusion":
+                if group.operator == "NOT":
+                    formatted_constraints.append(f"- The response must not include the word '{constraint.value}'.")
+                else:
+                    formatted_constraints.append(f"- The response must include the word '{constraint.value}'.")
+            elif constraint.type == "word_exclusion":
+                if group.operator == "NOT":
+                    formatted_constraints.append(f"- The response must include the word '{constraint.value}'.")
+                else:
+                    formatted_constraints.append(f"- The response must not include the word '{constraint.value}'.")
+    return "\n\n".join(formatted_constraints)
+
+
+def format_image_prompt(logicalGroups):
+    """
+    The Stable Diffusion prompt: every object and color that is not in a NOT group.
+    """
+    prompt = "A high-quality, realistic image of "
+    for group in logicalGroups:
+        if group.operator == "NOT":
+            continue
+        for constraint in group.constraints:
+            if constraint.type == "object_inclusion":
+                prompt += f"a {constraint.value}, "
+            elif constraint.type == "color_inclusion":
+                prompt += f"with a {constraint.value} color, "
+    prompt += "and a peaceful, vibrant atmosphere."
+    return prompt
+
+
+class ConstraintPlan:
+    """
+    Everything derived from one set of logical groups. Plans are shared between requests with
+    the same constraints, so nothing here may be changed after compiling.
+    """
+
+    def __init__(self, logicalGroups, key):
+        structure_constraints = [
+            c for group in logicalGroups for c in group.constraints if c.type == "structure"
+        ]
+        if len(structure_constraints) > 1:
+            raise ValueError("Only one structure constraint is allowed.")
+
+        self.key = key
+        self.logicalGroups = logicalGroups
+        self.has_structure_constraint = any(
+            c.type == "structure" for group in logicalGroups if group.operator == "AND" for c in group.constraints
+        )
+        # Entries validate can report as unsatisfied when everything fails:
+        # one per constraint in AND and NOT groups, one per OR group
+        self.total_constraints = sum(1 if group.operator == "OR" else len(group.constraints) for group in logicalGroups)
+
+        self.constraints_text = format_constraints(logicalGroups)
+        self.rules_instruction = f"Always follow these rules:\n{self.constraints_text}"
+        self.system_instruction = (
+            f"{self.rules_instruction}\n\n"
+            f"For example, if one of the constraints is a structure constraint that specifies a certain number of points (e.g., exactly 50), format your response accordingly. Each point should be clearly numbered, like this:\n"
+            f"1. First point.\n2. Second point.\n... up to N. Last point (as specified by the constraint).\n"
+        )
+
+        self.image_prompt = format_image_prompt(logicalGroups)
+        self.clip_phrases = tuple(
+            f"a photo without {c.value}" if group.operator == "NOT" else f"a photo of {c.value}"
+            for group in logicalGroups for c in group.constraints if c.type == "object_inclusion"
+        )
+
+        self._checks = tuple(
+            (group, tuple(compile_check(c) for c in group.constraints)) for group in logicalGroups
+        )
+        self._counts_points = bool(structure_constraints)
+
+    def validate(self, response):
+        """
+        Validate the response against the logical groups of constraints.
+        Returns:
+            - Boolean indicating if all constraints are satisfied
+            - List of unsatisfied constraints
+        """
+        lowered = response.lower()
+        points = count_points(response) if self._counts_points else 0
+        if self._counts_points:
+            logger.debug("Found %d points in response", points)
+
+        unsatisfied_constraints = []
+        for group, checks in self._checks:
+            # Image constraints do not apply to text and always pass
+            group_results = [check is None or check(lowered, points) for check in checks]
+
+            if group.operator == "AND":
+                # Add only failed constraints
+                for constraint, result in zip(group.constraints, group_results):
+                    if not result:
+                        unsatisfied_constraints.append({"operator": "AND", "constraint": constraint})
+            elif group.operator == "OR":
+                # At least one constraint must be True
+                if not any(group_results):
+                    unsatisfied_constraints.append({"operator": "OR", "group_constraints": group.constraints})
+            elif group.operator == "NOT":
+                # No constraint may be True
+                for constraint, result in zip(group.constraints, group_results):
+                    if result:
+                        unsatisfied_constraints.append({"operator": "NOT", "constraint": constraint})
+
+        return not unsatisfied_constraints, unsatisfied_constraints
+
+
+_plans = OrderedDict()
+_plans_lock = threading.Lock()
+
+
+def plan_key(logicalGroups) -> str:
+    """
+    Content hash of the logical groups; groups with the same operators and constraints in
+    the same order have the same key.
+    """
+    canonical = json.dumps([group.model_dump(mode="json") for group in logicalGroups], separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def compile_plan(logicalGroups) -> ConstraintPlan:
+    """
+    Return the plan for the logical groups (LogicalGroup models or plain dicts), compiling it
+    on first use. Raises ValueError if the constraints are invalid.
+    """
+    groups = tuple(
+        group if isinstance(group, LogicalGroup) else LogicalGroup.model_validate(group)
+        for group in logicalGroups
+    )
+    key = plan_key(groups)
+    with _plans_lock:
+        plan = _plans.get(key)
+        if plan is not None:
+            _plans.move_to_end(key)
+            return plan
+
+    plan = ConstraintPlan(groups, key)
+    with _plans_lock:
+        _plans[key] = plan
+        while len(_plans) > PLAN_CACHE_SIZE:
+            _plans.popitem(last=False)
+    return plan
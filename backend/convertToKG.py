@@ -1,33 +1,53 @@
-import openai
 from fastapi import HTTPException
 from typing import List
 from pydantic import BaseModel
 import re
-from google import genai
+import queue
+from concurrent.futures import ThreadPoolExecutor
 from google.genai import types
+from local_kg import extract_local_triples
+from triple_parser import TripleStreamParser
+from instrumentation import trace_span, observe_stage, record_llm_call
+from prompt_cache import generate_content, generate_content_stream
+from providers import gemini_client, openrouter_client
+from structured_logging import with_request_id
 import os 
+import time
 from dotenv import load_dotenv
 
 load_dotenv() # Load environment variables from .env file
 
 
 
-client = openai.OpenAI(
-    base_url="https://openrouter.ai/api/v1",
-    api_key=os.getenv("OPENROUTER_API_KEY"),
-)
+# Rate limited, coalesced and failed over by the provider gateway
+client = openrouter_client
+
+client2 = gemini_client
 
-client2 = genai.Client(api_key=os.getenv("GOOGLE_API_KEY"))
+# Long responses are split into chunks that are extracted concurrently
+KG_CHUNK_CHARS = int(os.getenv("KG_CHUNK_CHARS", "2000"))
+KG_CHUNK_OVERLAP = int(os.getenv("KG_CHUNK_OVERLAP", "1"))  # sentences repeated at the start of the next chunk
+KG_MAX_CONCURRENCY = int(os.getenv("KG_MAX_CONCURRENCY", "4"))
 
+# Extraction engine: "llm" always calls Gemini, "local" only uses the local extractor,
+# "hybrid" uses the local extractor first and calls the LLM when its result looks weak
+KG_ENGINE = os.getenv("KG_ENGINE", "hybrid")
+KG_MIN_COVERAGE = float(os.getenv("KG_MIN_COVERAGE", "0.6"))  # share of sentences that produced a triple
+KG_MIN_CONFIDENCE = float(os.getenv("KG_MIN_CONFIDENCE", "0.75"))  # mean confidence of the local triples
+
+KG_SYSTEM_INSTRUCTION = (
+    "You are a helpful assistant that extracts knowledge graphs from text."
+    "You will be provided with a text and you need to extract the knowledge graph in the form of triples. "
+    "The triples should be in the format (entity1, relation, entity2). "
+    "You should only return the triples, one per line, in the format (entity1, relation, entity2)."
+)
 
-conversation_history = []
 
 def call_llm_api(prompt: str) -> str:
     """
     Call the LLM API to generate a response for the given prompt using OpenAI via OpenRouter.
     """
-    global conversation_history
-    # Reset conversation history for each new request
+    # Each call gets its own history so chunks can be extracted concurrently
     conversation_history = []
     
     # System message to set up the LLM's behavior
@@ -56,14 +76,9 @@ def call_llm_api(prompt: str) -> str:
         # )
         # result = chat.choices[0].message.content.strip()
 
-        chat = client2.models.generate_content(
-            model="gemini-2.0-flash", 
-            contents=conversation_history,
-            config= types.GenerateContentConfig(system_instruction="You are a helpful assistant that extracts knowledge graphs from text."
-                "You will be provided with a text and you need to extract the knowledge graph in the form of triples. "
-                "The triples should be in the format (entity1, relation, entity2). "
-                "You should only return the triples, one per line, in the format (entity1, relation, entity2).")
-        )
+        with trace_span("llm", "gemini"):
+            chat = generate_content(client2, "gemini-2.0-flash", conversation_history, KG_SYSTEM_INSTRUCTION)
+        record_llm_call("gemini", "gemini-2.0-flash", chat)
         result = chat.candidates[0].content.parts[0].text.strip()
 
         # Append the LLM's response to the conversation history
@@ -71,46 +86,231 @@ def call_llm_api(prompt: str) -> str:
         assistant_msg = types.Content(role="assistant", parts=[types.Part.from_text(text=result)])
         conversation_history.append(assistant_msg)
         return result
+    except HTTPException:
+        # ProviderThrottled: every provider route is rate limited, passed on as a 429
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"LLM API call failed: {str(e)}")
 
 
 
+def stream_llm_api(prompt: str):
+    """
+    Call the LLM API and yield the generated text piece by piece as it arrives.
+    """
+    contents = [types.Content(role="user", parts=[types.Part.from_text(text=prompt)])]
+    start = time.perf_counter()
+    chunk = None
+    try:
+        for chunk in generate_content_stream(client2, "gemini-2.0-flash", contents, KG_SYSTEM_INSTRUCTION):
+            if chunk.text:
+                yield chunk.text
+    except HTTPException:
+        # ProviderThrottled: every provider route is rate limited, passed on as a 429
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"LLM API call failed: {str(e)}")
+    finally:
+        # The last chunk carries the usage for the whole stream
+        observe_stage("llm_stream", time.perf_counter() - start, "gemini")
+        record_llm_call("gemini", "gemini-2.0-flash", chunk)
+
+
 def parse_triples(llm_output: str) -> List[List[str]]:
     """
     Parse the LLM output into a list of triples [entity1, relation, entity2].
+    Accepts (entity1, relation, entity2) tuples with quoted entities, JSON lines and markdown tables.
     """
     try:
-        # Expected format: (entity1, relation, entity2) per line
-        triples = []
-        # Match patterns like (entity1, relation, entity2)
-        pattern = r"\(([^,]+),\s*([^,]+),\s*([^\)]+)\)"
-        for match in re.finditer(pattern, llm_output):
-            entity1, relation, entity2 = match.groups()
-            triples.append([entity1.strip(), relation.strip(), entity2.strip()])
-        if not triples:
-            return []
-        return triples
+        parser = TripleStreamParser()
+        return parser.feed(llm_output) + parser.close()
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to parse triples: {str(e)}")
-    
 
-def extract_knowledge_graph(response: str) -> List[List[str]]:
+
+def split_sentences(text: str) -> List[str]:
     """
-    Extract a knowledge graph from the response text using an LLM.
-    Returns a list of triples [entity1, relation, entity2].
+    Split a paragraph into sentences.
+    """
+    return [s.strip() for s in re.split(r'(?<=[.!?])\s+', text) if s.strip()]
+
+
+def split_text(text: str, max_chars: int = KG_CHUNK_CHARS, overlap: int = KG_CHUNK_OVERLAP) -> List[str]:
+    """
+    Split text into chunks of at most max_chars at paragraph boundaries, falling back to
+    sentence boundaries for long paragraphs. The last `overlap` sentences of each chunk are
+    repeated at the start of the next one so relations spanning a boundary are not lost.
+    """
+    if len(text) <= max_chars:
+        return [text]
+
+    # Units are whole paragraphs when they fit, otherwise their sentences
+    units = []
+    for paragraph in re.split(r'\n\s*\n', text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        if len(paragraph) <= max_chars:
+            units.append(paragraph)
+        else:
+            units.extend(split_sentences(paragraph))
+
+    chunks = []
+    current = []
+    for unit in units:
+        if current and len("\n\n".join(current + [unit])) > max_chars:
+            chunks.append("\n\n".join(current))
+            carried = split_sentences(current[-1])[-overlap:] if overlap else []
+            current = [" ".join(carried)] if carried else []
+        current.append(unit)
+    if current:
+        chunks.append("\n\n".join(current))
+    return chunks
+
+
+def canonical_entity(name: str) -> str:
+    """
+    Normalize an entity or relation name so that spelling variants compare equal.
+    """
+    name = name.strip().strip('"\'`*.,;:').lower()
+    name = re.sub(r'^(the|a|an)\s+', '', name)
+    return re.sub(r'\s+', ' ', name)
+
+
+class TripleMerger:
+    """
+    Deduplicate triples coming from several chunks.
+    Entities are matched on their canonical form and shown with the first spelling seen.
+    """
+
+    def __init__(self):
+        self.surface_forms = {}
+        self.seen = set()
+
+    def add(self, triple: List[str]):
+        """
+        Return the triple with canonical entity spellings, or None if it was already seen.
+        """
+        entity1, relation, entity2 = triple
+        key = (canonical_entity(entity1), canonical_entity(relation), canonical_entity(entity2))
+        if key in self.seen:
+            return None
+        self.seen.add(key)
+        entity1 = self.surface_forms.setdefault(key[0], entity1)
+        entity2 = self.surface_forms.setdefault(key[2], entity2)
+        return [entity1, relation, entity2]
+
+
+def merge_triples(triple_lists: List[List[List[str]]]) -> List[List[str]]:
+    """
+    Merge triples extracted from several chunks, dropping duplicates.
+    """
+    merger = TripleMerger()
+    merged = []
+    for triples in triple_lists:
+        for triple in triples:
+            triple = merger.add(triple)
+            if triple:
+                merged.append(triple)
+    return merged
+
+
+def build_extraction_prompt(text: str) -> str:
+    """
+    Build the extraction prompt for one chunk of text.
     """
-    # Define the prompt for the LLM
-    prompt = (
+    return (
         "Extract a knowledge graph from the following text in the form of triples: (entity1, relation, entity2).\n"
         "Each triple should represent a relationship between two entities.\n"
         "Return the triples as a list, one per line, in the format (entity1, relation, entity2).\n\n"
-        f"Text:\n{response}\n\n"
+        f"Text:\n{text}\n\n"
         "Triples:"
     )
 
+
+def extract_chunk(text: str) -> List[List[str]]:
+    """
+    Extract the triples of a single chunk of text with the LLM.
+    """
     # Use the real LLM API call
-    llm_output = call_llm_api(prompt)
+    llm_output = call_llm_api(build_extraction_prompt(text))
+
+    return parse_triples(llm_output)
+
+
+def local_fast_path(response: str):
+    """
+    Return the local extractor's triples when the engine settings allow it, otherwise None.
+    """
+    if KG_ENGINE not in ("local", "hybrid"):
+        return None
+    local = extract_local_triples(response)
+    if KG_ENGINE == "local":
+        return local["triples"]
+    if local["triples"] and local["coverage"] >= KG_MIN_COVERAGE and local["confidence"] >= KG_MIN_CONFIDENCE:
+        return local["triples"]
+    return None
+
+
+def extract_knowledge_graph(response: str) -> List[List[str]]:
+    """
+    Extract a knowledge graph from the response text using an LLM.
+    In hybrid mode the local extractor answers first and the LLM is only called when its
+    coverage or confidence is low. Long responses are split into chunks extracted
+    concurrently, then merged.
+    Returns a list of triples [entity1, relation, entity2].
+    """
+    local_triples = local_fast_path(response)
+    if local_triples is not None:
+        return local_triples
+
+    chunks = split_text(response)
+    if len(chunks) == 1:
+        return extract_chunk(chunks[0])
+
+    with ThreadPoolExecutor(max_workers=min(KG_MAX_CONCURRENCY, len(chunks))) as executor:
+        chunk_triples = list(executor.map(with_request_id(extract_chunk), chunks))
+
+    return merge_triples(chunk_triples)
+
+
+def stream_knowledge_graph(response: str):
+    """
+    Like extract_knowledge_graph, but yield each triple as soon as the streamed LLM output completes it.
+    """
+    local_triples = local_fast_path(response)
+    if local_triples is not None:
+        yield from local_triples
+        return
+
+    chunks = split_text(response)
+    results = queue.Queue()
+
+    def stream_chunk(text):
+        try:
+            parser = TripleStreamParser()
+            for piece in stream_llm_api(build_extraction_prompt(text)):
+                for triple in parser.feed(piece):
+                    results.put(triple)
+            for triple in parser.close():
+                results.put(triple)
+        except Exception as e:
+            results.put(e)
+        finally:
+            results.put(None)  # marks this chunk as done
 
-    triples = parse_triples(llm_output)
-    return triples
+    merger = TripleMerger()
+    with ThreadPoolExecutor(max_workers=min(KG_MAX_CONCURRENCY, len(chunks))) as executor:
+        for chunk in chunks:
+            executor.submit(with_request_id(stream_chunk), chunk)
+        remaining = len(chunks)
+        while remaining:
+            item = results.get()
+            if item is None:
+                remaining -= 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                triple = merger.add(item)
+                if triple:
+                    yield triple
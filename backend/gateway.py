@@ -0,0 +1,335 @@
+import asyncio
+import base64
+import io
+import itertools
+import os
+import time
+import wave
+import logging
+
+import httpx
+from fastapi import HTTPException, Request
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
+
+from instrumentation import observe_stage
+from structured_logging import request_id_var
+from tts_service.speech_chunks import pcm_stream_header
+
+# Gateway mode for backend/main.py.
+# With GATEWAY_MODE=remote the model endpoints are forwarded to the split services (image,
+# response, STT, TTS) over pooled keep-alive connections instead of running in this process,
+# so the Stable Diffusion and Whisper nodes can be scaled apart from the text path. Each
+# service may list several replicas; requests go to the replica with the fewest in flight,
+# and a replica that keeps failing is skipped by its circuit breaker until it recovers.
+
+logger = logging.getLogger(__name__)
+
+GATEWAY_MODE = os.getenv("GATEWAY_MODE", "local")  # "remote" forwards the model endpoints to the split services
+SERVICE_URLS = {
+    # Comma-separated replicas of each service
+    "image": os.getenv("IMAGE_SERVICE_URLS", "http://localhost:8001"),
+    "response": os.getenv("RESPONSE_SERVICE_URLS", "http://localhost:8002"),
+    "stt": os.getenv("STT_SERVICE_URLS", "http://localhost:8003"),
+    "tts": os.getenv("TTS_SERVICE_URLS", "http://localhost:8004"),
+}
+GATEWAY_MAX_CONNECTIONS = int(os.getenv("GATEWAY_MAX_CONNECTIONS", "200"))
+GATEWAY_MAX_KEEPALIVE = int(os.getenv("GATEWAY_MAX_KEEPALIVE", "50"))  # idle connections kept open for reuse
+GATEWAY_KEEPALIVE_S = float(os.getenv("GATEWAY_KEEPALIVE_S", "60"))
+GATEWAY_CONNECT_TIMEOUT_S = float(os.getenv("GATEWAY_CONNECT_TIMEOUT_S", "3"))
+GATEWAY_READ_TIMEOUT_S = float(os.getenv("GATEWAY_READ_TIMEOUT_S", "900"))  # image generation can take minutes on CPU
+GATEWAY_BREAKER_FAILURES = int(os.getenv("GATEWAY_BREAKER_FAILURES", "5"))  # consecutive failures that open the breaker
+GATEWAY_BREAKER_RESET_S = float(os.getenv("GATEWAY_BREAKER_RESET_S", "30"))  # how long an open breaker rejects requests
+
+# Endpoints of backend/main.py served by a split service, with the same path there
+PROXY_ROUTES = {
+    "/generate_image/": "image",
+    "/generate_response/": "response",
+    "/transcribe/": "stt",
+    "/api/text-to-speech/": "tts",
+}
+
+# Connection-level headers that must not be forwarded by a proxy
+_hop_by_hop = {"connection", "keep-alive", "proxy-authenticate", "proxy-authorization", "te", "trailer",
+               "transfer-encoding", "upgrade", "host"}
+# Headers describing the client's body, dropped when the upstream call sends a body of its own
+_body_headers = {"content-type", "content-length", "content-encoding"}
+# Methods that may be sent again after the request reached a replica; a repeated POST would
+# generate another image or another answer
+_idempotent = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+
+
+class CircuitBreaker:
+    """
+    Closed: requests flow. After `failures` consecutive failures it opens and rejects requests
+    for `reset_s`; then it lets a single trial request through (half-open), which closes it on
+    success or opens it again on failure.
+    """
+
+    def __init__(self, failures=GATEWAY_BREAKER_FAILURES, reset_s=GATEWAY_BREAKER_RESET_S):
+        self.max_failures = failures
+        self.reset_s = reset_s
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        return "half-open" if time.monotonic() - self.opened_at >= self.reset_s else "open"
+
+    def allow(self):
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half-open" and not self.trial_running:
+            self.trial_running = True
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+
+    def record_failure(self):
+        self.failures += 1
+        self.trial_running = False
+        if self.opened_at is not None or self.failures >= self.max_failures:
+            self.opened_at = time.monotonic()
+
+    def record_cancelled(self):
+        # A request cancelled on our side (client gone, timeout) says nothing about the replica,
+        # but a trial that never finished must not keep the breaker half-open for good
+        self.trial_running = False
+
+
+class Replica:
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+        self.breaker = CircuitBreaker()
+        self.in_flight = 0
+
+
+class _InFlightBody(httpx.AsyncByteStream):
+    """
+    The body of an upstream response. The request counts as in flight on its replica until the
+    body is closed, so long audio and image downloads weigh on the fewest-in-flight choice.
+    """
+
+    def __init__(self, stream, replica):
+        self._stream = stream
+        self._replica = replica
+        self._released = False
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self):
+        if not self._released:
+            self._released = True
+            self._replica.in_flight -= 1
+        await self._stream.aclose()
+
+
+class Backend:
+    """
+    The replicas of one split service.
+    """
+
+    def __init__(self, name, urls):
+        self.name = name
+        self.replicas = [Replica(url) for url in urls.split(",") if url.strip()]
+        self._order = itertools.count()
+
+    def candidates(self):
+        """
+        Replicas to try, best first: fewest requests in flight, ties rotated round-robin.
+        Replicas whose breaker is open are left out.
+        """
+        start = next(self._order)
+        count = len(self.replicas)
+        rotated = [self.replicas[(start + i) % count] for i in range(count)]
+        return sorted((r for r in rotated if r.breaker.state != "open"), key=lambda r: r.in_flight)
+
+
+class Gateway:
+    def __init__(self, service_urls=SERVICE_URLS):
+        self.backends = {name: Backend(name, urls) for name, urls in service_urls.items()}
+        self._client = None
+
+    @property
+    def client(self):
+        # Created on first use so it belongs to the server's event loop
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=GATEWAY_MAX_CONNECTIONS,
+                    max_keepalive_connections=GATEWAY_MAX_KEEPALIVE,
+                    keepalive_expiry=GATEWAY_KEEPALIVE_S,
+                ),
+                timeout=httpx.Timeout(GATEWAY_READ_TIMEOUT_S, connect=GATEWAY_CONNECT_TIMEOUT_S),
+            )
+        return self._client
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+
+    async def send(self, service, method, path, headers=None, content=None, retry_body=True, **kwargs):
+        """
+        Send a request to one replica of the service and return the response with its body
+        not yet read; the caller must close it. Connection failures move on to the next replica.
+        Other failures (a read timeout, a dropped connection) are only retried for idempotent
+        methods, and a body that is being streamed (retry_body=False) never.
+        """
+        backend = self.backends[service]
+        headers = dict(headers or {})
+        request_id = request_id_var.get()
+        if request_id:
+            headers["X-Request-ID"] = request_id
+
+        last_error = None
+        for replica in backend.candidates():
+            if not replica.breaker.allow():
+                continue
+            replica.in_flight += 1
+            start = time.perf_counter()
+            try:
+                request = self.client.build_request(method, replica.url + path, headers=headers, content=content, **kwargs)
+                response = await self.client.send(request, stream=True)
+            except (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout) as e:
+                replica.in_flight -= 1
+                replica.breaker.record_failure()
+                last_error = e
+                logger.warning("Upstream connection failed", extra={"service": service, "replica": replica.url, "error": str(e)})
+                continue
+            except httpx.HTTPError as e:
+                replica.in_flight -= 1
+                replica.breaker.record_failure()
+                last_error = e
+                logger.warning("Upstream request failed", extra={"service": service, "replica": replica.url, "error": str(e)})
+                if not retry_body or method.upper() not in _idempotent:
+                    break
+                continue
+            except BaseException:
+                replica.in_flight -= 1
+                replica.breaker.record_cancelled()
+                raise
+            finally:
+                observe_stage("upstream", time.perf_counter() - start, service)
+
+            # Released when the caller closes the response
+            response.stream = _InFlightBody(response.stream, replica)
+
+            if response.status_code >= 500:
+                replica.breaker.record_failure()
+            else:
+                replica.breaker.record_success()
+            return response
+
+        detail = f"{service} service unavailable"
+        if last_error is not None:
+            detail += f": {last_error}"
+        raise HTTPException(status_code=503, detail=detail)
+
+    async def proxy(self, request: Request, service):
+        """
+        Forward the request as it is, streaming the body both ways, and return the service's response.
+        """
+        headers = {k: v for k, v in request.headers.items() if k.lower() not in _hop_by_hop}
+        upstream = await self.send(
+            service, request.method, request.url.path, headers=headers,
+            content=request.stream(), params=request.query_params, retry_body=False,
+        )
+        response_headers = {k: v for k, v in upstream.headers.items() if k.lower() not in _hop_by_hop}
+        return StreamingResponse(
+            upstream.aiter_raw(), status_code=upstream.status_code, headers=response_headers,
+            background=BackgroundTask(upstream.aclose),
+        )
+
+    async def post_json(self, service, path, **kwargs):
+        """
+        POST to the service and return its JSON body, raising its error status as an HTTPException.
+        """
+        response = await self.send(service, "POST", path, **kwargs)
+        try:
+            await response.aread()
+        finally:
+            await response.aclose()
+        if response.status_code >= 400:
+            try:
+                detail = response.json().get("detail", response.text)
+            except ValueError:
+                detail = response.text
+            raise HTTPException(status_code=response.status_code, detail=detail)
+        return response.json()
+
+    async def speech_to_text(self, audio_bytes: bytes, headers=None) -> str:
+        result = await self.post_json("stt", "/transcribe/", headers=headers, files={"file": ("audio", audio_bytes)})
+        return result["transcription"]
+
+    async def generate_valid_response(self, question, logicalGroups, headers=None) -> dict:
+        return await self.post_json("response", "/generate_response/", headers=headers, json={
+            "question": question,
+            "logicalGroups": [group.model_dump() for group in logicalGroups],
+        })
+
+    async def text_to_speech(self, text: str, maleSpeaker: bool, headers=None) -> bytes:
+        result = await self.post_json("tts", "/api/text-to-speech/", headers=headers, json={"text": text, "maleSpeaker": maleSpeaker})
+        return base64.b64decode(result["audio"])
+
+    async def stream_speech(self, chunks, maleSpeaker: bool, headers=None):
+        """
+        Like stream_speech in main.py, with each chunk synthesized by the TTS service: one WAV
+        stream, the next chunk requested while the current one is sent. headers go with every
+        chunk's request, as forwarded_headers() of the client's request.
+        """
+        if not chunks:
+            return
+        next_audio = asyncio.ensure_future(self.text_to_speech(chunks[0], maleSpeaker, headers))
+        for i in range(len(chunks)):
+            audio = await next_audio
+            if i + 1 < len(chunks):
+                next_audio = asyncio.ensure_future(self.text_to_speech(chunks[i + 1], maleSpeaker, headers))
+            with wave.open(io.BytesIO(audio)) as wav:
+                if i == 0:
+                    yield pcm_stream_header(wav.getframerate())
+                yield wav.readframes(wav.getnframes())
+
+    def health(self):
+        return {
+            name: [{"url": r.url, "breaker": r.breaker.state, "in_flight": r.in_flight} for r in backend.replicas]
+            for name, backend in self.backends.items()
+        }
+
+
+gateway = Gateway()
+
+
+def forwarded_headers(request: Request):
+    """
+    The client's end-to-end headers, as proxy() forwards them, for upstream calls made on its
+    behalf with a body of their own.
+    """
+    return {k: v for k, v in request.headers.items() if k.lower() not in _hop_by_hop | _body_headers}
+
+
+def add_gateway_routes(app):
+    """
+    Route the model endpoints of app to the split services and add GET /gateway/health.
+    Called before the local endpoints are declared, so these routes match first.
+    """
+    def forward_to(service):
+        async def forward(request: Request):
+            return await gateway.proxy(request, service)
+        return forward
+
+    for path, service in PROXY_ROUTES.items():
+        app.add_api_route(path, forward_to(service), methods=["POST"], include_in_schema=False)
+
+    @app.get("/gateway/health")
+    def gateway_health():
+        return gateway.health()
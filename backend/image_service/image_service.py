@@ -5,19 +5,15 @@ import base64
 from fastapi import HTTPException
 from transformers import CLIPProcessor, CLIPModel
 from typing import List
-from pydantic import BaseModel 
+from constraint_plan import LogicalGroup, compile_plan
+from instrumentation import trace_span, record_model_memory, DIFFUSION_STEPS
+import logging
 
-class Constraint(BaseModel):
-    type: str
-    value: str
-
-class LogicalGroup(BaseModel):
-    operator: str  # AND, OR, NOT
-    constraints: List[Constraint]
+logger = logging.getLogger(__name__)
 
 # Check for GPU availability
 device = "cuda" if torch.cuda.is_available() else "cpu"
-print(f"Using device: {device}")
+logger.info("Using device: %s", device)
 
 # Load the Stable Diffusion model
 pipe = StableDiffusionPipeline.from_pretrained(
@@ -33,55 +29,38 @@ if device == "cuda":
 model = CLIPModel.from_pretrained("openai/clip-vit-base-patch32")
 processor = CLIPProcessor.from_pretrained("openai/clip-vit-base-patch32")
 
-def generate_prompt(logicalGroups: List[LogicalGroup]) -> str:
-    """
-    Generate a detailed text prompt based on the constraints.
-    """
-    prompt = "A high-quality, realistic image of "
-    for group in logicalGroups:
-        for constraint in group.constraints:
-            if constraint.type == "object_inclusion":
-                if group.operator == "NOT":
-                    continue
-                else:
-                    prompt += f"a {constraint.value}, "
-            elif constraint.type == "color_inclusion":
-                if group.operator == "NOT":
-                    continue
-                else:
-                    prompt += f"with a {constraint.value} color, "
-    prompt += "and a peaceful, vibrant atmosphere."
-    return prompt
+record_model_memory("runwayml/stable-diffusion-v1-5", pipe.unet, pipe.vae, pipe.text_encoder)
+record_model_memory("openai/clip-vit-base-patch32", model)
 
-def generate_image(prompt: str):
+def generate_image(prompt: str, steps: int = None, seed: int = None):
     """
     Use Stable Diffusion to generate an image based on the prompt.
+    steps and seed are fixed by benchmarks; the service leaves them to the defaults.
     """
-    image = pipe(
-        prompt,
-        num_inference_steps=140 if device == "cuda" else 50,  # More steps for GPU
-        guidance_scale=12 if device == "cuda" else 7.5,  # Stronger guidance for GPU
-    ).images[0]
+    if steps is None:
+        steps = 140 if device == "cuda" else 50  # More steps for GPU
+    generator = torch.Generator(device).manual_seed(seed) if seed is not None else None
+    with trace_span("diffusion"):
+        image = pipe(
+            prompt,
+            num_inference_steps=steps,
+            guidance_scale=12 if device == "cuda" else 7.5,  # Stronger guidance for GPU
+            generator=generator,
+        ).images[0]
+    DIFFUSION_STEPS.inc(steps)
     return image
 
-def validate_image(image, logicalGroups: List[LogicalGroup]) -> bool:
+def validate_image(image, plan) -> bool:
     """
     Validate if the generated image meets the constraints using CLIP.
     """
-    text_descriptions = []
-    for group in logicalGroups:
-        for constraint in group.constraints:
-            if constraint.type == "object_inclusion":
-                if group.operator == "NOT":
-                    text_descriptions.append(f"a photo without {constraint.value}")
-                else:
-                    text_descriptions.append(f"a photo of {constraint.value}")
-
+    text_descriptions = list(plan.clip_phrases)
     if not text_descriptions:
         return True
 
-    inputs = processor(text=text_descriptions, images=image, return_tensors="pt", padding=True)
-    outputs = model(**inputs)
+    with trace_span("clip_scoring"):
+        inputs = processor(text=text_descriptions, images=image, return_tensors="pt", padding=True)
+        outputs = model(**inputs)
     logits_per_image = outputs.logits_per_image
     probs = logits_per_image.softmax(dim=1)
 
@@ -94,20 +73,21 @@ def generate_valid_image(logicalGroups: List[LogicalGroup]):
     """
     Generate and validate an image based on the given constraints.
     """
-    prompt = generate_prompt(logicalGroups)
-    print("Generated Prompt:", prompt)
+    plan = compile_plan(logicalGroups)
+    prompt = plan.image_prompt
+    logger.info("Generated prompt: %s", prompt)
 
     max_attempts = 5 if device == "cuda" else 3  # More attempts on GPU
     for attempt in range(max_attempts):
         image = generate_image(prompt)
-        if validate_image(image, logicalGroups):
-            print(logicalGroups)
-            print("Image validation successful.")
+        if validate_image(image, plan):
+            logger.info("Image validation successful", extra={"attempt": attempt + 1})
+            logger.debug("Logical groups: %s", logicalGroups)
             buffered = io.BytesIO()
             image.save(buffered, format="PNG")
             image_base64 = base64.b64encode(buffered.getvalue()).decode("utf-8")
             return image_base64
         else:
-            print(f"Image validation failed. Regenerating (attempt {attempt + 1}/{max_attempts})...")
+            logger.info("Image validation failed, regenerating", extra={"attempt": attempt + 1, "max_attempts": max_attempts})
     
-    raise HTTPException(status_code=400, detail="Failed to generate a valid image after multiple attempts.")
\ No newline at end of file
+    raise HTTPException(status_code=400, detail="Failed to generate a valid image after multiple attempts.")
@@ -2,7 +2,19 @@ from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
 from typing import List
 from fastapi.middleware.cors import CORSMiddleware
-from image_service import generate_valid_image,LogicalGroup
+from instrumentation import instrument_app
+from structured_logging import configure_logging, add_request_id
+from inference_broker import INFERENCE_MODE, Broker, add_inference_routes
+from constraint_plan import LogicalGroup
+
+if INFERENCE_MODE == "workers":
+    # Stable Diffusion and CLIP run in worker processes
+    broker = Broker()
+    broker.register("image", "image_service:generate_valid_image")
+else:
+    from image_service import generate_valid_image
+
+configure_logging()
 
 app = FastAPI()
 
@@ -12,15 +24,24 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Server-Timing", "X-Request-ID"],
 )
 
+instrument_app(app, "image_service")
+add_request_id(app)
+if INFERENCE_MODE == "workers":
+    add_inference_routes(app, broker)
+
 class GenerateImageRequest(BaseModel):
     logicalGroups: List[LogicalGroup]
 
 @app.post("/generate_image/")
 async def generate_image_endpoint(request: GenerateImageRequest):
     try:
-        image_base64 = generate_valid_image(request.logicalGroups)
+        if INFERENCE_MODE == "workers":
+            image_base64 = await broker.run("image", request.logicalGroups)
+        else:
+            image_base64 = generate_valid_image(request.logicalGroups)
         return {"image": image_base64}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -0,0 +1,425 @@
+"""
+Run the models in dedicated worker processes behind a local broker.
+
+By default the split services call their model in the HTTP process. With
+INFERENCE_MODE=workers the service instead starts a Broker, which listens on a Unix socket
+and hands each job to one of a pool of worker processes per engine. The front-end only
+handles HTTP, so its concurrency and the number of model replicas can be tuned separately,
+and every worker can be pinned to its own set of cores.
+
+Workers are started by the broker, or by hand (for example under taskset or in another
+container sharing the socket) with:
+    python inference_broker.py worker --socket /tmp/inference.sock --engine stt --target STT_service:speech_to_text --path stt_service
+Both need the same INFERENCE_AUTHKEY.
+"""
+import argparse
+import asyncio
+import atexit
+import importlib
+import importlib.util
+import itertools
+import logging
+import os
+import secrets
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from multiprocessing.connection import Client, Listener
+
+logger = logging.getLogger(__name__)
+
+INFERENCE_MODE = os.getenv("INFERENCE_MODE", "inprocess")  # "workers" moves the models out of the HTTP process
+INFERENCE_SOCKET = os.getenv("INFERENCE_SOCKET", "")  # empty picks a private path per front-end process
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", "1"))  # worker processes per engine
+INFERENCE_CORE_SETS = os.getenv("INFERENCE_CORE_SETS", "")  # e.g. "0-3;4-7": cores of each worker, reused round-robin
+INFERENCE_WORKER_CONCURRENCY = int(os.getenv("INFERENCE_WORKER_CONCURRENCY", "1"))  # jobs one worker runs at once
+INFERENCE_HEALTH_INTERVAL_S = float(os.getenv("INFERENCE_HEALTH_INTERVAL_S", "10"))
+INFERENCE_JOB_TIMEOUT_S = float(os.getenv("INFERENCE_JOB_TIMEOUT_S", "900"))  # a worker stuck longer is restarted
+
+
+class WorkerError(RuntimeError):
+    """
+    A job failed in the worker, or the worker running it died.
+    """
+
+
+def parse_core_sets(value):
+    """
+    "0-3;4,5" -> [{0, 1, 2, 3}, {4, 5}]
+    """
+    core_sets = []
+    for group in filter(None, (g.strip() for g in value.split(";"))):
+        cores = set()
+        for part in group.split(","):
+            start, _, end = part.partition("-")
+            cores.update(range(int(start), int(end or start) + 1))
+        core_sets.append(cores)
+    return core_sets
+
+
+class _Worker:
+    def __init__(self, engine, conn, pid, capacity, process=None):
+        self.engine = engine
+        self.conn = conn
+        self.pid = pid
+        self.capacity = capacity
+        self.process = process
+        self.jobs = {}  # job id -> (future, start time)
+        self.last_seen = time.monotonic()
+        self.alive = True
+        self.draining = False
+
+
+class _Engine:
+    def __init__(self, name, target, count, core_sets):
+        self.name = name
+        self.target = target
+        self.count = count
+        self.core_sets = core_sets
+        self.workers = []
+        self.starting = []  # processes started but not yet connected
+        self.pending = []  # (job id, future, args, kwargs) waiting for a free worker
+        self.spawned = 0
+        self.completed = 0
+        self.failed = 0
+
+
+class Broker:
+    """
+    Accept worker connections on a Unix socket and dispatch jobs to them, per engine.
+    The broker's own threads (accept, one reader per worker, health monitor) never run model code.
+    """
+
+    def __init__(self, socket_path=INFERENCE_SOCKET, authkey=None):
+        self.socket_path = socket_path or os.path.join(tempfile.gettempdir(), f"inference-{os.getpid()}.sock")
+        authkey = authkey or os.getenv("INFERENCE_AUTHKEY")
+        self.authkey = bytes.fromhex(authkey) if authkey else secrets.token_bytes(16)
+        self.engines = {}
+        self._lock = threading.Lock()
+        self._ids = itertools.count()
+        self._listener = None
+        self._started = False
+        self._closing = False
+
+    def register(self, engine, target, workers=INFERENCE_WORKERS, core_sets=INFERENCE_CORE_SETS):
+        """
+        Declare an engine served by `target` ("module:function"), with its worker count and cores.
+        """
+        self.engines[engine] = _Engine(engine, target, workers, parse_core_sets(core_sets))
+
+    def start(self):
+        """
+        Listen for workers and start the configured number for every engine.
+        Called by the first job or health check, so importing the service stays cheap.
+        """
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        self._listener = Listener(self.socket_path, family="AF_UNIX", authkey=self.authkey)
+        threading.Thread(target=self._accept, name="inference-accept", daemon=True).start()
+        threading.Thread(target=self._monitor, name="inference-health", daemon=True).start()
+        with self._lock:
+            for engine in self.engines.values():
+                self._scale(engine)
+        atexit.register(self.close)
+        logger.info("Inference broker listening", extra={"socket": self.socket_path, "engines": list(self.engines)})
+
+    def close(self):
+        self._closing = True
+        with self._lock:
+            for engine in self.engines.values():
+                for worker in list(engine.workers):
+                    self._send(worker, ("stop",))
+                for process in engine.starting + [w.process for w in engine.workers if w.process]:
+                    process.terminate()
+        if self._listener is not None:
+            self._listener.close()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+    def submit(self, engine, *args, **kwargs) -> Future:
+        """
+        Queue one call of the engine's target and return a future for its result.
+        """
+        self.start()
+        future = Future()
+        with self._lock:
+            self.engines[engine].pending.append((next(self._ids), future, args, kwargs))
+            self._dispatch(self.engines[engine])
+        return future
+
+    async def run(self, engine, *args, **kwargs):
+        return await asyncio.wrap_future(self.submit(engine, *args, **kwargs))
+
+    def resize(self, engine, count):
+        """
+        Change the number of workers of an engine; extra workers finish their jobs and stop.
+        """
+        with self._lock:
+            state = self.engines[engine]
+            state.count = max(0, count)
+            surplus = len(state.workers) + len(state.starting) - state.count
+            for worker in sorted(state.workers, key=lambda w: len(w.jobs))[:max(surplus, 0)]:
+                state.workers.remove(worker)
+                worker.draining = True
+                self._send(worker, ("drain",))
+            self._scale(state)
+
+    def health(self):
+        self.start()
+        with self._lock:
+            return {
+                name: {
+                    "target": engine.target,
+                    "workers": engine.count,
+                    "ready": sum(1 for w in engine.workers if w.alive),
+                    "starting": len(engine.starting),
+                    "busy": sum(len(w.jobs) for w in engine.workers),
+                    "queued": len(engine.pending),
+                    "completed": engine.completed,
+                    "failed": engine.failed,
+                    "spawned": engine.spawned,
+                }
+                for name, engine in self.engines.items()
+            }
+
+    # Everything below runs with self._lock held unless it says otherwise
+
+    def _scale(self, engine):
+        engine.starting = [p for p in engine.starting if p.poll() is None]
+        while not self._closing and len(engine.workers) + len(engine.starting) < engine.count:
+            cores = engine.core_sets[engine.spawned % len(engine.core_sets)] if engine.core_sets else None
+            engine.starting.append(self._spawn(engine, cores))
+            engine.spawned += 1
+
+    def _spawn(self, engine, cores):
+        module = engine.target.split(":")[0]
+        spec = importlib.util.find_spec(module)
+        # The directory the target module is importable from, and backend/ for the shared modules
+        root = os.path.dirname(spec.origin)
+        for _ in range(module.count(".")):
+            root = os.path.dirname(root)
+        env = dict(os.environ, INFERENCE_AUTHKEY=self.authkey.hex())
+        env["PYTHONPATH"] = os.pathsep.join(filter(None, [os.path.dirname(os.path.abspath(__file__)), env.get("PYTHONPATH")]))
+        command = [sys.executable, os.path.abspath(__file__), "worker", "--socket", self.socket_path,
+                   "--engine", engine.name, "--target", engine.target, "--path", root]
+        if cores:
+            command += ["--cores", ",".join(map(str, sorted(cores)))]
+        return subprocess.Popen(command, env=env)
+
+    def _send(self, worker, message):
+        try:
+            worker.conn.send(message)
+            return True
+        except (OSError, ValueError):
+            self._lost(worker, "connection closed")
+            return False
+
+    def _dispatch(self, engine):
+        while engine.pending:
+            free = [w for w in engine.workers if w.alive and len(w.jobs) < w.capacity]
+            if not free:
+                return
+            worker = min(free, key=lambda w: len(w.jobs))
+            job = engine.pending.pop(0)
+            job_id, future, args, kwargs = job
+            # A job put back after a failed send is already running
+            if not (future.running() or future.set_running_or_notify_cancel()):
+                continue
+            try:
+                worker.conn.send(("job", job_id, args, kwargs))
+            except (OSError, ValueError):
+                # The job never reached the worker, so another one can take it; _lost dispatches it
+                engine.pending.insert(0, job)
+                self._lost(worker, "connection closed")
+                return
+            worker.jobs[job_id] = (future, time.monotonic())
+
+    def _lost(self, worker, reason):
+        if not worker.alive:
+            return
+        worker.alive = False
+        engine = self.engines[worker.engine]
+        if worker in engine.workers:
+            engine.workers.remove(worker)
+        for future, _ in worker.jobs.values():
+            engine.failed += 1
+            future.set_exception(WorkerError(f"{worker.engine} worker {worker.pid} stopped: {reason}"))
+        worker.jobs.clear()
+        try:
+            worker.conn.close()
+        except OSError:
+            pass
+        if worker.process is not None and worker.process.poll() is None:
+            worker.process.kill()
+        if worker.draining:
+            logger.info("Inference worker stopped", extra={"engine": worker.engine, "pid": worker.pid})
+        else:
+            logger.warning("Inference worker lost", extra={"engine": worker.engine, "pid": worker.pid, "reason": reason})
+        self._scale(engine)
+        self._dispatch(engine)
+
+    # Broker threads
+
+    def _accept(self):
+        while not self._closing:
+            try:
+                conn = self._listener.accept()
+                engine_name, pid, capacity = conn.recv()[1:]
+            except (OSError, EOFError):
+                if self._closing:
+                    return
+                logger.exception("Inference worker failed to connect")
+                continue
+            with self._lock:
+                engine = self.engines.get(engine_name)
+                if engine is None:
+                    conn.close()
+                    continue
+                process = next((p for p in engine.starting if p.pid == pid), None)
+                if process is not None:
+                    engine.starting.remove(process)
+                worker = _Worker(engine_name, conn, pid, capacity, process)
+                engine.workers.append(worker)
+                self._dispatch(engine)
+            logger.info("Inference worker ready", extra={"engine": engine_name, "pid": pid, "capacity": capacity})
+            threading.Thread(target=self._read, args=(worker,), name=f"inference-{engine_name}-{pid}", daemon=True).start()
+
+    def _read(self, worker):
+        while True:
+            try:
+                message = worker.conn.recv()
+            except (OSError, EOFError):
+                with self._lock:
+                    self._lost(worker, "exited")
+                return
+            with self._lock:
+                worker.last_seen = time.monotonic()
+                if message[0] == "result":
+                    _, job_id, ok, value = message
+                    future, _ = worker.jobs.pop(job_id, (None, None))
+                    engine = self.engines[worker.engine]
+                    if future is not None:
+                        if ok:
+                            engine.completed += 1
+                            future.set_result(value)
+                        else:
+                            engine.failed += 1
+                            future.set_exception(WorkerError(value))
+                    self._dispatch(engine)
+
+    def _monitor(self):
+        while not self._closing:
+            time.sleep(INFERENCE_HEALTH_INTERVAL_S)
+            now = time.monotonic()
+            with self._lock:
+                for engine in self.engines.values():
+                    for worker in list(engine.workers):
+                        stuck = any(now - started > INFERENCE_JOB_TIMEOUT_S for _, started in worker.jobs.values())
+                        silent = now - worker.last_seen > 3 * INFERENCE_HEALTH_INTERVAL_S and not worker.jobs
+                        if stuck or silent:
+                            self._lost(worker, "job timed out" if stuck else "missed health checks")
+                        else:
+                            self._send(worker, ("ping",))
+                    self._scale(engine)
+
+
+def add_inference_routes(app, broker):
+    """
+    Add the broker's health check and worker scaling endpoints to a FastAPI app.
+    """
+    from fastapi import HTTPException
+    from pydantic import BaseModel
+
+    class WorkerCount(BaseModel):
+        count: int
+
+    @app.get("/inference/health")
+    def inference_health():
+        health = broker.health()
+        if any(engine["workers"] and not engine["ready"] for engine in health.values()):
+            raise HTTPException(status_code=503, detail=health)
+        return health
+
+    @app.put("/inference/workers/{engine}")
+    def inference_workers(engine: str, request: WorkerCount):
+        if engine not in broker.engines:
+            raise HTTPException(status_code=404, detail=f"Unknown engine: {engine}")
+        broker.resize(engine, request.count)
+        return broker.health()[engine]
+
+
+def run_worker(socket_path, engine, target, cores=None, concurrency=INFERENCE_WORKER_CONCURRENCY, path=None):
+    """
+    Load the target once and serve jobs from the broker until told to stop.
+    path is searched first for the target's module: started as a script, the worker has
+    backend/ first on sys.path, where image_service is the package and not the service module.
+    """
+    if path:
+        sys.path.insert(0, os.path.abspath(path))
+    if cores:
+        os.sched_setaffinity(0, cores)
+    module_name, function_name = target.split(":")
+    function = getattr(importlib.import_module(module_name), function_name)
+    if cores and "torch" in sys.modules:
+        sys.modules["torch"].set_num_threads(len(cores))
+
+    conn = Client(socket_path, family="AF_UNIX", authkey=bytes.fromhex(os.environ["INFERENCE_AUTHKEY"]))
+    send_lock = threading.Lock()
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+
+    def send(message):
+        with send_lock:
+            conn.send(message)
+
+    def run_job(job_id, args, kwargs):
+        try:
+            send(("result", job_id, True, function(*args, **kwargs)))
+        except Exception as e:
+            logger.exception("Inference job failed", extra={"engine": engine})
+            send(("result", job_id, False, str(e)))
+
+    send(("hello", engine, os.getpid(), concurrency))
+    message = ("stop",)
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            break
+        if message[0] == "job":
+            executor.submit(run_job, *message[1:])
+        elif message[0] == "ping":
+            send(("pong",))
+        elif message[0] in ("drain", "stop"):
+            break
+    # drain lets the jobs already received finish; stop comes with the broker shutting down
+    executor.shutdown(wait=message[0] == "drain")
+    conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    worker = subparsers.add_parser("worker", help="Serve one engine's jobs for a broker")
+    worker.add_argument("--socket", required=True)
+    worker.add_argument("--engine", required=True)
+    worker.add_argument("--target", required=True, help="module:function to call for each job")
+    worker.add_argument("--cores", help="Comma-separated cores to pin the worker to")
+    worker.add_argument("--concurrency", type=int, default=INFERENCE_WORKER_CONCURRENCY)
+    worker.add_argument("--path", help="Directory to import the target's module from, ahead of everything else")
+    args = parser.parse_args()
+
+    from structured_logging import configure_logging
+    configure_logging()
+    cores = {int(c) for c in args.cores.split(",")} if args.cores else None
+    run_worker(args.socket, args.engine, args.target, cores, args.concurrency, args.path)
+
+
+if __name__ == "__main__":
+    main()
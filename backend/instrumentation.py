@@ -0,0 +1,165 @@
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+from starlette.requests import Request
+from starlette.responses import Response
+
+# Metrics and request-scoped tracing shared by backend/main.py and the split services.
+# Every service exposes GET /metrics in the Prometheus text format, and every response carries
+# a Server-Timing header with the time spent in each stage of that request.
+
+METRICS_PATH = os.getenv("METRICS_PATH", "/metrics")
+# Set by prefork.py: each worker process writes its metrics there and /metrics sums them over all workers
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+
+_stage_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds", "Latency of HTTP requests",
+    ["service", "method", "route", "status"], buckets=_stage_buckets,
+)
+STAGE_LATENCY = Histogram(
+    "stage_duration_seconds", "Latency of one pipeline stage (audio decode, Whisper, LLM call, validation, ...)",
+    ["stage", "provider"], buckets=_stage_buckets,
+)
+LLM_CALLS = Counter("llm_calls_total", "Provider calls", ["provider", "model", "outcome"])
+LLM_TOKENS = Counter("llm_tokens_total", "Tokens reported by the provider", ["provider", "model", "kind"])
+LLM_FIRST_TOKEN = Histogram(
+    "llm_time_to_first_token_seconds", "Time from sending a streaming provider call to its first token",
+    ["provider", "model", "prompt_cache"], buckets=_stage_buckets,
+)
+LLM_CALL_LATENCY = Histogram(
+    "llm_call_duration_seconds", "Time from sending a non-streaming provider call to its whole reply",
+    ["provider", "model", "prompt_cache"], buckets=_stage_buckets,
+)
+CORRECTION_ITERATIONS = Histogram(
+    "correction_iterations", "LLM correction turns per constrained generation request",
+    buckets=(0, 1, 2, 3, 4, 5, 7, 10, 15, 20),
+)
+SEMANTIC_CACHE_LOOKUPS = Counter(
+    "semantic_cache_lookups_total", "Semantic cache lookups: hit, miss, or rejected when a similar answer failed validation", ["outcome"],
+)
+BATCH_ITEMS = Counter("batch_items_total", "Items of batch jobs by outcome: ok, error, or retried after a 429", ["outcome"])
+DIFFUSION_STEPS = Counter("diffusion_steps_total", "Stable Diffusion denoising steps run")
+MODEL_MEMORY = Gauge(
+    "model_memory_bytes", "Memory held by the weights of a loaded model", ["model", "device"],
+    multiprocess_mode="max",  # the pre-fork workers share the master's weights, so they are not added up
+)
+
+# Stages timed during the current request, in order: [(stage, seconds), ...]
+_request_spans = ContextVar("request_spans", default=None)
+
+
+@contextmanager
+def trace_span(stage, provider=""):
+    """
+    Time a block as one stage of the current request.
+    The duration goes to the stage histogram and to the request's Server-Timing header.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - start, provider)
+
+
+def observe_stage(stage, seconds, provider=""):
+    """
+    Record a stage that was timed by hand, for code that does not fit in one with-block.
+    """
+    STAGE_LATENCY.labels(stage, provider).observe(seconds)
+    spans = _request_spans.get()
+    if spans is not None:
+        spans.append((f"{stage}-{provider}" if provider else stage, seconds))
+
+
+def record_llm_call(provider, model, chat):
+    """
+    Count a provider call and the tokens it reports. Understands Gemini responses
+    (usage_metadata) and OpenAI-compatible ones (usage).
+    Prompt tokens served from a provider-side cache are also counted as "cached_prompt",
+    so prompt minus cached_prompt is the input billed at the full rate.
+    """
+    LLM_CALLS.labels(provider, model, "ok" if chat else "empty").inc()
+    usage = getattr(chat, "usage_metadata", None)
+    if usage is not None:
+        prompt, completion = usage.prompt_token_count, usage.candidates_token_count
+        cached = getattr(usage, "cached_content_token_count", None)
+    else:
+        usage = getattr(chat, "usage", None)
+        if usage is None:
+            return
+        prompt, completion = usage.prompt_tokens, usage.completion_tokens
+        cached = getattr(getattr(usage, "prompt_tokens_details", None), "cached_tokens", None)
+    LLM_TOKENS.labels(provider, model, "prompt").inc(prompt or 0)
+    LLM_TOKENS.labels(provider, model, "cached_prompt").inc(cached or 0)
+    LLM_TOKENS.labels(provider, model, "completion").inc(completion or 0)
+
+
+def observe_first_token(provider, model, seconds, prompt_cache="none"):
+    """
+    Record the time to the first token of a streaming provider call, labelled by whether the
+    system instruction came from a provider-side cache ("hit") or was sent inline ("none").
+    """
+    LLM_FIRST_TOKEN.labels(provider, model, prompt_cache).observe(seconds)
+
+
+def observe_llm_call(provider, model, seconds, prompt_cache="none"):
+    """
+    Record the duration of a non-streaming provider call, labelled like observe_first_token.
+    """
+    LLM_CALL_LATENCY.labels(provider, model, prompt_cache).observe(seconds)
+
+
+def record_model_memory(name, *modules):
+    """
+    Set the memory gauge of a model from the parameters and buffers of its torch modules.
+    """
+    total = 0
+    device = "cpu"
+    for module in modules:
+        for tensor in list(module.parameters()) + list(module.buffers()):
+            total += tensor.numel() * tensor.element_size()
+            device = str(tensor.device)
+    MODEL_MEMORY.labels(name, device).set(total)
+
+
+def instrument_app(app, service):
+    """
+    Add GET /metrics and the per-request latency and tracing middleware to a FastAPI app.
+    """
+
+    @app.get(METRICS_PATH, include_in_schema=False)
+    def metrics():
+        if PROMETHEUS_MULTIPROC_DIR:
+            # Whichever worker answers reports the totals of all of them
+            registry = CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+            return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
+        return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+    @app.middleware("http")
+    async def trace_request(request: Request, call_next):
+        spans = []
+        token = _request_spans.set(spans)
+        start = time.perf_counter()
+        status = 500
+        try:
+            response = await call_next(request)
+            status = response.status_code
+        finally:
+            elapsed = time.perf_counter() - start
+            route = request.scope.get("route")
+            # Label by route template, not the raw path, so path parameters do not explode the series
+            REQUEST_LATENCY.labels(service, request.method, getattr(route, "path", "unmatched"), status).observe(elapsed)
+            _request_spans.reset(token)
+
+        timings = {}
+        for stage, seconds in spans:
+            timings[stage] = timings.get(stage, 0.0) + seconds
+        timings["total"] = elapsed
+        response.headers["Server-Timing"] = ", ".join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in timings.items())
+        return response
@@ -0,0 +1,275 @@
+import fcntl
+import json
+import os
+import re
+import tempfile
+import threading
+from array import array
+from collections import OrderedDict
+from typing import List
+
+from convertToKG import canonical_entity
+
+# Session-scoped knowledge graphs that grow as the conversation goes on
+KG_MAX_SESSIONS = int(os.getenv("KG_MAX_SESSIONS", "1000"))  # least recently used sessions are dropped from memory
+KG_STORE_DIR = os.getenv("KG_STORE_DIR")  # when set, each session graph is persisted there as JSON
+
+# Session IDs come from clients and name files, so only filename-safe ones are accepted
+_session_id = re.compile(r"^[A-Za-z0-9_-]{1,128}$")
+
+
+class KnowledgeGraphStore:
+    """
+    Knowledge graph with interned entity and relation IDs.
+    Edges live in three parallel int arrays (subject, relation, object), and each
+    entity and relation keeps an array of the edge indices that use it, so lookups
+    never scan the whole graph.
+    """
+
+    def __init__(self):
+        self.entity_ids = {}  # canonical name -> id
+        self.entity_names = []  # id -> display name (first spelling seen)
+        self.relation_ids = {}
+        self.relation_names = []
+        self.subjects = array("i")
+        self.relations = array("i")
+        self.objects = array("i")
+        self.edge_ids = {}  # (subject, relation, object) -> edge index, for deduplication
+        self.by_subject = {}  # entity id -> array of edge indices
+        self.by_object = {}
+        self.by_relation = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.subjects)
+
+    def _intern(self, name, ids, names):
+        key = canonical_entity(name)
+        if key not in ids:
+            ids[key] = len(names)
+            names.append(name.strip())
+        return ids[key]
+
+    def _triple(self, edge):
+        return [
+            self.entity_names[self.subjects[edge]],
+            self.relation_names[self.relations[edge]],
+            self.entity_names[self.objects[edge]],
+        ]
+
+    def merge(self, triples: List[List[str]]) -> List[List[str]]:
+        """
+        Add triples to the graph, skipping ones already present.
+        Returns only the triples that were new.
+        """
+        added = []
+        with self.lock:
+            for entity1, relation, entity2 in triples:
+                s = self._intern(entity1, self.entity_ids, self.entity_names)
+                r = self._intern(relation, self.relation_ids, self.relation_names)
+                o = self._intern(entity2, self.entity_ids, self.entity_names)
+                if (s, r, o) in self.edge_ids:
+                    continue
+                edge = len(self.subjects)
+                self.edge_ids[(s, r, o)] = edge
+                self.subjects.append(s)
+                self.relations.append(r)
+                self.objects.append(o)
+                self.by_subject.setdefault(s, array("i")).append(edge)
+                self.by_object.setdefault(o, array("i")).append(edge)
+                self.by_relation.setdefault(r, array("i")).append(edge)
+                added.append(self._triple(edge))
+        return added
+
+    def page(self, offset: int = 0, limit: int = 100) -> List[List[str]]:
+        """
+        Return triples in insertion order, one page at a time.
+        """
+        end = min(offset + limit, len(self.subjects))
+        return [self._triple(edge) for edge in range(offset, end)]
+
+    def neighbors(self, entity: str) -> List[List[str]]:
+        """
+        Return every triple in which the entity is the subject or the object.
+        """
+        entity_id = self.entity_ids.get(canonical_entity(entity))
+        if entity_id is None:
+            return []
+        edges = sorted(set(self.by_subject.get(entity_id, ())) | set(self.by_object.get(entity_id, ())))
+        return [self._triple(edge) for edge in edges]
+
+    def with_relation(self, relation: str) -> List[List[str]]:
+        """
+        Return every triple that uses the relation.
+        """
+        relation_id = self.relation_ids.get(canonical_entity(relation))
+        if relation_id is None:
+            return []
+        return [self._triple(edge) for edge in self.by_relation[relation_id]]
+
+    def subgraph(self, entity: str, hops: int = 1, limit: int = 500) -> List[List[str]]:
+        """
+        Return the triples reachable within `hops` edges of the entity, in either direction,
+        capped at `limit` triples.
+        """
+        entity_id = self.entity_ids.get(canonical_entity(entity))
+        if entity_id is None:
+            return []
+
+        visited = {entity_id}
+        frontier = [entity_id]
+        edges = set()
+        for _ in range(hops):
+            next_frontier = []
+            for node in frontier:
+                for edge in list(self.by_subject.get(node, ())) + list(self.by_object.get(node, ())):
+                    if edge in edges:
+                        continue
+                    edges.add(edge)
+                    if len(edges) >= limit:
+                        return [self._triple(e) for e in sorted(edges)]
+                    for other in (self.subjects[edge], self.objects[edge]):
+                        if other not in visited:
+                            visited.add(other)
+                            next_frontier.append(other)
+            frontier = next_frontier
+        return [self._triple(e) for e in sorted(edges)]
+
+    def to_dict(self) -> dict:
+        return {
+            "entities": self.entity_names,
+            "relations": self.relation_names,
+            "edges": [list(self.subjects), list(self.relations), list(self.objects)],
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "KnowledgeGraphStore":
+        store = cls()
+        subjects, relations, objects = data["edges"]
+        store.merge([
+            [data["entities"][s], data["relations"][r], data["entities"][o]]
+            for s, r, o in zip(subjects, relations, objects)
+        ])
+        return store
+
+
+class SessionGraphs:
+    """
+    One KnowledgeGraphStore per session, kept in an LRU and optionally persisted to disk.
+    With a store directory, every worker process holds its own copies: a copy is reloaded when
+    the session's file changed since it was read, and merges into one session are serialized
+    across processes by a lock on its <id>.lock file, so no worker writes over another's triples.
+    """
+
+    def __init__(self, max_sessions=KG_MAX_SESSIONS, store_dir=KG_STORE_DIR):
+        self.max_sessions = max_sessions
+        self.store_dir = store_dir
+        self.sessions = OrderedDict()
+        self.versions = {}  # session ID -> (inode, mtime) of the file its copy was read from or written to
+        self.lock = threading.Lock()
+        if store_dir:
+            os.makedirs(store_dir, exist_ok=True)
+
+    def _path(self, session_id, suffix=".json"):
+        return os.path.join(self.store_dir, f"{session_id}{suffix}")
+
+    def _version(self, session_id):
+        try:
+            stat = os.stat(self._path(session_id))
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns
+
+    def _lookup(self, session_id, create):
+        if not _session_id.match(session_id):
+            raise ValueError("Session IDs may only contain letters, digits, '-' and '_' (at most 128).")
+        with self.lock:
+            version = self._version(session_id) if self.store_dir else None
+            if session_id in self.sessions and version == self.versions.get(session_id):
+                self.sessions.move_to_end(session_id)
+                return self.sessions[session_id]
+
+            # Not loaded yet, or another worker changed or deleted the session since
+            self.sessions.pop(session_id, None)
+            self.versions.pop(session_id, None)
+            store = None
+            if version is not None:
+                with open(self._path(session_id)) as f:
+                    store = KnowledgeGraphStore.from_dict(json.load(f))
+            if store is None and not create:
+                return None
+            self.sessions[session_id] = store or KnowledgeGraphStore()
+            self.versions[session_id] = version
+            if len(self.sessions) > self.max_sessions:
+                evicted, _ = self.sessions.popitem(last=False)
+                self.versions.pop(evicted, None)
+            return self.sessions[session_id]
+
+    def get(self, session_id: str) -> KnowledgeGraphStore:
+        """
+        Return the graph of a session, loading it from disk or creating it if needed.
+        Raises ValueError for an invalid session ID.
+        """
+        return self._lookup(session_id, create=True)
+
+    def find(self, session_id: str):
+        """
+        Return the graph of an existing session, or None; unknown IDs do not create sessions,
+        so reads cannot push real sessions out of the LRU.
+        """
+        return self._lookup(session_id, create=False)
+
+    def merge(self, session_id: str, triples: List[List[str]]):
+        """
+        Merge triples into the graph of a session, creating it if needed, and persist it when a
+        store directory is configured. Returns the graph and the triples that were new.
+        Blocks while another thread or process merges into the same session.
+        """
+        if not self.store_dir:
+            graph = self.get(session_id)
+            return graph, graph.merge(triples)
+        with self._file_lock(session_id):
+            # Read under the lock, so the copy holds every merge written before this one
+            graph = self.get(session_id)
+            added = graph.merge(triples)
+            if added:
+                self._write(session_id, graph)
+        return graph, added
+
+    def _file_lock(self, session_id):
+        f = open(self._path(session_id, ".lock"), "a")
+        fcntl.flock(f, fcntl.LOCK_EX)  # released when the file is closed
+        return f
+
+    def _write(self, session_id, graph):
+        with graph.lock:
+            data = graph.to_dict()
+        # A temp file per write, so writers in other worker processes never share one
+        fd, tmp_path = tempfile.mkstemp(dir=self.store_dir, prefix=f"{session_id}.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self._path(session_id))
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        with self.lock:
+            if self.sessions.get(session_id) is graph:
+                self.versions[session_id] = self._version(session_id)
+
+    def delete(self, session_id: str):
+        if not _session_id.match(session_id):
+            raise ValueError("Session IDs may only contain letters, digits, '-' and '_' (at most 128).")
+        if not self.store_dir:
+            with self.lock:
+                self.sessions.pop(session_id, None)
+            return
+        with self._file_lock(session_id):
+            with self.lock:
+                self.sessions.pop(session_id, None)
+                self.versions.pop(session_id, None)
+            if os.path.exists(self._path(session_id)):
+                os.remove(self._path(session_id))
+
+
+session_graphs = SessionGraphs()
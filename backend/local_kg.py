@@ -0,0 +1,163 @@
+import re
+from typing import List
+
+# Local, CPU-only triple extraction used before falling back to the LLM.
+# Sentences are matched against a dependency parse when a spaCy English model is
+# installed, and against rule patterns otherwise.
+
+# Relation phrases recognised by the rule patterns, longest first so "is part of" wins over "is"
+RELATION_PHRASES = sorted([
+    "is located in", "are located in", "was located in", "is based in", "is part of", "are part of",
+    "is made of", "are made of", "is composed of", "are composed of", "is known as", "are known as",
+    "is called", "are called", "is used for", "are used for", "is used in", "are used in",
+    "was founded by", "was created by", "was invented by", "was written by", "was discovered by",
+    "was developed by", "was built by", "was designed by", "were invented by", "were discovered by",
+    "is the capital of", "is a type of", "is a kind of", "is a form of", "are types of", "is a member of",
+    "belongs to", "belong to", "consists of", "consist of", "depends on", "depend on", "leads to", "lead to",
+    "results in", "result in", "refers to", "refer to", "relies on", "rely on", "converts", "convert",
+    "contains", "contain", "includes", "include", "causes", "cause", "produces", "produce",
+    "requires", "require", "uses", "use", "provides", "provide", "supports", "support",
+    "improves", "improve", "reduces", "reduce", "increases", "increase", "prevents", "prevent",
+    "affects", "affect", "helps", "help", "creates", "create", "enables", "enable", "protects", "protect",
+    "stores", "store", "connects", "connect", "allows", "allow", "has", "have", "had",
+    "is", "are", "was", "were",
+], key=len, reverse=True)
+
+_relation_pattern = re.compile(
+    r'^(?P<subject>.+?)\s+(?P<relation>' + "|".join(re.escape(p) for p in RELATION_PHRASES) + r')\s+(?P<object>.+)$',
+    re.IGNORECASE,
+)
+_list_marker = re.compile(r'^\s*(?:\d+[.)]|[-*•])\s*')
+_clause_break = re.compile(r'\s*(?:[,;:(]|\s(?:which|that|who|because|while|although|when|where)\s)', re.IGNORECASE)
+_leading_article = re.compile(r'^(?:the|a|an)\s+', re.IGNORECASE)
+_sentence_split = re.compile(r'(?<=[.!?])\s+|\n+')
+_weak_relations = {"is", "are", "was", "were", "has", "have", "had"}
+_pronouns = {"it", "they", "this", "that", "these", "those", "he", "she", "we", "you", "i", "there", "which"}
+
+MAX_ENTITY_WORDS = 8
+
+_nlp = None
+
+
+def load_spacy_model():
+    """
+    Load the spaCy English pipeline once, returning None when spaCy or the model is not installed.
+    """
+    global _nlp
+    if _nlp is None:
+        try:
+            import spacy
+            _nlp = spacy.load("en_core_web_sm", disable=["ner", "lemmatizer"])
+        except (ImportError, OSError):
+            _nlp = False
+    return _nlp or None
+
+
+def clean_entity(text: str) -> str:
+    """
+    Trim an entity to its head phrase and drop characters that parse_triples cannot carry.
+    """
+    text = _clause_break.split(text, maxsplit=1)[0]
+    text = text.strip().strip('"\'`*.!?')
+    text = _leading_article.sub('', text)
+    return re.sub(r'[(),]', '', text).strip()
+
+
+def split_sentences(text: str) -> List[str]:
+    """
+    Split text into sentences, dropping list markers left by the response formatter.
+    """
+    sentences = []
+    for sentence in _sentence_split.split(text):
+        sentence = _list_marker.sub('', sentence).strip()
+        # A bare "1." line is just a point number
+        if len(sentence.split()) >= 3:
+            sentences.append(sentence)
+    return sentences
+
+
+def extract_with_rules(sentence: str):
+    """
+    Match a sentence against the relation patterns.
+    Returns a list of (entity1, relation, entity2, confidence) tuples.
+    """
+    match = _relation_pattern.match(sentence.rstrip('.!?'))
+    if not match:
+        return []
+
+    subject = clean_entity(match.group("subject"))
+    relation = match.group("relation").lower()
+    obj = clean_entity(match.group("object"))
+    if not subject or not obj or subject.lower() in _pronouns or obj.lower() in _pronouns:
+        return []
+
+    # Bare copulas and long entities are less reliable than a specific relation phrase
+    confidence = 0.7 if relation in _weak_relations else 0.9
+    if len(subject.split()) > MAX_ENTITY_WORDS or len(obj.split()) > MAX_ENTITY_WORDS:
+        confidence -= 0.3
+    return [(subject, relation, obj, confidence)]
+
+
+def extract_with_parser(doc):
+    """
+    Read subject-verb-object triples off a spaCy dependency parse.
+    Returns a list of (entity1, relation, entity2, confidence) tuples.
+    """
+    def phrase(token):
+        return clean_entity(" ".join(t.text for t in token.subtree))
+
+    results = []
+    for token in doc:
+        if token.pos_ not in ("VERB", "AUX") or token.dep_ not in ("ROOT", "conj"):
+            continue
+        subjects = [c for c in token.children if c.dep_ in ("nsubj", "nsubjpass")]
+        if not subjects:
+            continue
+        subject = phrase(subjects[0])
+        verb = " ".join(t.text for t in token.children if t.dep_ in ("aux", "auxpass", "neg")) + " " + token.text
+        for child in token.children:
+            if child.dep_ in ("dobj", "attr", "acomp"):
+                results.append((subject, verb.strip().lower(), phrase(child), 0.9))
+            elif child.dep_ in ("prep", "agent"):
+                for pobj in (c for c in child.children if c.dep_ == "pobj"):
+                    results.append((subject, f"{verb.strip()} {child.text}".lower(), phrase(pobj), 0.85))
+    return [r for r in results if r[0] and r[2] and r[0].lower() not in _pronouns and r[2].lower() not in _pronouns]
+
+
+def extract_local_triples(text: str) -> dict:
+    """
+    Extract triples from text without calling the LLM.
+    Returns the triples in the same [entity1, relation, entity2] shape as parse_triples,
+    the share of sentences that produced at least one triple (coverage) and the mean
+    confidence of the triples found.
+    """
+    sentences = split_sentences(text)
+    if not sentences:
+        return {"triples": [], "coverage": 0.0, "confidence": 0.0}
+
+    nlp = load_spacy_model()
+    docs = nlp.pipe(sentences) if nlp else [None] * len(sentences)
+
+    triples = []
+    confidences = []
+    seen = set()
+    covered = 0
+    for sentence, doc in zip(sentences, docs):
+        found = extract_with_parser(doc) if doc is not None else []
+        if not found:
+            found = extract_with_rules(sentence)
+        if found:
+            covered += 1
+        for entity1, relation, entity2, confidence in found:
+            key = (entity1.lower(), relation, entity2.lower())
+            if key in seen:
+                continue
+            seen.add(key)
+            triples.append([entity1, relation, entity2])
+            confidences.append(confidence)
+
+    return {
+        "triples": triples,
+        "coverage": covered / len(sentences),
+        "confidence": sum(confidences) / len(confidences) if confidences else 0.0,
+    }
@@ -1,17 +1,41 @@
 from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
-from typing import List
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, TypeAdapter
+from typing import List, Optional
 from fastapi.middleware.cors import CORSMiddleware
-from response_service.llm_service import generate_valid_response
-from image_service.image_service import generate_valid_image, LogicalGroup
-from stt_service.STT_service import speech_to_text
-from tts_service.TTS_service import text_to_speech
+from fastapi.concurrency import run_in_threadpool
+from response_service.llm_service import generate_valid_response, generate_speculative_response, SPECULATIVE_CANDIDATES
+from constraint_plan import LogicalGroup
+from gateway import GATEWAY_MODE, gateway, add_gateway_routes, forwarded_headers
+from batch_jobs import add_batch_routes
+if GATEWAY_MODE == "remote":
+    # The models run in the split services; only the text chunking is needed here
+    from tts_service.speech_chunks import split_into_chunks
+else:
+    from image_service.image_service import generate_valid_image
+    from stt_service.STT_service import speech_to_text
+    from tts_service.TTS_service import text_to_speech, split_into_chunks, synthesize_pcm, wav_stream_header
 from llm_service2 import generate_valid_response as generate_valid_response2
-from convertToKG import extract_knowledge_graph
-from fastapi import FastAPI, File, UploadFile
+from convertToKG import extract_knowledge_graph, stream_knowledge_graph
+from kg_store import session_graphs
+from voice_results import voice_results
+from instrumentation import instrument_app
+from structured_logging import configure_logging, add_request_id
+from fastapi import FastAPI, File, UploadFile, Form, Query, Request
+from urllib.parse import quote
+import asyncio
 import base64
+import json
+import logging
+import os
+import uuid
 
 
+configure_logging()
+logger = logging.getLogger(__name__)
+
+VOICE_HEADER_MAX_CHARS = int(os.getenv("VOICE_HEADER_MAX_CHARS", "4000"))  # URL-encoded text per header; proxies reject headers of 8-16 KB
+
 app = FastAPI()
 
 # Enable CORS
@@ -21,11 +45,26 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Transcription", "X-Response", "X-Iteration-Count", "X-Stop-Reason", "Server-Timing", "X-Request-ID", "X-Batch-Job-ID",
+                    "X-Voice-Result-ID", "X-Response-Truncated"],
 )
 
+instrument_app(app, "backend")
+add_request_id(app)
+if GATEWAY_MODE == "remote":
+    # Registered before the local endpoints below, so the same paths go to the split services
+    add_gateway_routes(app)
+
 class RequestPayload(BaseModel):
     question: str
     logicalGroups: List[LogicalGroup]
+    # Optional per-request limits for the correction loop
+    maxIterations: Optional[int] = None
+    deadlineSeconds: Optional[float] = None
+    tokenBudget: Optional[int] = None
+    maxProviderCalls: Optional[int] = None
+    # Race this many candidates concurrently before falling back to the correction loop
+    speculativeCandidates: Optional[int] = None
 
 class GenerateImageRequest(BaseModel):
     logicalGroups: List[LogicalGroup]
@@ -38,14 +77,46 @@ class ResponseInput(BaseModel):
     response: str
 
 
+async def answer_question(payload: RequestPayload) -> dict:
+    """
+    The constrained generation behind /generate_response/, shared with the batch endpoint.
+    In gateway mode the response service answers.
+    """
+    if GATEWAY_MODE == "remote":
+        return await gateway.post_json("response", "/generate_response/", json=payload.model_dump(mode="json", exclude_none=True))
+    limits = dict(
+        max_iterations=payload.maxIterations,
+        deadline_s=payload.deadlineSeconds,
+        token_budget=payload.tokenBudget,
+        max_calls=payload.maxProviderCalls,
+    )
+    candidates = payload.speculativeCandidates or SPECULATIVE_CANDIDATES
+    if candidates > 1:
+        valid_response = await generate_speculative_response(
+            payload.question, payload.logicalGroups, candidates=candidates, **limits
+        )
+    else:
+        # Off the event loop: a call may wait for its provider's rate limit
+        valid_response = await run_in_threadpool(generate_valid_response, payload.question, payload.logicalGroups, **limits)
+    return {
+        "response": valid_response["response"],
+        "iterationCount": valid_response["iterationCount"],
+        "repairCount": valid_response["repairCount"],
+        "stopReason": valid_response["stopReason"],
+    }
+
 @app.post("/generate_response/")
 async def generate_response(payload: RequestPayload):
     try:
-        valid_response = generate_valid_response(payload.question, payload.logicalGroups)
-        return {"response": valid_response["response"], "iterationCount": valid_response["iterationCount"]}
+        return await answer_question(payload)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+# Many /generate_response/ payloads in one request, answered concurrently and streamed back as NDJSON
+add_batch_routes(app, RequestPayload, answer_question)
+
 @app.post("/generate_image/")
 async def generate_image_endpoint(request: GenerateImageRequest):
     try:
@@ -58,9 +129,11 @@ async def generate_image_endpoint(request: GenerateImageRequest):
 async def transcribe_audio(file: UploadFile = File(...)):
     try:
         contents = await file.read()
-        return {"transcription": speech_to_text(contents)}
+        # Run off the event loop so concurrent uploads can be batched together
+        transcription = await run_in_threadpool(speech_to_text, contents)
+        return {"transcription": transcription}
     except Exception as e:
-        print(f"Transcription error: {e}")
+        logger.exception("Transcription error")
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/api/text-to-speech/")
@@ -76,7 +149,8 @@ def text_to_speech_api(request: TextToSpeechRequest):
 @app.post("/generate_valid_response/")
 async def generate_valid_response_endpoint(request: RequestPayload):
     try:
-        result = generate_valid_response2(
+        result = await run_in_threadpool(
+            generate_valid_response2,
             question=request.question,
             logicalGroups=request.logicalGroups
         )
@@ -86,6 +160,8 @@ async def generate_valid_response_endpoint(request: RequestPayload):
             "analysis_B_of_A": result["analysis_B_of_A"],
             "analysis_A_of_B": result["analysis_A_of_B"]
         }
+    except HTTPException:
+        raise
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
@@ -98,9 +174,196 @@ async def generate_knowledge_graph(input: ResponseInput):
     Returns a list of triples [entity1, relation, entity2].
     """
     try:
-        triples = extract_knowledge_graph(input.response)
+        triples = await run_in_threadpool(extract_knowledge_graph, input.response)
         return {"triples": triples}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error generating knowledge graph: {str(e)}")
-    
 
+
+@app.post("/api/generate-knowledge-graph/stream")
+async def stream_knowledge_graph_endpoint(input: ResponseInput):
+    """
+    Stream the knowledge graph as NDJSON, one {"triple": [entity1, relation, entity2]} per line,
+    as soon as each triple is parsed from the LLM output.
+    """
+    def ndjson():
+        try:
+            for triple in stream_knowledge_graph(input.response):
+                yield json.dumps({"triple": triple}) + "\n"
+        except Exception as e:
+            yield json.dumps({"error": f"Error generating knowledge graph: {str(e)}"}) + "\n"
+
+    return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+
+
+@app.post("/api/knowledge-graph/{session_id}/merge")
+async def merge_knowledge_graph(session_id: str, input: ResponseInput):
+    """
+    Extract triples from a new response and merge them into the session graph.
+    Returns only the triples that were not already in the graph.
+    """
+    try:
+        # An invalid session ID is rejected before any provider call
+        session_graphs.get(session_id)
+        triples = await run_in_threadpool(extract_knowledge_graph, input.response)
+        graph, added = await run_in_threadpool(session_graphs.merge, session_id, triples)
+        return {"added": added, "tripleCount": len(graph), "entityCount": len(graph.entity_names)}
+    except HTTPException:
+        raise
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error merging knowledge graph: {str(e)}")
+
+def existing_graph(session_id: str):
+    """
+    The graph of a session for the read endpoints: 400 for an invalid ID, 404 for an unknown one.
+    """
+    try:
+        graph = session_graphs.find(session_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if graph is None:
+        raise HTTPException(status_code=404, detail=f"No knowledge graph for session {session_id}")
+    return graph
+
+@app.get("/api/knowledge-graph/{session_id}/triples")
+async def knowledge_graph_triples(session_id: str, offset: int = Query(0, ge=0), limit: int = Query(100, ge=1)):
+    """
+    Page through the triples of a session graph in insertion order.
+    """
+    graph = existing_graph(session_id)
+    return {"triples": graph.page(offset, limit), "offset": offset, "total": len(graph)}
+
+@app.get("/api/knowledge-graph/{session_id}/neighbors")
+async def knowledge_graph_neighbors(session_id: str, entity: str):
+    """
+    Return the triples touching an entity.
+    """
+    return {"triples": existing_graph(session_id).neighbors(entity)}
+
+@app.get("/api/knowledge-graph/{session_id}/relation")
+async def knowledge_graph_relation(session_id: str, relation: str):
+    """
+    Return the triples that use a relation.
+    """
+    return {"triples": existing_graph(session_id).with_relation(relation)}
+
+@app.get("/api/knowledge-graph/{session_id}/subgraph")
+async def knowledge_graph_subgraph(session_id: str, entity: str, hops: int = Query(1, ge=1), limit: int = Query(500, ge=1)):
+    """
+    Return the triples within `hops` edges of an entity.
+    """
+    return {"triples": existing_graph(session_id).subgraph(entity, hops, limit)}
+
+@app.delete("/api/knowledge-graph/{session_id}")
+async def delete_knowledge_graph(session_id: str):
+    try:
+        session_graphs.delete(session_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"deleted": session_id}
+
+
+async def stream_speech(chunks: List[str], maleSpeaker: bool):
+    """
+    Stream the synthesized chunks as one WAV, synthesizing the next chunk while the current one is sent.
+    """
+    yield wav_stream_header()
+    if not chunks:
+        return
+    next_audio = asyncio.ensure_future(run_in_threadpool(synthesize_pcm, chunks[0], maleSpeaker))
+    for i in range(len(chunks)):
+        audio = await next_audio
+        if i + 1 < len(chunks):
+            next_audio = asyncio.ensure_future(run_in_threadpool(synthesize_pcm, chunks[i + 1], maleSpeaker))
+        yield audio
+
+
+def header_text(text, limit=VOICE_HEADER_MAX_CHARS):
+    """
+    URL-encode text for a header, keeping whole characters up to `limit` encoded characters.
+    Returns (encoded text, whether it was truncated).
+    """
+    encoded = quote(text)
+    if len(encoded) <= limit:
+        return encoded, False
+    pieces, size = [], 0
+    for ch in text:
+        piece = quote(ch)
+        if size + len(piece) > limit:
+            break
+        pieces.append(piece)
+        size += len(piece)
+    return "".join(pieces), True
+
+
+@app.post("/api/voice-pipeline/")
+async def voice_pipeline(
+    request: Request,
+    file: UploadFile = File(...),
+    logicalGroups: str = Form("[]"),
+    maleSpeaker: bool = Form(False),
+):
+    """
+    Transcribe a recording, generate a constrained answer and stream it back as speech.
+    logicalGroups is the same list as in /generate_response/, sent as a JSON form field.
+    The transcription and answer text are returned URL-encoded in the X-Transcription and X-Response headers,
+    cut to VOICE_HEADER_MAX_CHARS (X-Response-Truncated: true); the full texts are available from
+    GET /api/voice-pipeline/{X-Voice-Result-ID}.
+    """
+    # In gateway mode every upstream call carries the client's headers, as the proxied endpoints do
+    upstream_headers = forwarded_headers(request)
+    try:
+        groups = TypeAdapter(List[LogicalGroup]).validate_json(logicalGroups)
+        contents = await file.read()
+        if GATEWAY_MODE == "remote":
+            transcription = await gateway.speech_to_text(contents, upstream_headers)
+        else:
+            transcription = await run_in_threadpool(speech_to_text, contents)
+        if not transcription.strip():
+            raise HTTPException(status_code=400, detail="No speech detected in the recording.")
+        if GATEWAY_MODE == "remote":
+            valid_response = await gateway.generate_valid_response(transcription, groups, upstream_headers)
+        else:
+            valid_response = await run_in_threadpool(generate_valid_response, transcription, groups)
+    except HTTPException:
+        raise
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+    chunks = split_into_chunks(valid_response["response"])
+    result_id = uuid.uuid4().hex
+    await run_in_threadpool(voice_results.put, result_id, {
+        "transcription": transcription,
+        "response": valid_response["response"],
+        "iterationCount": valid_response["iterationCount"],
+        "stopReason": valid_response["stopReason"],
+    })
+    transcription_header, transcription_truncated = header_text(transcription)
+    response_header, response_truncated = header_text(valid_response["response"])
+    headers = {
+        "X-Transcription": transcription_header,
+        "X-Response": response_header,
+        "X-Response-Truncated": str(transcription_truncated or response_truncated).lower(),
+        "X-Voice-Result-ID": result_id,
+        "X-Iteration-Count": str(valid_response["iterationCount"]),
+        "X-Stop-Reason": valid_response["stopReason"],
+    }
+    speech = gateway.stream_speech(chunks, maleSpeaker, upstream_headers) if GATEWAY_MODE == "remote" else stream_speech(chunks, maleSpeaker)
+    return StreamingResponse(speech, media_type="audio/wav", headers=headers)
+
+
+@app.get("/api/voice-pipeline/{result_id}")
+async def voice_pipeline_result(result_id: str):
+    """
+    The full transcription and answer of a recent voice pipeline call.
+    """
+    result = await run_in_threadpool(voice_results.get, result_id)
+    if result is None:
+        raise HTTPException(status_code=404, detail=f"No voice pipeline result {result_id}")
+    return result
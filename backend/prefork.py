@@ -0,0 +1,233 @@
+"""
+Pre-fork launcher: load the models once, then fork the uvicorn workers.
+
+With `uvicorn main:app --workers N` every worker imports main.py and so loads Whisper,
+Stable Diffusion, CLIP and VITS on its own, and memory grows with N. Here the master
+process imports the app (loading every model at import time as usual), moves the weights
+of every torch module into shared memory, freezes the garbage collector's view of the heap
+and only then forks the workers. The workers inherit the weights instead of loading them,
+so each extra worker costs its own Python heap and activations, not another copy of the models.
+
+Usage (from the backend directory):
+    python prefork.py --workers 4 --port 8000
+    python prefork.py --app stt_service.main:app --workers 2 --port 8003
+
+CPU only: CUDA cannot be used across fork, so the launcher refuses to start if the app
+initialized CUDA while loading.
+
+Metrics run in prometheus_client's multiprocess mode: every process writes its samples to
+PROMETHEUS_MULTIPROC_DIR (a fresh temporary directory unless set), and /metrics on any
+worker reports the sum over all of them.
+
+A request may land on any worker, so the app's state that a follow-up request reads must be
+shared: the voice pipeline results go to VOICE_RESULTS_DIR (a fresh temporary directory unless
+set), and KG_STORE_DIR and BATCH_STORE_DIR should be set for the knowledge graphs and batch jobs.
+"""
+import argparse
+import gc
+import importlib
+import logging
+import os
+import signal
+import shutil
+import socket
+import sys
+import tempfile
+import time
+
+logger = logging.getLogger(__name__)
+
+PREFORK_WORKERS = int(os.getenv("PREFORK_WORKERS", "2"))
+# torch threads per worker; 0 divides the cores between the workers so they do not oversubscribe them
+PREFORK_WORKER_THREADS = int(os.getenv("PREFORK_WORKER_THREADS", "0"))
+
+# Service modules whose globals hold the loaded models
+MODEL_MODULES = ("image_service.image_service", "stt_service.STT_service", "tts_service.TTS_service")
+
+
+def loaded_torch_modules():
+    """
+    The torch modules held by the service modules that are loaded: plain nn.Modules, the
+    components of a diffusers pipeline and the model of an STT engine.
+    """
+    import torch
+
+    found = {}
+    for module_name in MODEL_MODULES:
+        service = sys.modules.get(module_name)
+        if service is None:
+            continue
+        for name, value in vars(service).items():
+            candidates = [value]
+            components = getattr(value, "components", None)
+            if isinstance(components, dict):
+                candidates.extend(components.values())
+            candidates.append(getattr(value, "model", None))
+            for candidate in candidates:
+                if isinstance(candidate, torch.nn.Module):
+                    found[id(candidate)] = (f"{module_name}.{name}", candidate)
+    return list(found.values())
+
+
+def share_weights():
+    """
+    Move the parameters and buffers of every loaded model into shared memory, so pages the
+    workers touch are never copied on write.
+    """
+    import torch
+
+    if torch.cuda.is_available() and torch.cuda.is_initialized():
+        raise RuntimeError("The models were loaded on CUDA, which does not survive fork; run the pre-fork launcher on CPU.")
+
+    total = 0
+    for name, module in loaded_torch_modules():
+        try:
+            module.share_memory()
+        except RuntimeError as e:
+            # Some packed weights (int8 dynamic quantization) cannot be moved; they are still copy-on-write
+            logger.warning("Could not share weights", extra={"model": name, "error": str(e)})
+            continue
+        size = sum(t.numel() * t.element_size() for t in list(module.parameters()) + list(module.buffers()))
+        total += size
+        logger.info("Shared model weights", extra={"model": name, "bytes": size})
+    return total
+
+
+def process_memory(pid):
+    """
+    Memory of one process in bytes: rss, pss (shared pages split between the processes
+    mapping them), uss (pages only this process holds) and peak_rss. Linux only.
+    """
+    fields = {}
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) >= 2 and parts[1].isdigit():
+                fields[parts[0].rstrip(":")] = int(parts[1]) * 1024
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                fields["VmHWM"] = int(line.split()[1]) * 1024
+    return {
+        "rss": fields.get("Rss", 0),
+        "pss": fields.get("Pss", 0),
+        "uss": fields.get("Private_Clean", 0) + fields.get("Private_Dirty", 0),
+        "peak_rss": fields.get("VmHWM", 0),
+    }
+
+
+def prepare_metrics_dir():
+    """
+    Point prometheus_client at an empty multiprocess directory. Must run before the app
+    imports prometheus_client, which picks its storage when it is first imported.
+    """
+    path = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+    if path:
+        # Samples left by an earlier run would be added to this one's
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path)
+    else:
+        path = tempfile.mkdtemp(prefix="prefork-metrics-")
+        os.environ["PROMETHEUS_MULTIPROC_DIR"] = path
+    return path
+
+
+def bind_socket(host, port, backlog=2048):
+    sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+def run_worker(app, sock, threads):
+    import torch
+    import uvicorn
+
+    torch.set_num_threads(threads)
+    # Logging is already configured by the app; uvicorn's own config would replace it
+    config = uvicorn.Config(app, log_config=None, timeout_keep_alive=5)
+    uvicorn.Server(config).run(sockets=[sock])
+
+
+def fork_worker(app, sock, threads):
+    pid = os.fork()
+    if pid == 0:
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        try:
+            run_worker(app, sock, threads)
+        except Exception:
+            logger.exception("Worker failed")
+            sys.exit(1)
+        # Leave through the normal interpreter exit so the atexit handlers flush the logs
+        sys.exit(0)
+    return pid
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--app", default="main:app", help="module:attribute of the ASGI app")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=PREFORK_WORKERS)
+    args = parser.parse_args()
+
+    if not hasattr(os, "fork"):
+        raise SystemExit("The pre-fork launcher needs os.fork; use uvicorn --workers on this platform.")
+
+    metrics_dir = prepare_metrics_dir()
+    if not os.environ.get("VOICE_RESULTS_DIR"):
+        os.environ["VOICE_RESULTS_DIR"] = tempfile.mkdtemp(prefix="prefork-voice-")
+    module_name, attribute = args.app.split(":")
+    load_start = time.perf_counter()
+    app = getattr(importlib.import_module(module_name), attribute)
+    from prometheus_client import multiprocess  # only once prepare_metrics_dir has set up its directory
+    shared = share_weights()
+    logger.info("Models loaded in the master", extra={
+        "seconds": round(time.perf_counter() - load_start, 1), "shared_bytes": shared,
+    })
+
+    threads = PREFORK_WORKER_THREADS or max(1, (os.cpu_count() or 1) // args.workers)
+    sock = bind_socket(args.host, args.port)
+
+    # Objects that exist now are never collected or moved by the workers' GC, so their
+    # pages stay shared instead of being copied when the collector touches them
+    gc.collect()
+    gc.freeze()
+
+    workers = {fork_worker(app, sock, threads) for _ in range(args.workers)}
+    logger.info("Workers started", extra={"workers": len(workers), "port": args.port, "torch_threads": threads})
+
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        workers.discard(pid)
+        multiprocess.mark_process_dead(pid, metrics_dir)
+        if not stopping:
+            # Replace a crashed worker from the same loaded state
+            logger.warning("Worker exited, starting a replacement", extra={"pid": pid, "status": status})
+            time.sleep(1)  # do not spin if the worker fails right away
+            workers.add(fork_worker(app, sock, threads))
+    sock.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,237 @@
+import asyncio
+import hashlib
+import os
+import threading
+import time
+import logging
+from collections import OrderedDict
+
+from google.genai import errors, types
+
+from instrumentation import observe_first_token, observe_llm_call
+
+# Provider-side caching of the static system instructions sent with Gemini calls.
+# A system instruction is registered here the first time it is used. Once it has been seen
+# PROMPT_CACHE_MIN_USES times and is long enough for the provider to cache, a cached content
+# holding it is created with client.caches.create, and later calls reference the cache by name
+# instead of resending the text; Gemini bills the cached tokens at a reduced rate. Whenever no
+# cache can be used (too short, not reused yet, creation failed, cache gone), the instruction
+# is sent inline as before.
+# Gemini only caches contents of at least PROMPT_CACHE_MIN_TOKENS tokens. The current
+# instructions (KG extraction, analysis templates, the rules of a typical constraint plan) are
+# all well below that, so until they grow every call sends its instruction inline and this
+# module only counts uses; benchmarks/load_test.py exercises the caching path with
+# PROMPT_CACHE_MIN_TOKENS=0.
+
+logger = logging.getLogger(__name__)
+
+PROMPT_CACHE_ENABLED = os.getenv("PROMPT_CACHE_ENABLED", "true").lower() == "true"
+PROMPT_CACHE_TTL_S = int(os.getenv("PROMPT_CACHE_TTL_S", "3600"))
+PROMPT_CACHE_MIN_TOKENS = int(os.getenv("PROMPT_CACHE_MIN_TOKENS", "1024"))  # Gemini rejects shorter cached contents
+PROMPT_CACHE_MIN_USES = int(os.getenv("PROMPT_CACHE_MIN_USES", "2"))  # uses before a cache is worth its storage cost
+PROMPT_CACHE_RETRY_S = float(os.getenv("PROMPT_CACHE_RETRY_S", "300"))  # wait after a failed create before trying again
+PROMPT_CACHE_MAX_ENTRIES = int(os.getenv("PROMPT_CACHE_MAX_ENTRIES", "256"))
+
+# A cache is not used in the last minute of its TTL, so it cannot expire while a call is in flight
+_refresh_margin_s = 60
+
+
+def estimate_tokens(text) -> int:
+    """
+    Rough token count; about four characters per token.
+    """
+    return len(text) // 4 + 1
+
+
+class _Entry:
+    def __init__(self):
+        self.uses = 0
+        self.name = None  # name of the provider's cached content, once created
+        self.expires_at = 0.0
+        self.retry_at = 0.0
+        self.creating = False
+
+
+class PromptCache:
+    """
+    Registry of the system instructions seen, keyed by (model, hash of the text), with the
+    handle of the provider cache holding each one when there is one.
+    """
+
+    def __init__(self, enabled=PROMPT_CACHE_ENABLED, ttl_s=PROMPT_CACHE_TTL_S, min_tokens=PROMPT_CACHE_MIN_TOKENS,
+                 min_uses=PROMPT_CACHE_MIN_USES, retry_s=PROMPT_CACHE_RETRY_S, max_entries=PROMPT_CACHE_MAX_ENTRIES):
+        self.enabled = enabled
+        self.ttl_s = ttl_s
+        self.min_tokens = min_tokens
+        self.min_uses = min_uses
+        self.retry_s = retry_s
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._instructions = {}  # cache name -> instruction text, for sending it inline elsewhere
+        self._lock = threading.Lock()
+
+    def lookup(self, model, system_instruction):
+        """
+        Count a use of the instruction and return (cache name or None, whether a cache should be created now).
+        """
+        if not self.enabled or estimate_tokens(system_instruction) < self.min_tokens:
+            return None, False
+        key = (model, hashlib.sha256(system_instruction.encode("utf-8")).hexdigest())
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.pop(key, None) or _Entry()
+            self._entries[key] = entry
+            entry.uses += 1
+            if entry.name and now < entry.expires_at - _refresh_margin_s:
+                return entry.name, False
+            entry.name = None
+            if entry.creating or entry.uses < self.min_uses or now < entry.retry_at:
+                return None, False
+            entry.creating = True
+            return None, True
+
+    def create(self, client, model, system_instruction):
+        """
+        Create the provider cache for the instruction and return its name, or None if the provider refused.
+        """
+        key = (model, hashlib.sha256(system_instruction.encode("utf-8")).hexdigest())
+        try:
+            cache = client.caches.create(
+                model=model,
+                config=types.CreateCachedContentConfig(
+                    system_instruction=system_instruction,
+                    ttl=f"{self.ttl_s}s",
+                    display_name=f"prompt-{key[1][:16]}",
+                ),
+            )
+            name, expires_at = cache.name, time.monotonic() + self.ttl_s
+            logger.info("Created prompt cache", extra={"model": model, "cache": name, "tokens": estimate_tokens(system_instruction)})
+        except Exception as e:
+            name, expires_at = None, 0.0
+            logger.warning("Could not create prompt cache, sending the instruction inline", extra={"model": model, "error": str(e)})
+
+        evicted = []
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry.creating = False
+                entry.name, entry.expires_at = name, expires_at
+                if name is None:
+                    entry.retry_at = time.monotonic() + self.retry_s
+                else:
+                    self._instructions[name] = system_instruction
+                    while len(self._instructions) > 4 * self.max_entries:
+                        self._instructions.pop(next(iter(self._instructions)))
+            while len(self._entries) > self.max_entries:
+                _, old = self._entries.popitem(last=False)
+                if old.name:
+                    evicted.append(old.name)
+        for old_name in evicted:
+            # The TTL would remove it too, but until then its storage is billed
+            try:
+                client.caches.delete(name=old_name)
+            except Exception as e:
+                logger.debug("Could not delete evicted prompt cache %s: %s", old_name, e)
+        return name
+
+    def invalidate(self, name):
+        """
+        Forget a cache the provider no longer has, so the next use creates it again.
+        """
+        with self._lock:
+            for entry in self._entries.values():
+                if entry.name == name:
+                    entry.name = None
+
+    def instruction(self, name):
+        """
+        The text of the instruction held by a cache created here, for a call that cannot use the cache.
+        Kept after the cache is dropped, since a call may still be holding its name.
+        """
+        with self._lock:
+            return self._instructions.get(name)
+
+    def config(self, name, system_instruction, **kwargs):
+        if name:
+            return types.GenerateContentConfig(cached_content=name, **kwargs)
+        return types.GenerateContentConfig(system_instruction=system_instruction, **kwargs)
+
+
+prompt_cache = PromptCache()
+
+
+def _cache_missing(error):
+    # The provider answers 403/404 for a cached content that expired or was deleted
+    return isinstance(error, errors.ClientError) and (error.code in (403, 404) or "cache" in str(error).lower())
+
+
+def generate_content(client, model, contents, system_instruction, **config):
+    """
+    client.models.generate_content with the system instruction taken from the provider cache when
+    there is one, and sent inline otherwise. Extra keyword arguments go to GenerateContentConfig.
+    """
+    name, create = prompt_cache.lookup(model, system_instruction)
+    if create:
+        name = prompt_cache.create(client, model, system_instruction)
+    start = time.perf_counter()
+    try:
+        chat = client.models.generate_content(model=model, contents=contents, config=prompt_cache.config(name, system_instruction, **config))
+    except Exception as e:
+        if not name or not _cache_missing(e):
+            raise
+        prompt_cache.invalidate(name)
+        name = None
+        start = time.perf_counter()
+        chat = client.models.generate_content(model=model, contents=contents, config=prompt_cache.config(None, system_instruction, **config))
+    observe_llm_call("gemini", model, time.perf_counter() - start, "hit" if name else "none")
+    return chat
+
+
+async def agenerate_content(client, model, contents, system_instruction, **config):
+    """
+    generate_content on client.aio; a cache is created off the event loop.
+    """
+    name, create = prompt_cache.lookup(model, system_instruction)
+    if create:
+        name = await asyncio.to_thread(prompt_cache.create, client, model, system_instruction)
+    start = time.perf_counter()
+    try:
+        chat = await client.aio.models.generate_content(model=model, contents=contents, config=prompt_cache.config(name, system_instruction, **config))
+    except Exception as e:
+        if not name or not _cache_missing(e):
+            raise
+        prompt_cache.invalidate(name)
+        name = None
+        start = time.perf_counter()
+        chat = await client.aio.models.generate_content(model=model, contents=contents, config=prompt_cache.config(None, system_instruction, **config))
+    observe_llm_call("gemini", model, time.perf_counter() - start, "hit" if name else "none")
+    return chat
+
+
+def generate_content_stream(client, model, contents, system_instruction, **config):
+    """
+    client.models.generate_content_stream with the cached system instruction when there is one.
+    A missing cache is only retried inline while nothing has been yielded yet.
+    """
+    name, create = prompt_cache.lookup(model, system_instruction)
+    if create:
+        name = prompt_cache.create(client, model, system_instruction)
+    start = time.perf_counter()
+    first = True
+    try:
+        for chunk in client.models.generate_content_stream(model=model, contents=contents, config=prompt_cache.config(name, system_instruction, **config)):
+            if first:
+                observe_first_token("gemini", model, time.perf_counter() - start, "hit" if name else "none")
+                first = False
+            yield chunk
+        return
+    except Exception as e:
+        if not first or not name or not _cache_missing(e):
+            raise
+        prompt_cache.invalidate(name)
+    start = time.perf_counter()
+    for chunk in client.models.generate_content_stream(model=model, contents=contents, config=prompt_cache.config(None, system_instruction, **config)):
+        if first:
+            observe_first_token("gemini", model, time.perf_counter() - start)
+            first = False
+        yield chunk
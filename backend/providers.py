@@ -0,0 +1,578 @@
+import asyncio
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import logging
+from concurrent.futures import Future
+from types import SimpleNamespace
+
+import openai
+from fastapi import HTTPException
+from google import genai
+from google.genai import types
+from openai.types import CompletionUsage
+from openai.types.chat import ChatCompletion, ChatCompletionMessage
+from openai.types.chat.chat_completion import Choice
+from prometheus_client import Counter
+
+from prompt_cache import prompt_cache
+
+# Provider gateway for the LLM calls of llm_service, llm_service2 and convertToKG.
+# Every call takes a token from the bucket of its provider and model first. Identical calls
+# that are in flight at the same time are sent once and share the reply (single flight).
+# When a route is throttled - its bucket stays empty for longer than PROVIDER_MAX_WAIT_S, or
+# the provider answers 429/503 - the call fails over to the next route configured for it,
+# translating the request between the Gemini and OpenAI shapes. When every route is throttled
+# the call raises ProviderThrottled, which FastAPI turns into a 429 with Retry-After.
+#
+# The modules use gemini_client and openrouter_client in place of genai.Client and
+# openai.OpenAI; they offer the same methods the modules call.
+
+logger = logging.getLogger(__name__)
+
+# Requests allowed per window, as provider[:model]=requests/seconds; a model entry overrides its provider's
+PROVIDER_RATE_LIMITS = os.getenv("PROVIDER_RATE_LIMITS", "gemini=1000/60,openrouter=20/60,openrouter:deepseek/deepseek-r1:free=20/60")
+# Routes tried in order when a route is throttled, as provider:model=provider:model|provider:model;...
+PROVIDER_FALLBACKS = os.getenv(
+    "PROVIDER_FALLBACKS",
+    "gemini:gemini-2.0-flash=openrouter:google/gemini-2.0-flash-exp:free;"
+    "openrouter:deepseek/deepseek-r1:free=gemini:gemini-2.0-flash",
+)
+PROVIDER_MAX_WAIT_S = float(os.getenv("PROVIDER_MAX_WAIT_S", "2"))  # longest wait for a token before failing over
+PROVIDER_COOLDOWN_S = float(os.getenv("PROVIDER_COOLDOWN_S", "30"))  # a 429 without Retry-After keeps the route off this long
+PROVIDER_COALESCE = os.getenv("PROVIDER_COALESCE", "true").lower() == "true"
+# "true" answers every call with the local stub provider, for running without API keys
+PROVIDER_STUB = os.getenv("PROVIDER_STUB", "false").lower() == "true"
+PROVIDER_STUB_LATENCY_MS = float(os.getenv("PROVIDER_STUB_LATENCY_MS", "50"))
+PROVIDER_STUB_THROTTLE_RATE = float(os.getenv("PROVIDER_STUB_THROTTLE_RATE", "0"))  # share of stub calls answered with 429
+
+PROVIDER_ROUTED = Counter("provider_calls_routed_total", "Calls by the route that answered them", ["provider", "model", "fallback"])
+PROVIDER_THROTTLED = Counter("provider_throttled_total", "Routes skipped because they were rate limited", ["provider", "model", "reason"])
+PROVIDER_COALESCED = Counter("provider_coalesced_total", "Calls answered by an identical call already in flight", ["provider"])
+
+_retry_delay = re.compile(r"retryDelay['\"]?\s*:\s*['\"]?(\d+(?:\.\d+)?)s")
+
+
+class ProviderThrottled(HTTPException):
+    """
+    Every route for a call is rate limited. Raised through the endpoints as a 429.
+    """
+
+    def __init__(self, retry_after):
+        self.retry_after = max(1, int(retry_after + 0.999))
+        super().__init__(
+            status_code=429,
+            detail="The language model providers are rate limiting requests; try again later.",
+            headers={"Retry-After": str(self.retry_after)},
+        )
+
+
+class TokenBucket:
+    """
+    `rate` requests per `per_s` seconds, with bursts of up to `rate`.
+    """
+
+    def __init__(self, rate, per_s):
+        self.capacity = float(rate)
+        self.refill_per_s = rate / per_s
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, max_wait):
+        """
+        Take a token and return how long to wait before using it, or None without taking one
+        if that wait would be longer than max_wait.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.refill_per_s)
+            self.updated = now
+            wait = max(0.0, (1 - self.tokens) / self.refill_per_s)
+            if wait > max_wait:
+                return None
+            self.tokens -= 1
+            return wait
+
+    def time_to_token(self):
+        with self._lock:
+            return max(0.0, (1 - self.tokens) / self.refill_per_s)
+
+
+def parse_rate_limits(value):
+    limits = {}
+    for item in value.split(","):
+        if not item.strip():
+            continue
+        route, _, rate = item.strip().rpartition("=")
+        requests, _, seconds = rate.partition("/")
+        provider, _, model = route.partition(":")
+        limits[(provider, model or None)] = (float(requests), float(seconds or 60))
+    return limits
+
+
+def parse_routes(value):
+    routes = {}
+    for item in value.split(";"):
+        if not item.strip():
+            continue
+        route, _, fallbacks = item.strip().partition("=")
+        routes[tuple(route.split(":", 1))] = [tuple(f.split(":", 1)) for f in fallbacks.split("|") if f.strip()]
+    return routes
+
+
+def throttle_delay(error):
+    """
+    Seconds to keep a route off after the error if it is a rate limit or overload, else None.
+    """
+    status = getattr(error, "code", None) or getattr(error, "status_code", None)
+    if status not in (429, 503):
+        return None
+    response = getattr(error, "response", None)
+    header = getattr(response, "headers", {}).get("retry-after") if response is not None else None
+    if header:
+        try:
+            return float(header)
+        except ValueError:
+            pass
+    match = _retry_delay.search(str(getattr(error, "details", None) or error))
+    if match:
+        return float(match.group(1))
+    return PROVIDER_COOLDOWN_S if status == 429 else 5.0
+
+
+# The provider-neutral form of a call used when failing over between the Gemini and OpenAI shapes:
+# Prompt(system=str, turns=[(role, text)], temperature) and Reply(text, prompt_tokens, completion_tokens)
+
+def prompt_from_gemini(contents, config):
+    system = getattr(config, "system_instruction", None)
+    if system is None and getattr(config, "cached_content", None):
+        system = prompt_cache.instruction(config.cached_content)
+    if system is not None and not isinstance(system, str):
+        system = "".join(part.text or "" for part in system.parts or [])
+    contents = contents if isinstance(contents, list) else [contents]
+    turns = []
+    for content in contents:
+        if isinstance(content, str):
+            turns.append(("user", content))
+        else:
+            role = "user" if content.role == "user" else "assistant"
+            turns.append((role, "".join(part.text or "" for part in content.parts or [])))
+    return SimpleNamespace(system=system or "", turns=turns, temperature=getattr(config, "temperature", None))
+
+
+def prompt_from_messages(messages, temperature=None):
+    system = "\n\n".join(m["content"] for m in messages if m["role"] == "system")
+    turns = [("user" if m["role"] == "user" else "assistant", m["content"]) for m in messages if m["role"] != "system"]
+    return SimpleNamespace(system=system, turns=turns, temperature=temperature)
+
+
+def gemini_reply(text, prompt_tokens, completion_tokens):
+    return types.GenerateContentResponse(
+        candidates=[types.Candidate(content=types.Content(role="model", parts=[types.Part.from_text(text=text)]))],
+        usage_metadata=types.GenerateContentResponseUsageMetadata(
+            prompt_token_count=prompt_tokens, candidates_token_count=completion_tokens,
+            total_token_count=prompt_tokens + completion_tokens,
+        ),
+    )
+
+
+def chat_completion_reply(model, text, prompt_tokens, completion_tokens):
+    return ChatCompletion(
+        id=f"gateway-{time.time_ns()}", object="chat.completion", created=int(time.time()), model=model,
+        choices=[Choice(index=0, finish_reason="stop", message=ChatCompletionMessage(role="assistant", content=text))],
+        usage=CompletionUsage(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                              total_tokens=prompt_tokens + completion_tokens),
+    )
+
+
+class GeminiProvider:
+    name = "gemini"
+
+    def __init__(self, client):
+        self.client = client
+
+    def _request(self, prompt):
+        contents = [types.Content(role="user" if role == "user" else "model", parts=[types.Part.from_text(text=text)])
+                    for role, text in prompt.turns]
+        return contents, types.GenerateContentConfig(system_instruction=prompt.system or None, temperature=prompt.temperature)
+
+    def _reply(self, chat):
+        usage = chat.usage_metadata
+        return (chat.candidates[0].content.parts[0].text,
+                (usage.prompt_token_count or 0) if usage else 0, (usage.candidates_token_count or 0) if usage else 0)
+
+    def complete(self, model, prompt):
+        contents, config = self._request(prompt)
+        return self._reply(self.client.models.generate_content(model=model, contents=contents, config=config))
+
+    async def acomplete(self, model, prompt):
+        contents, config = self._request(prompt)
+        return self._reply(await self.client.aio.models.generate_content(model=model, contents=contents, config=config))
+
+
+class OpenRouterProvider:
+    name = "openrouter"
+
+    def __init__(self, client):
+        self.client = client
+
+    def _messages(self, prompt):
+        messages = [{"role": "system", "content": prompt.system}] if prompt.system else []
+        return messages + [{"role": role, "content": text} for role, text in prompt.turns]
+
+    def _reply(self, chat):
+        usage = chat.usage
+        return (chat.choices[0].message.content,
+                (usage.prompt_tokens or 0) if usage else 0, (usage.completion_tokens or 0) if usage else 0)
+
+    def complete(self, model, prompt):
+        kwargs = {} if prompt.temperature is None else {"temperature": prompt.temperature}
+        return self._reply(self.client.chat.completions.create(model=model, messages=self._messages(prompt), **kwargs))
+
+    async def acomplete(self, model, prompt):
+        return await asyncio.to_thread(self.complete, model, prompt)
+
+
+class StubThrottled(Exception):
+    status_code = 429
+
+
+class StubProvider:
+    """
+    Local stand-in that answers without a network call, after PROVIDER_STUB_LATENCY_MS; a share
+    of its calls (PROVIDER_STUB_THROTTLE_RATE) is answered with a 429 to exercise failover.
+    """
+    name = "stub"
+
+    def __init__(self, latency_ms=PROVIDER_STUB_LATENCY_MS, throttle_rate=PROVIDER_STUB_THROTTLE_RATE):
+        self.latency_s = latency_ms / 1000
+        self.throttle_rate = throttle_rate
+        self._calls = 0
+        self._lock = threading.Lock()
+
+    def _answer(self, model, prompt):
+        with self._lock:
+            self._calls += 1
+            throttled = self.throttle_rate and (self._calls * self.throttle_rate) % 1 < self.throttle_rate
+        if throttled:
+            raise StubThrottled(f"stub provider {model} throttled this call")
+        question = prompt.turns[-1][1] if prompt.turns else ""
+        text = f"1. Stub answer from {model}.\n2. It answers: {question[:200]}"
+        words = sum(len(text.split()) for _, text in prompt.turns) + len(prompt.system.split())
+        return text, words, len(text.split())
+
+    def complete(self, model, prompt):
+        time.sleep(self.latency_s)
+        return self._answer(model, prompt)
+
+    async def acomplete(self, model, prompt):
+        await asyncio.sleep(self.latency_s)
+        return self._answer(model, prompt)
+
+
+def _fingerprint(*parts):
+    def encode(value):
+        if hasattr(value, "model_dump_json"):
+            return value.model_dump_json(exclude_none=True)
+        if isinstance(value, (list, tuple)):
+            return "[" + ",".join(encode(v) for v in value) + "]"
+        return json.dumps(value, sort_keys=True, default=str)
+    return hashlib.sha256("\x1f".join(encode(p) for p in parts).encode("utf-8")).hexdigest()
+
+
+class ProviderGateway:
+    def __init__(self, providers, rate_limits=PROVIDER_RATE_LIMITS, fallbacks=PROVIDER_FALLBACKS,
+                 max_wait_s=PROVIDER_MAX_WAIT_S, coalesce=PROVIDER_COALESCE, stub=PROVIDER_STUB):
+        self.providers = {provider.name: provider for provider in providers}
+        self.max_wait_s = max_wait_s
+        self.coalesce = coalesce
+        self.stub = stub
+        self.fallbacks = parse_routes(fallbacks)
+        self._limits = parse_rate_limits(rate_limits)
+        self._buckets = {}
+        self._cooldowns = {}  # (provider, model) -> monotonic time the route may be used again
+        self._in_flight = {}
+        self._in_flight_async = {}
+        self._lock = threading.Lock()
+
+    def routes(self, provider, model):
+        if self.stub:
+            return [("stub", model)]
+        return [(provider, model)] + self.fallbacks.get((provider, model), [])
+
+    def _bucket(self, provider, model):
+        key = (provider, model)
+        with self._lock:
+            if key not in self._buckets:
+                limit = self._limits.get(key) or self._limits.get((provider, None))
+                # A bucket per provider is shared by its models unless a model has its own limit
+                shared = key if key in self._limits else (provider, None)
+                if limit is None:
+                    self._buckets[key] = None
+                else:
+                    if shared not in self._buckets:
+                        self._buckets[shared] = TokenBucket(*limit)
+                    self._buckets[key] = self._buckets[shared]
+            return self._buckets[key]
+
+    def admit(self, provider, model):
+        """
+        Seconds to wait before calling the route, or None with the time until it frees up if it is throttled.
+        """
+        cooldown = self._cooldowns.get((provider, model), 0.0) - time.monotonic()
+        if cooldown > 0:
+            PROVIDER_THROTTLED.labels(provider, model, "cooldown").inc()
+            return None, cooldown
+        bucket = self._bucket(provider, model)
+        if bucket is None:
+            return 0.0, 0.0
+        wait = bucket.reserve(self.max_wait_s)
+        if wait is None:
+            PROVIDER_THROTTLED.labels(provider, model, "rate_limit").inc()
+            return None, bucket.time_to_token()
+        return wait, 0.0
+
+    def cool_down(self, provider, model, seconds):
+        PROVIDER_THROTTLED.labels(provider, model, "provider").inc()
+        self._cooldowns[(provider, model)] = time.monotonic() + seconds
+        logger.warning("Provider throttled, failing over", extra={"provider": provider, "model": model, "cooldown_s": seconds})
+
+    def _routed(self, routes, i, error):
+        """
+        Decide what to do with the error of route i: the throttle delay to fail over with, or re-raise.
+        Errors of the primary route that are not throttling propagate as before; a fallback that
+        fails for any reason is skipped.
+        """
+        provider, model = routes[i]
+        delay = throttle_delay(error)
+        if delay is not None:
+            self.cool_down(provider, model, delay)
+            return delay
+        if i == 0:
+            raise error
+        logger.warning("Fallback route failed", extra={"provider": provider, "model": model, "error": str(error)})
+        return PROVIDER_COOLDOWN_S
+
+    def call(self, routes, native):
+        """
+        Try the routes in order. native(provider, model) makes the call in the caller's shape
+        for the first route's provider, or through the neutral form for another provider.
+        """
+        retry_after = None
+        for i, (provider, model) in enumerate(routes):
+            wait, free_in = self.admit(provider, model)
+            if wait is None:
+                retry_after = free_in if retry_after is None else min(retry_after, free_in)
+                continue
+            time.sleep(wait)
+            try:
+                result = native(self.providers[provider], model)
+            except Exception as e:
+                delay = self._routed(routes, i, e)
+                retry_after = delay if retry_after is None else min(retry_after, delay)
+                continue
+            PROVIDER_ROUTED.labels(provider, model, str(i > 0).lower()).inc()
+            return result
+        raise ProviderThrottled(retry_after or PROVIDER_COOLDOWN_S)
+
+    async def acall(self, routes, native):
+        retry_after = None
+        for i, (provider, model) in enumerate(routes):
+            wait, free_in = self.admit(provider, model)
+            if wait is None:
+                retry_after = free_in if retry_after is None else min(retry_after, free_in)
+                continue
+            await asyncio.sleep(wait)
+            try:
+                result = await native(self.providers[provider], model)
+            except Exception as e:
+                delay = self._routed(routes, i, e)
+                retry_after = delay if retry_after is None else min(retry_after, delay)
+                continue
+            PROVIDER_ROUTED.labels(provider, model, str(i > 0).lower()).inc()
+            return result
+        raise ProviderThrottled(retry_after or PROVIDER_COOLDOWN_S)
+
+    def single_flight(self, provider, key, call):
+        """
+        Run call(), or wait for the result of the identical call already in flight.
+        """
+        if not self.coalesce:
+            return call()
+        with self._lock:
+            future = self._in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = self._in_flight[key] = Future()
+        if not leader:
+            PROVIDER_COALESCED.labels(provider).inc()
+            return future.result()
+        try:
+            result = call()
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._in_flight.pop(key, None)
+
+    async def asingle_flight(self, provider, key, call):
+        if not self.coalesce:
+            return await call()
+        future = self._in_flight_async.get(key)
+        if future is not None:
+            PROVIDER_COALESCED.labels(provider).inc()
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise
+                # The leader was cancelled by its own caller; this caller still wants an answer
+                return await call()
+        future = self._in_flight_async[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await call()
+            future.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()  # retrieved here so a future nobody awaits does not log a warning
+            raise
+        finally:
+            self._in_flight_async.pop(key, None)
+
+
+class _GatedGeminiModels:
+    def __init__(self, gateway):
+        self.gateway = gateway
+
+    def _native(self, model, contents, config):
+        def native(provider, route_model):
+            if provider.name == "gemini":
+                # A cached content belongs to one model; other models get the instruction inline
+                route_config = config if route_model == model else _inline(config)
+                return provider.client.models.generate_content(model=route_model, contents=contents, config=route_config)
+            return gemini_reply(*provider.complete(route_model, prompt_from_gemini(contents, config)))
+        return native
+
+    def generate_content(self, model, contents, config=None):
+        gateway = self.gateway
+        key = _fingerprint("gemini", model, contents, config)
+        return gateway.single_flight("gemini", key, lambda: gateway.call(gateway.routes("gemini", model), self._native(model, contents, config)))
+
+    def generate_content_stream(self, model, contents, config=None):
+        """
+        Streams from the first Gemini route that admits the call. A route throttled before its
+        first chunk fails over; a fallback answers in a single chunk.
+        """
+        gateway = self.gateway
+        routes = gateway.routes("gemini", model)
+        retry_after = None
+        for i, (provider_name, route_model) in enumerate(routes):
+            wait, free_in = gateway.admit(provider_name, route_model)
+            if wait is None:
+                retry_after = free_in if retry_after is None else min(retry_after, free_in)
+                continue
+            time.sleep(wait)
+            provider = gateway.providers[provider_name]
+            started = False
+            try:
+                if provider.name == "gemini":
+                    route_config = config if route_model == model else _inline(config)
+                    for chunk in provider.client.models.generate_content_stream(model=route_model, contents=contents, config=route_config):
+                        started = True
+                        yield chunk
+                else:
+                    reply = gemini_reply(*provider.complete(route_model, prompt_from_gemini(contents, config)))
+                    started = True
+                    yield reply
+            except Exception as e:
+                if started:
+                    raise
+                delay = gateway._routed(routes, i, e)
+                retry_after = delay if retry_after is None else min(retry_after, delay)
+                continue
+            PROVIDER_ROUTED.labels(provider_name, route_model, str(i > 0).lower()).inc()
+            return
+        raise ProviderThrottled(retry_after or PROVIDER_COOLDOWN_S)
+
+
+class _GatedAsyncGeminiModels(_GatedGeminiModels):
+    async def generate_content(self, model, contents, config=None):
+        gateway = self.gateway
+
+        async def native(provider, route_model):
+            if provider.name == "gemini":
+                route_config = config if route_model == model else _inline(config)
+                return await provider.client.aio.models.generate_content(model=route_model, contents=contents, config=route_config)
+            return gemini_reply(*await provider.acomplete(route_model, prompt_from_gemini(contents, config)))
+
+        key = _fingerprint("gemini", model, contents, config)
+        return await gateway.asingle_flight("gemini", key, lambda: gateway.acall(gateway.routes("gemini", model), native))
+
+
+def _inline(config):
+    if config is None or not getattr(config, "cached_content", None):
+        return config
+    return config.model_copy(update={"cached_content": None, "system_instruction": prompt_cache.instruction(config.cached_content)})
+
+
+class GatedGeminiClient:
+    """
+    genai.Client look-alike whose models and aio.models calls go through the gateway.
+    Caches are created directly on the Gemini client.
+    """
+
+    def __init__(self, gateway):
+        self.gateway = gateway
+        self.models = _GatedGeminiModels(gateway)
+        self.aio = SimpleNamespace(models=_GatedAsyncGeminiModels(gateway))
+
+    @property
+    def caches(self):
+        return self.gateway.providers["gemini"].client.caches
+
+
+class _GatedCompletions:
+    def __init__(self, gateway):
+        self.gateway = gateway
+
+    def create(self, model, messages, **kwargs):
+        gateway = self.gateway
+
+        def native(provider, route_model):
+            if provider.name == "openrouter":
+                return provider.client.chat.completions.create(model=route_model, messages=messages, **kwargs)
+            text, prompt_tokens, completion_tokens = provider.complete(route_model, prompt_from_messages(messages, kwargs.get("temperature")))
+            return chat_completion_reply(route_model, text, prompt_tokens, completion_tokens)
+
+        key = _fingerprint("openrouter", model, messages, kwargs)
+        return gateway.single_flight("openrouter", key, lambda: gateway.call(gateway.routes("openrouter", model), native))
+
+
+class GatedOpenRouterClient:
+    """
+    openai.OpenAI look-alike for OpenRouter whose chat.completions.create goes through the gateway.
+    """
+
+    def __init__(self, gateway):
+        self.gateway = gateway
+        self.chat = SimpleNamespace(completions=_GatedCompletions(gateway))
+
+
+provider_gateway = ProviderGateway([
+    GeminiProvider(genai.Client(api_key=os.getenv("GOOGLE_API_KEY"))),
+    OpenRouterProvider(openai.OpenAI(base_url="https://openrouter.ai/api/v1", api_key=os.getenv("OPENROUTER_API_KEY"))),
+    StubProvider(),
+])
+gemini_client = GatedGeminiClient(provider_gateway)
+openrouter_client = GatedOpenRouterClient(provider_gateway)
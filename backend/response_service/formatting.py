@@ -0,0 +1,68 @@
+import re
+
+# Formatting for LLM responses, shared by response_service/llm_service.py and llm_service2.py.
+# The output is the same as the original chain of re.sub / str.replace passes, but the
+# layout rules are applied in one scan instead of one full copy of the response per rule.
+
+_first_point = re.compile(r'^(?:\s*\d+\.\s+|\s*[-*]\s+|\s*\(\d+\))', re.MULTILINE)
+_parenthesized_number = re.compile(r'\((\d+)\)')
+_bold = re.compile(r'\*\*(.*?)\*\*')
+_italic = re.compile(r'\*(.*?)\*')
+
+# All the layout rules as one pattern, so the response is rewritten in a single re.sub.
+# Every match starts with one of the characters the rules care about, which lets the regex
+# engine skip plain text quickly:
+#   ". " (or "." + any whitespace), ": " and newlines are line breaks; a break swallows the
+#   whitespace and stray asterisks after it, as the old newline-collapsing pass did, and
+#   takes a numbered point or bullet that starts right after it
+#   digits followed by ". " start a numbered point on a new line
+#   "* " starts a bullet point on a new line, any other "*" is dropped
+_layout = re.compile(
+    r'([.:\n*\d])(?:'
+    r'(?:(?<=\.)\s|(?<=:) |(?<=\n))(?:\s|\*(?! ))*(\* |\d+(?=\.\s))?'
+    r'|(?<=\*) ?'
+    r'|(?<=\d)\d*(?=\.\s))'
+)
+
+
+def _layout_rule(match):
+    head, following = match.group(1, 2)
+    if head == "*":
+        return "\n- " if match.end() - match.start() == 2 else ""
+    if head.isdecimal():
+        return "\n" + match.group()
+    if following == "* ":
+        following = "- "
+    return ("" if head == "\n" else head) + "\n" + (following or "")
+
+
+def apply_layout(response):
+    """
+    Put numbered points, sentences, colons and bullets on their own lines, drop stray
+    asterisks and collapse each line break together with the whitespace after it.
+    """
+    return _layout.sub(_layout_rule, response).strip()
+
+
+def format_response(response, has_structure_constraint):
+    """
+    Clean up the response based on whether the structure constraint is present.
+    If has_structure_constraint is True, start the text from the first point.
+    Otherwise, return the response as-is.
+    """
+    if has_structure_constraint:
+        # Find the first point that starts with "1.", or a bullet point, ignoring numbers in headers
+        match = _first_point.search(response)
+        if match:
+            response = response[match.start():]
+
+    # Convert (1), (2), etc., to 1., 2., etc.
+    if "(" in response:
+        response = _parenthesized_number.sub(r'\1.', response)
+
+    # Remove unnecessary symbols like ** and *
+    if "*" in response:
+        response = _bold.sub(r'\1', response)
+        response = _italic.sub(r'\1', response)
+
+    return apply_layout(response)
@@ -0,0 +1,73 @@
+import os
+from google.genai import types
+
+# Input token budget for the contents sent with each correction turn
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "8000"))
+HISTORY_MAX_ATTEMPTS = int(os.getenv("HISTORY_MAX_ATTEMPTS", "1"))  # earlier attempts kept in full besides the latest
+
+
+def estimate_tokens(text) -> int:
+    """
+    Rough token count for budgeting before a call; about four characters per token.
+    """
+    return len(text) // 4 + 1
+
+
+def text_content(role, text):
+    return types.Content(role=role, parts=[types.Part.from_text(text=text)])
+
+
+class ConversationHistory:
+    """
+    The turns the correction loop sends to Gemini.
+    The question and the latest response are always kept. Up to `max_attempts` earlier attempts
+    are kept, newest first, while they fit in the token budget; the rest are replaced by a one-line summary of
+    the constraints they failed, so input stays flat instead of growing with every iteration.
+    Analysis turns are never stored: they are one-off calls whose result ends up in the next
+    correction prompt anyway.
+    """
+
+    def __init__(self, question, token_budget=HISTORY_TOKEN_BUDGET, max_attempts=HISTORY_MAX_ATTEMPTS):
+        self.question = question
+        self.token_budget = token_budget
+        self.max_attempts = max_attempts
+        self.attempts = []  # (response, correction prompt, failed constraints), oldest first
+
+    def add_attempt(self, response, correction_prompt, readable_constraints):
+        """
+        Record the response being corrected, the correction prompt sent for it and the
+        constraints it failed, which is all the summary keeps once the attempt is dropped.
+        """
+        self.attempts.append((response, correction_prompt, readable_constraints))
+
+    def contents(self):
+        """
+        Build the contents for the next correction call, ending with the latest correction prompt.
+        """
+        *earlier, latest = self.attempts
+        tail = [text_content("assistant", latest[0]), text_content("user", latest[1])]
+        used = estimate_tokens(self.question) + estimate_tokens(latest[0]) + estimate_tokens(latest[1])
+
+        # Walk back from the newest earlier attempt while it still fits
+        kept = []
+        for response, correction_prompt, _ in reversed(earlier):
+            cost = estimate_tokens(response) + estimate_tokens(correction_prompt)
+            if len(kept) >= self.max_attempts or used + cost > self.token_budget:
+                break
+            used += cost
+            kept.insert(0, (response, correction_prompt))
+        dropped = earlier[:len(earlier) - len(kept)]
+
+        question = self.question
+        if dropped:
+            failed = sorted({line.strip() for _, _, constraints in dropped for line in constraints.split("\n") if line.strip()})
+            question += (
+                f"\n\n(Note: {len(dropped)} earlier attempt(s) are omitted. They failed these constraints:\n"
+                + "\n".join(failed) + ")"
+            )
+
+        contents = [text_content("user", question)]
+        for response, correction_prompt in kept:
+            contents.append(text_content("assistant", response))
+            contents.append(text_content("user", correction_prompt))
+        return contents + tail
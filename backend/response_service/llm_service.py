@@ -1,62 +1,43 @@
-import openai
+import asyncio
 from typing import List
-from pydantic import BaseModel
-from response_service.constraints import validate_response
+from constraint_plan import LogicalGroup, compile_plan
+from response_service.repair import repair_response, record
+from response_service.retry import RetryController
+from response_service.history import ConversationHistory, text_content
+from response_service.formatting import format_response
+from response_service.semantic_cache import semantic_cache
+from instrumentation import trace_span, observe_stage, record_llm_call, CORRECTION_ITERATIONS
+from prompt_cache import generate_content, agenerate_content
+from providers import ProviderThrottled, gemini_client, openrouter_client
 import re
-from google import genai
+import time
+import logging
 from google.genai import types
 import os 
 from dotenv import load_dotenv
 
 load_dotenv() # Load environment variables from .env file
 
+logger = logging.getLogger(__name__)
 
 
 
-class Constraint(BaseModel):
-    type: str
-    value: str
+# Rate limited, coalesced and failed over by the provider gateway
+client = openrouter_client
 
-class LogicalGroup(BaseModel):
-    operator: str  # AND, OR, NOT
-    constraints: List[Constraint]
+client2 = gemini_client
 
 
-client = openai.OpenAI(
-    base_url="https://openrouter.ai/api/v1",
-    api_key=os.getenv("OPENROUTER_API_KEY"),
-)
-
-client2 = genai.Client(api_key=os.getenv("GOOGLE_API_KEY"))
-
-
-# Store conversation history
-conversation_history = []
-
+# Speculative mode races several candidates at different temperatures and keeps the first valid one
+SPECULATIVE_CANDIDATES = int(os.getenv("SPECULATIVE_CANDIDATES", "1"))  # 1 keeps the sequential loop
+SPECULATIVE_TEMPERATURES = [float(t) for t in os.getenv("SPECULATIVE_TEMPERATURES", "0.2,0.7,1.0,0.4,0.9").split(",")]
 
-def format_constraints(logicalGroups):
-    """
-    Format the constraints into a readable string, grouped by logical operators.
-    """
-    if not logicalGroups:
-        return "No constraints provided. Answer the question naturally."
-    for group in logicalGroups:
-        formatted_constraints = []
-        for constraint in group.constraints:
-            if constraint.type == "structure":
-                if group.operator =="AND":
-                    formatted_constraints.append(f"- The response must have exactly {constraint.value} points.")
-            elif constraint.type == "word_inclusion":
-                if group.operator == "NOT":
-                    formatted_constraints.append(f"- The response must not include the word '{constraint.value}'.") 
-                else:
-                    formatted_constraints.append(f"- The response must include the word '{constraint.value}'.")
-            elif constraint.type == "word_exclusion":
-                if group.operator == "NOT":
-                    formatted_constraints.append(f"- The response must include the word '{constraint.value}'.")
-                else:
-                    formatted_constraints.append(f"- The response must not include the word '{constraint.value}'.")
-    return "\n\n".join(formatted_constraints)
+# Fixed part of the failed-constraint analysis prompt, sent as the system instruction so the
+# provider can cache it; the response and the constraints follow in the user turn
+ANALYSIS_INSTRUCTION = (
+    "Here is a response and a list of constraints that are not satisfied. "
+    "Please analyze why the response does not satisfy these constraints."
+)
 
 
 # def format_response(response, has_structure_constraint):
@@ -99,48 +80,6 @@ def format_constraints(logicalGroups):
 
 #     return response.strip()
 
-def format_response(response, has_structure_constraint):
-    """
-    Clean up the response based on whether the structure constraint is present.
-    If has_structure_constraint is True, start the text from the first point.
-    Otherwise, return the response as-is.
-    """
-    if has_structure_constraint:
-        # Find the first point that starts with "1.", or a bullet point, ignoring numbers in headers
-        match = re.search(r'^(?:\s*\d+\.\s+|\s*[-*]\s+|\s*\(\d+\))', response, re.MULTILINE)
-        if match:
-            response = response[match.start():]
-        else:
-            # If no points are found, return the response as-is to avoid losing content
-            pass
-
-    # Convert (1), (2), etc., to 1., 2., etc.
-    response = re.sub(r'\((\d+)\)', r'\1.', response)
-
-    # Remove unnecessary symbols like ** and *
-    response = re.sub(r'\*\*(.*?)\*\*', r'\1', response)
-    response = re.sub(r'\*(.*?)\*', r'\1', response)
-
-    # Add new lines before numbered points
-    response = re.sub(r'(\d+\.\s)', r'\n\1', response)
-
-    # Add new lines after sentences
-    response = response.replace('. ', '.\n\n')
-
-    # Add new lines after colons
-    response = response.replace(': ', ':\n\n')
-
-    # Ensure paragraphs have space between them
-    response = re.sub(r"(\.\s)", r".\n\n", response)
-
-    # Replace * with proper new lines and bullet points
-    response = response.replace("* ", "\n- ").replace("*", "")
-
-    # Remove excessive new lines
-    response = re.sub(r'(\n\s*)+', r'\n', response)
-
-    return response.strip()
-
 # def validate_response(response, logicalGroups):
 #     """
 #     Validate the response against the logical groups of constraints.
@@ -202,27 +141,7 @@ def format_response(response, has_structure_constraint):
 #     return all_constraints_satisfied, unsatisfied_constraints
 
 
-def generate_response(question, logicalGroups):
-    global conversation_history  # Ensure we keep track of history
-
-     # Check if there is a structure constraint in an AND group
-    has_structure_constraint = any(
-        any(c.type == "structure" for c in group.constraints)
-        for group in logicalGroups if group.operator == "AND"
-    )
-
-    # Ensure only one structure constraint exists across all groups
-    structure_constraints = [
-        c for group in logicalGroups for c in group.constraints
-        if c.type == "structure"
-    ]
-    if len(structure_constraints) > 1:
-        raise ValueError("Only one structure constraint is allowed.")
-
-    # Append user question to history
-    # conversation_history.append({"role": "user", "content": question})
-    conversation_history.append(types.Content(role="user", parts=[types.Part.from_text(text=question)]))
-
+def generate_response(question, plan, controller=None):
     # chat = client.chat.completions.create(
     #     # model="gpt-3.5-turbo",
     #     # model="nousresearch/deephermes-3-llama-3-8b-preview:free",
@@ -235,16 +154,13 @@ def generate_response(question, logicalGroups):
     #     messages=conversation_history
     # )
 
-    chat = client2.models.generate_content(
-        model="gemini-2.0-flash", 
-        contents=conversation_history,
-        config= types.GenerateContentConfig(system_instruction=f"Always follow these rules:\n{format_constraints(logicalGroups)}\n\n"
-                f"For example, if one of the constraints is a structure constraint that specifies a certain number of points (e.g., exactly 50), format your response accordingly. Each point should be clearly numbered, like this:\n"
-                f"1. First point.\n2. Second point.\n... up to N. Last point (as specified by the constraint).\n")
-    )
+    with trace_span("llm", "gemini"):
+        chat = generate_content(client2, "gemini-2.0-flash", [text_content("user", question)], plan.system_instruction)
+    record_llm_call("gemini", "gemini-2.0-flash", chat)
 
-    print("Raw API Response:", chat)  # Debugging line
-    print("-------------------------------------------------------------------") # Debugging line
+    logger.debug("Raw API response: %s", chat)
+    if controller:
+        controller.record_call(chat)
 
     # if not chat or not chat.choices:
     #     return "Error: No response from LLM"
@@ -253,24 +169,23 @@ def generate_response(question, logicalGroups):
     
     # response = chat.choices[0].message.content
     response = chat.candidates[0].content.parts[0].text
-    
-    # Append AI response to history
-    # conversation_history.append({"role": "assistant", "content": response})
-    conversation_history.append(types.Content(role="assistant", parts=[types.Part.from_text(text=response)]))
 
     # Check if the structure constraint is present
     # has_structure_constraint = any(constraint.type == "structure" for constraint in constraints)
 
-    return format_response(response, has_structure_constraint)
+    return format_response(response, plan.has_structure_constraint)
 
 ##############################################################################################################################
-def generate_valid_response(question: str, logicalGroups: List[LogicalGroup]) -> dict:
-    # global conversation_history  # Keep track of history
-
+def generate_valid_response(question: str, logicalGroups: List[LogicalGroup], max_iterations=None, deadline_s=None, token_budget=None, max_calls=None) -> dict:
+    """
+    Generate a response and correct it until it satisfies the constraints or the retry budget runs out.
+    When the budget runs out, the candidate that satisfied the most constraints is returned and
+    stopReason says which limit was hit. With the semantic cache on, a close paraphrase of an
+    earlier question with the same constraints is answered from the cache (stopReason "semantic_cache").
+    If the providers start rate limiting during the corrections, the best candidate is returned
+    with stopReason "throttled"; if they refuse the first call, ProviderThrottled is raised.
+    """
     ####################################################
-    global conversation_history # Keep track of history
-    conversation_history = []  # Reset history for each new request
-    
     # Add system message with constraints
     # system_msg = {
     #     "role": "system", 
@@ -282,47 +197,80 @@ def generate_valid_response(question: str, logicalGroups: List[LogicalGroup]) ->
     # conversation_history.append(system_msg)
     ####################################################
 
-     # Check if there is a structure constraint in an AND group
-    has_structure_constraint = any(
-        any(c.type == "structure" for c in group.constraints)
-        for group in logicalGroups if group.operator == "AND"
-    )
+    # Everything derived from the constraints is computed once here, or reused from an earlier request
+    plan = compile_plan(logicalGroups)
 
-    # Ensure only one structure constraint exists across all groups
-    structure_constraints = [
-        c for group in logicalGroups for c in group.constraints
-        if c.type == "structure"
-    ]
-    if len(structure_constraints) > 1:
-        raise ValueError("Only one structure constraint is allowed.")
+    # A paraphrase of a question already answered under the same constraints needs no provider call
+    embedding = semantic_cache.embed(question)
+    cached = semantic_cache.lookup(plan, embedding)
+    if cached is not None:
+        return cached
+
+    # Bounds the loop by iterations, wall-clock time, tokens and provider calls
+    controller = RetryController(plan, max_iterations, deadline_s, token_budget, max_calls)
 
     # Get the first response
-    response = generate_response(question, logicalGroups)
+    response = generate_response(question, plan, controller)
+    record(requests=1)
+
+    result = correct_response(question, response, plan, controller)
+    semantic_cache.store(plan, question, embedding, result)
+    return result
 
+
+def correct_response(question, response, plan, controller, repairCount=0) -> dict:
+    """
+    The correction loop: validate, repair or ask the LLM for a correction, until the response
+    is valid or the controller's budget is spent.
+    """
     iterationCount = 0
+    history = ConversationHistory(question)
+    inputTokens = []  # prompt tokens sent per correction iteration
 
     while True: 
 
         # Validate the response and get unsatisfied constraints
-        is_valid, unsatisfied_constraints = validate_response(response, logicalGroups)
+        with trace_span("validation"):
+            is_valid, unsatisfied_constraints = plan.validate(response)
+        controller.consider(response, unsatisfied_constraints)
         if is_valid:
+            controller.stop_reason = "valid"
             break  # Exit the loop if all constraints are satisfied
-        
+
+        # Try a deterministic fix of the point count before spending a provider call
+        repaired = repair_response(response, plan, unsatisfied_constraints)
+        if repaired is not None:
+            response = repaired
+            repairCount += 1
+            continue
+
+        # Give up with the best candidate so far once the retry budget is spent
+        stop_reason = controller.exhausted(iterationCount)
+        if stop_reason:
+            controller.stop_reason = stop_reason
+            logger.info("Stopping correction loop", extra={"stop_reason": stop_reason, "iterations": iterationCount})
+            break
+
         iterationCount += 1 
-        print("Constraints not satisfied, requesting correction...")
-        print("Unsatisfied Constraints:", unsatisfied_constraints)  # Debugging line
-        print("-------------------------------------------------------------------") # Debugging line
-        print(logicalGroups) # Debugging line
+        record(iterations=1)
+        iteration_start = time.perf_counter()
+        logger.info("Constraints not satisfied, requesting correction", extra={"iteration": iterationCount, "unsatisfied": len(unsatisfied_constraints)})
+        logger.debug("Unsatisfied constraints: %s", unsatisfied_constraints)
 
 
         # Generate a readable constraints list for unsatisfied constraints only
         readable_constraints = format_unsatisfied_constraints(unsatisfied_constraints)
 
+        input_tokens_before = controller.input_tokens
+
         # Analyze why the constraints are not satisfied
-        analysis = analyze_failed_constraints(response, readable_constraints)
-        print("-------------------------------------------------------------------") # Debugging line
-        print("Analysis of Failed Constraints : ", analysis)  # Debugging line
-        print("-------------------------------------------------------------------") # Debugging line
+        try:
+            analysis = analyze_failed_constraints(response, readable_constraints, controller)
+        except ProviderThrottled:
+            # Every provider route is rate limited; answer with the best response so far
+            controller.stop_reason = "throttled"
+            break
+        logger.debug("Analysis of failed constraints: %s", analysis)
 
 
         # # Generate a correction prompt with the analysis
@@ -335,8 +283,9 @@ def generate_valid_response(question: str, logicalGroups: List[LogicalGroup]) ->
         # )
 
         # Enhanced correction prompt with an example
+        # The response itself is the previous turn in the history, so it is not repeated here
         correction_prompt = (
-            f"Your last response: '{response}' did not fully satisfy the constraints.\n\n"
+            f"Your last response did not fully satisfy the constraints.\n\n"
             f"Here is an analysis of why the constraints are not satisfied:\n\n"
             f"{analysis}\n\n"
             f"Please revise the response to meet the following constraints:\n\n"
@@ -347,7 +296,7 @@ def generate_valid_response(question: str, logicalGroups: List[LogicalGroup]) ->
 
         # conversation_history.append({"role": "user", "content": correction_prompt})
 
-        conversation_history.append(types.Content(role="user", parts=[types.Part.from_text(text=correction_prompt)]))
+        history.add_attempt(response, correction_prompt, readable_constraints)
 
         # chat = client.chat.completions.create(
         #     # model="gpt-3.5-turbo",
@@ -361,29 +310,146 @@ def generate_valid_response(question: str, logicalGroups: List[LogicalGroup]) ->
         #     messages=conversation_history
         # )
 
-        chat = client2.models.generate_content(
-            model="gemini-2.0-flash", 
-            contents=conversation_history
-    )
+        try:
+            with trace_span("llm", "gemini"):
+                chat = client2.models.generate_content(
+                    model="gemini-2.0-flash", 
+                    contents=history.contents()
+            )
+        except ProviderThrottled:
+            controller.stop_reason = "throttled"
+            break
+        record_llm_call("gemini", "gemini-2.0-flash", chat)
+        controller.record_call(chat)
+        observe_stage("correction_iteration", time.perf_counter() - iteration_start)
+        inputTokens.append(controller.input_tokens - input_tokens_before)
 
         # if not chat or not chat.choices:
         #     print(logicalGroups) # Debugging line
         #     return "Error: No corrected response from LLM"
         if not chat or not chat.candidates:
-            print(logicalGroups) # Debugging line
-            return "Error: No corrected response from LLM"
+            logger.warning("No corrected response from LLM", extra={"iteration": iterationCount})
+            controller.stop_reason = "no_response"
+            break
 
         # response = chat.choices[0].message.content
         response = chat.candidates[0].content.parts[0].text
-        # conversation_history.append({"role": "assistant", "content": response})
 
-        conversation_history.append(types.Content(role="assistant", parts=[types.Part.from_text(text=response)]))
-
-    # Clean the final valid response
-    print("Final Response : ",response) # Debugging line
+    # Clean the final response: the valid one, or the closest to valid if the budget ran out
+    response = controller.best_response
+    CORRECTION_ITERATIONS.observe(iterationCount)
+    logger.info("Final response", extra={"chars": len(response), "iterations": iterationCount, "stop_reason": controller.stop_reason})
+    logger.debug("Final response: %s", response)
     # cleaned_response = clean_response_with_llm(response)
     # return format_response(cleaned_response, has_structure_constraint)
-    return {"response": format_response(response, has_structure_constraint), "iterationCount": iterationCount}
+    return {
+        "response": format_response(response, plan.has_structure_constraint),
+        "iterationCount": iterationCount,
+        "repairCount": repairCount,
+        "stopReason": controller.stop_reason,
+        "tokensUsed": controller.tokens_used,
+        "inputTokens": inputTokens,
+    }
+
+
+async def generate_candidate(question, plan, temperature, seed):
+    """
+    One independent first attempt at the given temperature, with its own contents so
+    concurrent candidates do not share conversation history. Each candidate has its own seed,
+    so candidates sharing a temperature still sample differently and are never coalesced
+    into one provider call.
+    """
+    with trace_span("llm", "gemini"):
+        chat = await agenerate_content(
+            client2, "gemini-2.0-flash", [text_content("user", question)], plan.system_instruction,
+            temperature=temperature, seed=seed,
+        )
+    record_llm_call("gemini", "gemini-2.0-flash", chat)
+    return chat
+
+
+async def generate_speculative_response(question: str, logicalGroups: List[LogicalGroup], candidates=None, max_iterations=None, deadline_s=None, token_budget=None, max_calls=None) -> dict:
+    """
+    Send several candidates concurrently at different temperatures and validate each as it
+    arrives. The first valid one is returned and the requests still in flight are cancelled.
+    If none is valid, the sequential correction loop continues from the closest candidate.
+    Every candidate counts against the controller's token and call budgets.
+    """
+    candidates = SPECULATIVE_CANDIDATES if candidates is None else candidates
+
+    plan = compile_plan(logicalGroups)
+    embedding = await asyncio.to_thread(semantic_cache.embed, question)
+    cached = semantic_cache.lookup(plan, embedding)
+    if cached is not None:
+        return {**cached, "candidateCount": 0}
+
+    controller = RetryController(plan, max_iterations, deadline_s, token_budget, max_calls)
+    record(requests=1)
+
+    # Never start more candidates than the call budget allows
+    candidates = max(1, min(candidates, controller.max_calls))
+    tasks = [
+        asyncio.ensure_future(generate_candidate(question, plan, SPECULATIVE_TEMPERATURES[i % len(SPECULATIVE_TEMPERATURES)], i))
+        for i in range(candidates)
+    ]
+
+    repairCount = 0
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            try:
+                chat = await next_done
+            except Exception as e:
+                logger.warning("Speculative candidate failed: %s", e)
+                continue
+            controller.record_call(chat)
+            if not chat or not chat.candidates:
+                continue
+
+            response = format_response(chat.candidates[0].content.parts[0].text, plan.has_structure_constraint)
+            with trace_span("validation"):
+                is_valid, unsatisfied_constraints = plan.validate(response)
+            if not is_valid:
+                repaired = repair_response(response, plan, unsatisfied_constraints)
+                if repaired is not None:
+                    response = repaired
+                    repairCount += 1
+                    is_valid, unsatisfied_constraints = plan.validate(response)
+            controller.consider(response, unsatisfied_constraints)
+            if is_valid:
+                controller.stop_reason = "valid"
+                break
+    finally:
+        # The first valid candidate wins; the others are no longer needed
+        for task in tasks:
+            task.cancel()
+        # Wait for them to finish cancelling, so none outlives the request or logs an unretrieved error
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    if controller.stop_reason == "valid":
+        result = {
+            "response": format_response(controller.best_response, plan.has_structure_constraint),
+            "iterationCount": 0,
+            "repairCount": repairCount,
+            "stopReason": "valid",
+            "tokensUsed": controller.tokens_used,
+            "candidateCount": candidates,
+        }
+        semantic_cache.store(plan, question, embedding, result)
+        return result
+
+    # The sequential path makes blocking provider calls and may wait for a rate limit, so it
+    # runs on a worker thread rather than on the event loop
+    if controller.best_response is None:
+        # Every candidate failed, so start over sequentially within what is left of the budget
+        response = await asyncio.to_thread(generate_response, question, plan, controller)
+    else:
+        logger.info("No valid candidate, falling back to the correction loop", extra={"candidates": candidates})
+        response = controller.best_response
+
+    result = await asyncio.to_thread(correct_response, question, response, plan, controller, repairCount)
+    result["candidateCount"] = candidates
+    semantic_cache.store(plan, question, embedding, result)
+    return result
 
 
 
@@ -439,7 +505,7 @@ def generate_valid_response(question: str, logicalGroups: List[LogicalGroup]) ->
 #     return analysis
 
 
-def analyze_failed_constraints(response, readable_constraints):
+def analyze_failed_constraints(response, readable_constraints, controller=None):
     """
     Analyze the response to determine why the unsatisfied constraints are not satisfied.
     Includes the 'structure' constraint in the analysis.
@@ -479,16 +545,13 @@ def analyze_failed_constraints(response, readable_constraints):
 
     # Prompt to analyze the non-structure constraints
     analysis_prompt = (
-        f"Here is a response and a list of constraints that are not satisfied. "
-        f"Please analyze why the response does not satisfy these constraints.\n\n"
         f"Response:\n{response}\n\n"
         f"Constraints:\n{other_constraints_str}\n\n"
         f"Explanation:"
     )
 
-    # Append the analysis prompt to the conversation history
-    # conversation_history.append({"role": "user", "content": analysis_prompt})
-    conversation_history.append(types.Content(role="user", parts=[types.Part.from_text(text=analysis_prompt)]))
+    # The prompt carries the response and the constraints, so it is sent on its own
+    # rather than on top of the conversation history
 
     # Get the analysis from the LLM
     # chat = client.chat.completions.create(
@@ -496,10 +559,11 @@ def analyze_failed_constraints(response, readable_constraints):
     #     messages=conversation_history
     # )
 
-    chat = client2.models.generate_content(
-        model="gemini-2.0-flash", 
-        contents=conversation_history
-    )
+    with trace_span("llm", "gemini"):
+        chat = generate_content(client2, "gemini-2.0-flash", [text_content("user", analysis_prompt)], ANALYSIS_INSTRUCTION)
+    record_llm_call("gemini", "gemini-2.0-flash", chat)
+    if controller:
+        controller.record_call(chat)
 
     # if not chat or not chat.choices:
     #     return "Unable to analyze the failed constraints."
@@ -510,10 +574,6 @@ def analyze_failed_constraints(response, readable_constraints):
     # analysis = chat.choices[0].message.content
     analysis = chat.candidates[0].content.parts[0].text
 
-    # Append the analysis to the conversation history
-    # conversation_history.append({"role": "assistant", "content": analysis})
-    conversation_history.append(types.Content(role="assistant", parts=[types.Part.from_text(text=analysis)]))
-
     # Combine structure analysis with other analysis
     if structure_analysis:
         joined_structure = '\n'.join(structure_analysis)
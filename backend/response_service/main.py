@@ -1,8 +1,14 @@
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
-from typing import List
+from typing import List, Optional
 from fastapi.middleware.cors import CORSMiddleware
-from llm_service import generate_valid_response
+from fastapi.concurrency import run_in_threadpool
+from instrumentation import instrument_app
+from structured_logging import configure_logging, add_request_id
+from constraint_plan import LogicalGroup
+from llm_service import generate_valid_response, generate_speculative_response, SPECULATIVE_CANDIDATES
+
+configure_logging()
 
 app = FastAPI()
 
@@ -12,25 +18,49 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Server-Timing", "X-Request-ID"],
 )
 
-class Constraint(BaseModel):
-    type: str
-    value: str
-
-class LogicalGroup(BaseModel):
-    operator: str  # AND, OR, NOT
-    constraints: List[Constraint]
+instrument_app(app, "response_service")
+add_request_id(app)
 
 class RequestPayload(BaseModel):
     question: str
     logicalGroups: List[LogicalGroup]
+    # Optional per-request limits for the correction loop, as in backend/main.py
+    maxIterations: Optional[int] = None
+    deadlineSeconds: Optional[float] = None
+    tokenBudget: Optional[int] = None
+    maxProviderCalls: Optional[int] = None
+    # Race this many candidates concurrently before falling back to the correction loop
+    speculativeCandidates: Optional[int] = None
 
 @app.post("/generate_response/")
 async def generate_response(payload: RequestPayload):
     try:
-        valid_response = generate_valid_response(payload.question, payload.logicalGroups)
-        return {"response": valid_response} 
+        limits = dict(
+            max_iterations=payload.maxIterations,
+            deadline_s=payload.deadlineSeconds,
+            token_budget=payload.tokenBudget,
+            max_calls=payload.maxProviderCalls,
+        )
+        candidates = payload.speculativeCandidates or SPECULATIVE_CANDIDATES
+        if candidates > 1:
+            valid_response = await generate_speculative_response(
+                payload.question, payload.logicalGroups, candidates=candidates, **limits
+            )
+        else:
+            valid_response = await run_in_threadpool(generate_valid_response, payload.question, payload.logicalGroups, **limits)
+        # Same shape as /generate_response/ in backend/main.py, which forwards here in gateway mode
+        return {
+            "response": valid_response["response"],
+            "iterationCount": valid_response["iterationCount"],
+            "repairCount": valid_response["repairCount"],
+            "stopReason": valid_response["stopReason"],
+        }
+    except HTTPException:
+        # Rate limiting by the providers is passed on as a 429 with Retry-After
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
     
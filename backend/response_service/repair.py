@@ -0,0 +1,132 @@
+import re
+import threading
+
+# Deterministic fixes for structure failures, tried before asking the LLM for a correction.
+
+_numbered_line = re.compile(r'^\s*\d+\.(?:\s+|$)')
+_bullet_line = re.compile(r'^\s*[-*](?:\s+|$)')
+_sentence_end = re.compile(r'(?<=[.!?])\s+')
+
+# Counters for how often the correction loop runs and how often local repair saves a provider call
+_stats_lock = threading.Lock()
+repair_stats = {
+    "requests": 0,
+    "iterations": 0,  # LLM correction turns
+    "repairs_attempted": 0,
+    "repairs_succeeded": 0,
+}
+
+
+def record(**increments):
+    """
+    Add to the correction-loop counters.
+    """
+    with _stats_lock:
+        for key, value in increments.items():
+            repair_stats[key] += value
+
+
+def get_repair_stats() -> dict:
+    """
+    Return a snapshot of the counters with the derived repair success rate.
+    """
+    with _stats_lock:
+        stats = dict(repair_stats)
+    stats["repair_success_rate"] = stats["repairs_succeeded"] / stats["repairs_attempted"] if stats["repairs_attempted"] else 0.0
+    return stats
+
+
+def split_points(response):
+    """
+    Split a response into its preamble and points, using the same marker priority as
+    ConstraintPlan.validate: numbered points if there are any, otherwise bullet points.
+    Returns (preamble_lines, points) where each point is its text without the marker,
+    or None if the response has no points.
+    """
+    lines = response.split("\n")
+    marker = _numbered_line if any(_numbered_line.match(line) for line in lines) else _bullet_line
+
+    preamble = []
+    points = []
+    for line in lines:
+        match = marker.match(line)
+        if match:
+            points.append(line[match.end():].strip())
+        elif points:
+            # Continuation lines belong to the point above them
+            points[-1] = f"{points[-1]} {line.strip()}".strip()
+        else:
+            preamble.append(line)
+
+    if not points:
+        return None
+    return preamble, points
+
+
+def merge_points(points, target):
+    """
+    Merge the shortest neighbouring pair of points until there are `target` points.
+    """
+    points = list(points)
+    while len(points) > target:
+        i = min(range(len(points) - 1), key=lambda k: len(points[k]) + len(points[k + 1]))
+        points[i:i + 2] = [f"{points[i]} {points[i + 1]}".strip()]
+    return points
+
+
+def split_points_to(points, target):
+    """
+    Split the longest multi-sentence point at its middle sentence boundary until there are
+    `target` points. Returns None when no point can be split any further.
+    """
+    points = list(points)
+    while len(points) < target:
+        candidates = [(len(p), i) for i, p in enumerate(points) if len(_sentence_end.split(p)) > 1]
+        if not candidates:
+            return None
+        _, i = max(candidates)
+        sentences = _sentence_end.split(points[i])
+        middle = len(sentences) // 2
+        points[i:i + 1] = [" ".join(sentences[:middle]), " ".join(sentences[middle:])]
+    return points
+
+
+def repair_response(response, plan, unsatisfied_constraints):
+    """
+    Try to fix a failed structure constraint without calling the LLM, by merging or
+    splitting points to reach the exact count and renumbering them.
+    Returns the repaired response, or None if no deterministic repair applies. The
+    repaired response satisfies the structure constraint but may still fail others.
+    """
+    structure = next(
+        (item["constraint"] for item in unsatisfied_constraints
+         if item["operator"] == "AND" and item.get("constraint") is not None and item["constraint"].type == "structure"),
+        None,
+    )
+    if structure is None:
+        return None
+
+    record(repairs_attempted=1)
+    parsed = split_points(response)
+    if parsed is None:
+        return None
+    preamble, points = parsed
+
+    target = int(structure.value)
+    if len(points) > target:
+        points = merge_points(points, target)
+    elif len(points) < target:
+        points = split_points_to(points, target)
+        if points is None:
+            return None
+
+    renumbered = [f"{i}. {point}" for i, point in enumerate(points, start=1)]
+    repaired = "\n".join([line for line in preamble if line.strip()] + renumbered)
+
+    # Only accept the repair if the validator now agrees the structure is right
+    _, still_unsatisfied = plan.validate(repaired)
+    if any(item.get("constraint") is structure for item in still_unsatisfied):
+        return None
+
+    record(repairs_succeeded=1)
+    return repaired
@@ -0,0 +1,73 @@
+import os
+import time
+
+# Limits for the correction loop in generate_valid_response; each can be overridden per request
+MAX_CORRECTION_ITERATIONS = int(os.getenv("MAX_CORRECTION_ITERATIONS", "5"))
+CORRECTION_DEADLINE_S = float(os.getenv("CORRECTION_DEADLINE_S", "60"))
+CORRECTION_TOKEN_BUDGET = int(os.getenv("CORRECTION_TOKEN_BUDGET", "100000"))
+CORRECTION_CALL_BUDGET = int(os.getenv("CORRECTION_CALL_BUDGET", "20"))  # provider calls, speculative candidates included
+
+
+def count_tokens(chat) -> int:
+    """
+    Total tokens billed for a Gemini response, or 0 if the provider did not report usage.
+    """
+    usage = getattr(chat, "usage_metadata", None)
+    return (usage.total_token_count or 0) if usage else 0
+
+
+def count_input_tokens(chat) -> int:
+    """
+    Prompt tokens Gemini reported for a response, or 0 if it did not report usage.
+    """
+    usage = getattr(chat, "usage_metadata", None)
+    return (usage.prompt_token_count or 0) if usage else 0
+
+
+class RetryController:
+    """
+    Bounds the correction loop by iteration count, wall-clock deadline, token budget and
+    number of provider calls, and remembers the candidate that satisfied the most constraints so far.
+    """
+
+    def __init__(self, plan, max_iterations=None, deadline_s=None, token_budget=None, max_calls=None):
+        self.max_iterations = MAX_CORRECTION_ITERATIONS if max_iterations is None else max_iterations
+        self.deadline = time.monotonic() + (CORRECTION_DEADLINE_S if deadline_s is None else deadline_s)
+        self.token_budget = CORRECTION_TOKEN_BUDGET if token_budget is None else token_budget
+        self.total_constraints = plan.total_constraints
+        self.max_calls = CORRECTION_CALL_BUDGET if max_calls is None else max_calls
+        self.tokens_used = 0
+        self.input_tokens = 0
+        self.calls = 0
+        self.best_response = None
+        self.best_score = -1
+        self.stop_reason = None
+
+    def record_call(self, chat):
+        self.calls += 1
+        self.tokens_used += count_tokens(chat)
+        self.input_tokens += count_input_tokens(chat)
+
+    def consider(self, response, unsatisfied_constraints):
+        """
+        Score a validated candidate by the number of constraints it satisfies and keep the best.
+        Ties go to the newer candidate, since corrections only move towards the constraints.
+        """
+        score = self.total_constraints - len(unsatisfied_constraints)
+        if score >= self.best_score:
+            self.best_response = response
+            self.best_score = score
+
+    def exhausted(self, iterationCount):
+        """
+        Return the reason to stop before another correction turn, or None to keep going.
+        """
+        if iterationCount >= self.max_iterations:
+            return "max_iterations"
+        if time.monotonic() >= self.deadline:
+            return "deadline"
+        if self.tokens_used >= self.token_budget:
+            return "token_budget"
+        if self.calls >= self.max_calls:
+            return "call_budget"
+        return None
@@ -0,0 +1,202 @@
+import os
+import threading
+import time
+import logging
+from collections import OrderedDict
+
+import numpy as np
+
+from instrumentation import trace_span, SEMANTIC_CACHE_LOOKUPS
+
+# Semantic cache in front of generate_valid_response.
+# Questions are embedded with a small local sentence-embedding model on the CPU. A new question
+# is answered from the cache when an earlier one with the same constraint plan is at least
+# SEMANTIC_CACHE_THRESHOLD similar (cosine) and its answer still passes validation, so
+# paraphrases of a question that was already answered cost no provider calls.
+
+logger = logging.getLogger(__name__)
+
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "false").lower() == "true"
+SEMANTIC_CACHE_MODEL = os.getenv("SEMANTIC_CACHE_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.92"))  # cosine similarity needed for a hit
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "10000"))
+SEMANTIC_CACHE_TTL_S = float(os.getenv("SEMANTIC_CACHE_TTL_S", "86400"))  # 0 keeps entries until they are evicted
+SEMANTIC_CACHE_EVICTION = os.getenv("SEMANTIC_CACHE_EVICTION", "lru")  # "lru" drops the least recently hit, "fifo" the oldest
+
+
+class Embedder:
+    """
+    Mean-pooled, L2-normalized sentence embeddings from a Hugging Face encoder, loaded on first use.
+    """
+
+    def __init__(self, model_id=SEMANTIC_CACHE_MODEL):
+        self.model_id = model_id
+        self._model = None
+        self._tokenizer = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        """
+        Load the model unless it is loaded; raises when it cannot be.
+        """
+        if self._model is not None:
+            return
+        with self._lock:
+            if self._model is None:
+                try:
+                    import torch
+                    from transformers import AutoModel, AutoTokenizer
+                except ImportError as e:
+                    raise RuntimeError("SEMANTIC_CACHE_ENABLED=true requires the torch and transformers packages.") from e
+                self._tokenizer = AutoTokenizer.from_pretrained(self.model_id)
+                self._model = AutoModel.from_pretrained(self.model_id).eval()
+                self._torch = torch
+                logger.info("Loaded semantic cache embedding model", extra={"model": self.model_id})
+
+    def embed(self, text) -> np.ndarray:
+        self.load()
+        torch = self._torch
+        inputs = self._tokenizer([text], padding=True, truncation=True, max_length=256, return_tensors="pt")
+        with torch.inference_mode():
+            hidden = self._model(**inputs).last_hidden_state
+        mask = inputs["attention_mask"].unsqueeze(-1).to(hidden.dtype)
+        pooled = (hidden * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1e-9)
+        vector = pooled[0].numpy().astype(np.float32)
+        return vector / max(float(np.linalg.norm(vector)), 1e-12)
+
+
+class _Entry:
+    def __init__(self, plan_key, question, result):
+        self.plan_key = plan_key
+        self.question = question
+        self.result = result
+        self.created_at = time.monotonic()
+
+
+class SemanticCache:
+    """
+    Brute-force cosine search over the question embeddings, restricted to the entries whose
+    constraint plan has the same key as the request's. Embeddings live in one preallocated
+    matrix; each entry owns a row.
+    """
+
+    def __init__(self, embedder=None, enabled=SEMANTIC_CACHE_ENABLED, threshold=SEMANTIC_CACHE_THRESHOLD,
+                 max_entries=SEMANTIC_CACHE_MAX_ENTRIES, ttl_s=SEMANTIC_CACHE_TTL_S, eviction=SEMANTIC_CACHE_EVICTION):
+        if eviction not in ("lru", "fifo"):
+            raise ValueError(f"Unknown SEMANTIC_CACHE_EVICTION {eviction!r}; use lru or fifo")
+        self.embedder = embedder or Embedder()
+        self.enabled = enabled
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self.eviction = eviction
+        self._vectors = None  # (max_entries, dim), allocated with the first entry
+        self._entries = OrderedDict()  # row -> _Entry, in eviction order
+        self._rows_by_plan = {}  # plan key -> rows
+        self._free_rows = list(range(max_entries - 1, -1, -1))
+        self._lock = threading.Lock()
+
+    def embed(self, question):
+        """
+        The question's embedding, or None when the cache is off or the model cannot be used.
+        """
+        if not self.enabled:
+            return None
+        try:
+            self.embedder.load()
+        except Exception as e:
+            # The cache only saves work; without the model every request goes to the LLM as usual
+            logger.warning("Semantic cache disabled: %s", e)
+            self.enabled = False
+            return None
+        try:
+            with trace_span("embedding"):
+                return self.embedder.embed(question)
+        except Exception:
+            # One bad input does not turn the cache off for everyone else
+            logger.exception("Semantic cache embedding failed")
+            return None
+
+    def lookup(self, plan, embedding):
+        """
+        Return a copy of the cached result for the most similar question with the same plan, or
+        None. Matches whose answer no longer passes the plan's validation are dropped.
+        """
+        if embedding is None:
+            return None
+        with self._lock:
+            self._expire(plan.key)
+            rows = self._rows_by_plan.get(plan.key)
+            if not rows:
+                SEMANTIC_CACHE_LOOKUPS.labels("miss").inc()
+                return None
+            rows = np.fromiter(rows, dtype=np.int64)
+            scores = self._vectors[rows] @ embedding
+            for i in np.argsort(-scores):
+                if scores[i] < self.threshold:
+                    break
+                row = int(rows[i])
+                entry = self._entries[row]
+                is_valid, _ = plan.validate(entry.result["response"])
+                if not is_valid:
+                    SEMANTIC_CACHE_LOOKUPS.labels("rejected").inc()
+                    self._remove(row)
+                    continue
+                if self.eviction == "lru":
+                    self._entries.move_to_end(row)
+                SEMANTIC_CACHE_LOOKUPS.labels("hit").inc()
+                logger.info("Semantic cache hit", extra={"similarity": round(float(scores[i]), 4)})
+                return {
+                    **entry.result,
+                    "iterationCount": 0,
+                    "repairCount": 0,
+                    "stopReason": "semantic_cache",
+                    "tokensUsed": 0,
+                    "inputTokens": [],
+                    "cacheSimilarity": float(scores[i]),
+                }
+        SEMANTIC_CACHE_LOOKUPS.labels("miss").inc()
+        return None
+
+    def store(self, plan, question, embedding, result):
+        """
+        Keep a result for later paraphrases; only answers that satisfied every constraint are kept.
+        """
+        if embedding is None or result.get("stopReason") != "valid":
+            return
+        with self._lock:
+            if self._vectors is None:
+                self._vectors = np.zeros((self.max_entries, embedding.shape[0]), dtype=np.float32)
+            if not self._free_rows:
+                self._remove(next(iter(self._entries)))
+            row = self._free_rows.pop()
+            self._vectors[row] = embedding
+            self._entries[row] = _Entry(plan.key, question, dict(result))
+            self._rows_by_plan.setdefault(plan.key, set()).add(row)
+
+    def _remove(self, row):
+        entry = self._entries.pop(row)
+        rows = self._rows_by_plan[entry.plan_key]
+        rows.discard(row)
+        if not rows:
+            del self._rows_by_plan[entry.plan_key]
+        self._free_rows.append(row)
+
+    def _expire(self, plan_key):
+        if not self.ttl_s:
+            return
+        cutoff = time.monotonic() - self.ttl_s
+        for row in [r for r in self._rows_by_plan.get(plan_key, ()) if self._entries[r].created_at < cutoff]:
+            self._remove(row)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._rows_by_plan.clear()
+            self._free_rows = list(range(self.max_entries - 1, -1, -1))
+
+    def __len__(self):
+        return len(self._entries)
+
+
+semantic_cache = SemanticCache()
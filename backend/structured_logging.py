@@ -0,0 +1,173 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import time
+import uuid
+import zlib
+from contextvars import ContextVar
+
+# Structured logging for the backend and the split services.
+# Records are handed to a queue on the calling thread and written as JSON lines by a
+# background listener, so a slow stdout never blocks a request. Long payloads are
+# truncated and DEBUG records are sampled per request.
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_MAX_FIELD_CHARS = int(os.getenv("LOG_MAX_FIELD_CHARS", "500"))  # longer messages and fields are cut
+LOG_DEBUG_SAMPLE_RATE = float(os.getenv("LOG_DEBUG_SAMPLE_RATE", "0.05"))  # share of requests whose DEBUG records are kept
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))  # records beyond this are dropped rather than waited on
+
+request_id_var = ContextVar("request_id", default=None)
+
+# Attributes every LogRecord has; anything else was passed through `extra` and is logged as a field
+_standard_attributes = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "request_id"}
+
+_listener = None
+
+
+def truncate(value, limit=LOG_MAX_FIELD_CHARS):
+    text = value if isinstance(value, str) else repr(value)
+    if len(text) <= limit:
+        return text
+    return f"{text[:limit]}... [{len(text) - limit} more chars]"
+
+
+def with_request_id(fn):
+    """
+    Wrap fn so it logs with the current request ID when run on another thread,
+    for executors that do not copy the caller's context.
+    """
+    request_id = request_id_var.get()
+
+    def run(*args, **kwargs):
+        token = request_id_var.set(request_id)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            request_id_var.reset(token)
+
+    return run
+
+
+class RequestSampler(logging.Filter):
+    """
+    Keep every record at INFO and above, and DEBUG records for a sample of requests.
+    The decision is made per request ID, so a sampled request keeps its whole debug trail.
+    """
+
+    def __init__(self, rate=LOG_DEBUG_SAMPLE_RATE):
+        super().__init__()
+        self.threshold = int(rate * 10000)
+
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        if record.levelno >= logging.INFO:
+            return True
+        if record.request_id is None:
+            return self.threshold >= 10000
+        return zlib.crc32(record.request_id.encode()) % 10000 < self.threshold
+
+
+class TruncatingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue handler that renders and truncates the message on the calling thread and never
+    blocks: when the queue is full the record is dropped.
+    """
+
+    def prepare(self, record):
+        record.message = truncate(record.getMessage())
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        for key, value in list(vars(record).items()):
+            if key not in _standard_attributes and not isinstance(value, (int, float, bool, type(None))):
+                setattr(record, key, truncate(value))
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            pass
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        if getattr(record, "request_id", None):
+            entry["request_id"] = record.request_id
+        for key, value in vars(record).items():
+            if key not in _standard_attributes:
+                entry[key] = value
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+def configure_logging(level=LOG_LEVEL):
+    """
+    Route all logging through the queue and the JSON listener. Safe to call more than once.
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setFormatter(JsonFormatter())
+
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    handler = TruncatingQueueHandler(log_queue)
+    handler.addFilter(RequestSampler())
+
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(level)
+
+    _listener = logging.handlers.QueueListener(log_queue, stream, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
+    if hasattr(os, "register_at_fork"):
+        os.register_at_fork(after_in_child=_restart_listener_in_child)
+
+
+def _restart_listener_in_child():
+    """
+    A forked worker (see prefork.py) inherits the listener but not its thread, and the queue's
+    locks may have been held at fork time, so it starts over with a fresh queue and listener.
+    """
+    global _listener
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, TruncatingQueueHandler):
+            handler.queue = log_queue
+    _listener = logging.handlers.QueueListener(log_queue, *_listener.handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
+
+
+def add_request_id(app):
+    """
+    Give every request an ID, taken from the X-Request-ID header when the caller sent one,
+    make it visible to the service modules through request_id_var and echo it back.
+    """
+
+    @app.middleware("http")
+    async def request_id_middleware(request, call_next):
+        request_id = request.headers.get("X-Request-ID") or uuid.uuid4().hex
+        token = request_id_var.set(request_id)
+        try:
+            response = await call_next(request)
+        finally:
+            request_id_var.reset(token)
+        response.headers["X-Request-ID"] = request_id
+        return response
@@ -2,9 +2,16 @@ import torch
 from transformers import AutoModelForSpeechSeq2Seq, AutoProcessor, pipeline
 # from datasets import load_dataset
 import librosa
+import numpy as np
 # import sounddevice as sd
 import io
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
 from pydub import AudioSegment
+from instrumentation import trace_span, record_model_memory
 
 
 
@@ -13,23 +20,118 @@ device = "cuda:0" if torch.cuda.is_available() else "cpu"
 # print(f"Using device: {device}")
 torch_dtype = torch.float16 if torch.cuda.is_available() else torch.float32
 
-model_id = "openai/whisper-large-v3-turbo"
+# Engine selection, read once at startup:
+#   "transformers"       - Hugging Face pipeline in float32 (float16 on GPU)
+#   "transformers-int8"  - same pipeline with int8 dynamic quantization of the Linear layers (CPU only)
+#   "ctranslate2"        - faster-whisper / CTranslate2 export with int8 weights (requires faster-whisper)
+STT_ENGINE = os.getenv("STT_ENGINE", "transformers")
+STT_MODEL_SIZE = os.getenv("STT_MODEL_SIZE", "large-v3-turbo")  # tiny, base, small, medium, large-v3, large-v3-turbo
+STT_CPU_THREADS = int(os.getenv("STT_CPU_THREADS", "0"))  # 0 lets the runtime decide
 
-model = AutoModelForSpeechSeq2Seq.from_pretrained(
-    model_id, torch_dtype=torch_dtype, low_cpu_mem_usage=True, use_safetensors=True
-)
-model.to(device)
 
-processor = AutoProcessor.from_pretrained(model_id)
+class TransformersWhisperEngine:
+    """
+    Whisper through the Hugging Face ASR pipeline, optionally int8-quantized for CPU.
+    """
+
+    def __init__(self, model_size, quantize=False):
+        self.name = "transformers-int8" if quantize else "transformers"
+        self.model_id = f"openai/whisper-{model_size}"
+        # Dynamic quantization only has CPU kernels
+        self.device = "cpu" if quantize else device
+        dtype = torch.float32 if quantize else torch_dtype
+
+        if STT_CPU_THREADS:
+            torch.set_num_threads(STT_CPU_THREADS)
+
+        self.model = AutoModelForSpeechSeq2Seq.from_pretrained(
+            self.model_id, torch_dtype=dtype, low_cpu_mem_usage=True, use_safetensors=True
+        )
+        self.model.to(self.device)
+        if quantize:
+            self.model = torch.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+
+        self.processor = AutoProcessor.from_pretrained(self.model_id)
+
+        self.pipe = pipeline(
+            "automatic-speech-recognition",
+            model=self.model,
+            tokenizer=self.processor.tokenizer,
+            feature_extractor=self.processor.feature_extractor,
+            torch_dtype=dtype,
+            device=self.device,
+        )
+        record_model_memory(self.model_id, self.model)
+
+    def transcribe_batch(self, inputs, batch_size, chunk_length_s):
+        """
+        Transcribe a list of {"array", "sampling_rate"} inputs in batched pipeline calls.
+        """
+        return self.pipe(
+            inputs,
+            batch_size=batch_size,
+            chunk_length_s=chunk_length_s,
+            generate_kwargs={
+                "task": "transcribe",  # transcribe or translate , Use "transcribe" if you want transcription instead of translation
+                "language": "en",      # optional
+            },
+            return_timestamps=True,
+        )
+
+
+class CTranslate2WhisperEngine:
+    """
+    Whisper through faster-whisper (CTranslate2) with int8 weights.
+    """
+
+    def __init__(self, model_size):
+        try:
+            from faster_whisper import WhisperModel, BatchedInferencePipeline
+        except ImportError as e:
+            raise RuntimeError("STT_ENGINE=ctranslate2 requires the faster-whisper package.") from e
+
+        self.name = "ctranslate2"
+        self.model_id = model_size
+        self.model = WhisperModel(
+            model_size,
+            device="cuda" if torch.cuda.is_available() else "cpu",
+            compute_type="int8_float16" if torch.cuda.is_available() else "int8",
+            cpu_threads=STT_CPU_THREADS,
+        )
+        self.pipe = BatchedInferencePipeline(model=self.model)
+
+    def transcribe_batch(self, inputs, batch_size, chunk_length_s):
+        """
+        Transcribe a list of {"array", "sampling_rate"} inputs; chunks of each recording are batched.
+        """
+        results = []
+        for item in inputs:
+            segments, _ = self.pipe.transcribe(
+                item["array"],
+                language="en",
+                task="transcribe",
+                batch_size=batch_size,
+                chunk_length=chunk_length_s,
+            )
+            chunks = [{"timestamp": (segment.start, segment.end), "text": segment.text} for segment in segments]
+            results.append({"text": "".join(chunk["text"] for chunk in chunks), "chunks": chunks})
+        return results
+
+
+def load_engine(engine_name=STT_ENGINE, model_size=STT_MODEL_SIZE):
+    """
+    Build the speech-to-text engine selected by configuration.
+    """
+    if engine_name == "transformers":
+        return TransformersWhisperEngine(model_size)
+    if engine_name == "transformers-int8":
+        return TransformersWhisperEngine(model_size, quantize=True)
+    if engine_name == "ctranslate2":
+        return CTranslate2WhisperEngine(model_size)
+    raise ValueError(f"Unknown STT engine: {engine_name}")
+
 
-pipe = pipeline(
-    "automatic-speech-recognition",
-    model=model,
-    tokenizer=processor.tokenizer,
-    feature_extractor=processor.feature_extractor,
-    torch_dtype=torch_dtype,
-    device=device,
-)
+engine = load_engine()
 
 # dataset = load_dataset("distil-whisper/librispeech_long", "clean", split="validation")
 # sample = dataset[0]["audio"]
@@ -64,9 +166,89 @@ pipe = pipeline(
 
 # print(result["text"])
 
-def speech_to_text(audio_bytes: bytes) -> str:
+# Batching configuration for concurrent transcription requests
+STT_BATCH_SIZE = int(os.getenv("STT_BATCH_SIZE", "8"))  # max inputs (or 30s chunks) per pipeline call
+STT_BATCH_WAIT_MS = float(os.getenv("STT_BATCH_WAIT_MS", "50"))  # how long to wait for more requests
+STT_CHUNK_LENGTH_S = int(os.getenv("STT_CHUNK_LENGTH_S", "30"))  # long recordings are split into chunks
+
+# Voice-activity trimming applied before Whisper
+STT_VAD_ENABLED = os.getenv("STT_VAD_ENABLED", "1") == "1"
+STT_VAD_FRAME_MS = 30
+STT_VAD_RELATIVE_DB = float(os.getenv("STT_VAD_RELATIVE_DB", "-35"))  # frames this far below the loudest frame are silence
+STT_VAD_FLOOR_DB = float(os.getenv("STT_VAD_FLOOR_DB", "-55"))  # frames below this level (dBFS) are always silence
+STT_VAD_MIN_SILENCE_MS = int(os.getenv("STT_VAD_MIN_SILENCE_MS", "600"))  # shorter pauses are kept
+STT_VAD_MIN_SPEECH_MS = int(os.getenv("STT_VAD_MIN_SPEECH_MS", "150"))  # shorter bursts are dropped as noise
+STT_VAD_PADDING_MS = int(os.getenv("STT_VAD_PADDING_MS", "200"))  # context kept around each speech segment
+
+
+class TranscriptionScheduler:
     """
-    Convert speech to text using Whisper.
+    Gather concurrent transcription requests into batched pipeline calls.
+    Requests arriving within the wait window share one call to the pipeline, long
+    recordings are split into chunks that are batched together, and each result is
+    routed back to the request that submitted it.
+    """
+
+    def __init__(self, max_batch_size=STT_BATCH_SIZE, max_wait_ms=STT_BATCH_WAIT_MS):
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._worker = None
+
+    def submit(self, audio_array, sampling_rate) -> Future:
+        """
+        Queue one recording for transcription and return a future for its result.
+        """
+        future = Future()
+        self._queue.put(({"array": audio_array, "sampling_rate": sampling_rate}, future))
+        self._ensure_worker()
+        return future
+
+    def _ensure_worker(self):
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name="stt-batch-worker", daemon=True)
+                self._worker.start()
+
+    def _collect_batch(self):
+        # Block for the first request, then keep gathering until the batch is full or the window closes
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect_batch()
+            inputs = [item for item, _ in batch]
+            futures = [future for _, future in batch]
+            try:
+                with trace_span("whisper_batch", engine.name):
+                    results = engine.transcribe_batch(inputs, self.max_batch_size, STT_CHUNK_LENGTH_S)
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+                continue
+
+            # The engine returns one result per input, in order
+            for future, result in zip(futures, results):
+                future.set_result(result)
+
+
+scheduler = TranscriptionScheduler()
+
+
+def load_audio(audio_bytes: bytes):
+    """
+    Decode an uploaded recording into a 16kHz mono float array.
     """
 
     # Convert bytes to file-like object
@@ -82,14 +264,120 @@ def speech_to_text(audio_bytes: bytes) -> str:
 
     # Load the WAV bytes with librosa
     audio_array, sampling_rate = librosa.load(wav_io, sr=16000)
+    return audio_array, sampling_rate
+
+
+def detect_speech(audio_array, sampling_rate):
+    """
+    Find speech segments with a frame-energy detector.
+    Returns a list of (start_sample, end_sample) pairs, empty if the recording is silent.
+    """
+    frame_length = int(sampling_rate * STT_VAD_FRAME_MS / 1000)
+    n_frames = len(audio_array) // frame_length
+    if n_frames == 0:
+        return []
+
+    # Per-frame energy in dBFS, computed on a (frames, samples) view of the signal
+    frames = audio_array[:n_frames * frame_length].reshape(n_frames, frame_length)
+    energy_db = 10 * np.log10(np.mean(frames.astype(np.float32) ** 2, axis=1) + 1e-10)
+    threshold = max(energy_db.max() + STT_VAD_RELATIVE_DB, STT_VAD_FLOOR_DB)
+    voiced = energy_db > threshold
+    if not voiced.any():
+        return []
+
+    # Runs of voiced frames as [start, end) frame indices
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], voiced.astype(np.int8), [0]))))
+    starts, ends = edges[0::2], edges[1::2]
+
+    # Bridge pauses shorter than the minimum silence
+    keep = (starts[1:] - ends[:-1]) * STT_VAD_FRAME_MS >= STT_VAD_MIN_SILENCE_MS
+    starts = np.concatenate((starts[:1], starts[1:][keep]))
+    ends = np.concatenate((ends[:-1][keep], ends[-1:]))
+
+    # Drop bursts too short to be speech
+    long_enough = (ends - starts) * STT_VAD_FRAME_MS >= STT_VAD_MIN_SPEECH_MS
+    starts, ends = starts[long_enough], ends[long_enough]
+    if len(starts) == 0:
+        return []
+
+    # Pad each segment with some context, without letting neighbours overlap
+    padding = int(sampling_rate * STT_VAD_PADDING_MS / 1000)
+    start_samples = np.maximum(starts * frame_length - padding, 0)
+    end_samples = np.minimum(ends * frame_length + padding, len(audio_array))
+    start_samples[1:] = np.maximum(start_samples[1:], end_samples[:-1])
+    return list(zip(start_samples.tolist(), end_samples.tolist()))
+
+
+def trim_silence(audio_array, sampling_rate, segments):
+    """
+    Concatenate the speech segments into one array.
+    Returns the trimmed audio and (trimmed_start, original_start) offsets in seconds per segment.
+    """
+    offsets = []
+    position = 0
+    for start, end in segments:
+        offsets.append((position / sampling_rate, start / sampling_rate))
+        position += end - start
+    trimmed = np.concatenate([audio_array[start:end] for start, end in segments])
+    return trimmed, offsets
+
+
+def remap_timestamps(chunks, offsets):
+    """
+    Map chunk timestamps from the trimmed audio back onto the original recording.
+    """
+    trimmed_starts = np.array([trimmed for trimmed, _ in offsets])
 
-    # Process audio
-    result = pipe(
-        {"array": audio_array, "sampling_rate": sampling_rate},
-        generate_kwargs={
-            "task": "transcribe",  # transcribe or translate , Use "transcribe" if you want transcription instead of translation
-            "language": "en",      # optional
-            "return_timestamps": True
-        }
-    )
-    return result["text"]
+    def to_original(t, is_end):
+        if t is None:
+            return None
+        # An end timestamp sitting on a segment boundary belongs to the segment before it
+        index = np.searchsorted(trimmed_starts, t, side="left" if is_end else "right") - 1
+        index = max(int(index), 0)
+        trimmed_start, original_start = offsets[index]
+        return round(original_start + (t - trimmed_start), 2)
+
+    remapped = []
+    for chunk in chunks:
+        start, end = chunk["timestamp"]
+        remapped.append({**chunk, "timestamp": (to_original(start, False), to_original(end, True))})
+    return remapped
+
+
+def transcribe_array(audio_array, sampling_rate) -> dict:
+    """
+    Transcribe a decoded recording, skipping silence.
+    Returns the text and timestamped chunks relative to the original recording.
+    """
+    if STT_VAD_ENABLED:
+        with trace_span("vad"):
+            segments = detect_speech(audio_array, sampling_rate)
+    else:
+        segments = [(0, len(audio_array))]
+
+    # Silent uploads never reach the model
+    if not segments:
+        return {"text": "", "chunks": []}
+
+    trimmed, offsets = trim_silence(audio_array, sampling_rate, segments)
+
+    # Process audio, batched with any other requests in flight
+    with trace_span("whisper", engine.name):
+        result = scheduler.submit(trimmed, sampling_rate).result()
+    return {**result, "chunks": remap_timestamps(result.get("chunks", []), offsets)}
+
+
+def transcribe(audio_bytes: bytes) -> dict:
+    """
+    Convert speech to text with timestamps using Whisper.
+    """
+    with trace_span("audio_decode"):
+        audio_array, sampling_rate = load_audio(audio_bytes)
+    return transcribe_array(audio_array, sampling_rate)
+
+
+def speech_to_text(audio_bytes: bytes) -> str:
+    """
+    Convert speech to text using Whisper.
+    """
+    return transcribe(audio_bytes)["text"]
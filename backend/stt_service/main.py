@@ -1,6 +1,20 @@
 from fastapi import FastAPI, HTTPException, File, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
-from STT_service import speech_to_text
+from fastapi.concurrency import run_in_threadpool
+import logging
+from instrumentation import instrument_app
+from structured_logging import configure_logging, add_request_id
+from inference_broker import INFERENCE_MODE, Broker, add_inference_routes
+
+if INFERENCE_MODE == "workers":
+    # Whisper runs in worker processes; set INFERENCE_WORKER_CONCURRENCY to keep batching concurrent uploads
+    broker = Broker()
+    broker.register("stt", "STT_service:speech_to_text")
+else:
+    from STT_service import speech_to_text
+
+configure_logging()
+logger = logging.getLogger(__name__)
 
 app = FastAPI()
 
@@ -10,15 +24,26 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Server-Timing", "X-Request-ID"],
 )
 
+instrument_app(app, "stt_service")
+add_request_id(app)
+if INFERENCE_MODE == "workers":
+    add_inference_routes(app, broker)
+
 @app.post("/transcribe/")
 async def transcribe_audio(file: UploadFile = File(...)):
     try:
         contents = await file.read()
-        return {"transcription": speech_to_text(contents)}
+        if INFERENCE_MODE == "workers":
+            transcription = await broker.run("stt", contents)
+        else:
+            # Run off the event loop so concurrent uploads can be batched together
+            transcription = await run_in_threadpool(speech_to_text, contents)
+        return {"transcription": transcription}
     except Exception as e:
-        print(f"Transcription error: {e}")
+        logger.exception("Transcription error")
         raise HTTPException(status_code=500, detail=str(e))
     
 if __name__ == "__main__":
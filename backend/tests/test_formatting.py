@@ -0,0 +1,29 @@
+"""
+format_response against the golden outputs of the legacy formatter, so a behavioural change
+fails the tests rather than waiting for someone to run benchmarks/format_response_benchmark.py.
+
+Run from the backend directory: python -m pytest tests
+"""
+import json
+import random
+
+import pytest
+
+from benchmarks.format_response_benchmark import GOLDEN_PATH, legacy_format_response, random_response
+from response_service.formatting import format_response
+
+with open(GOLDEN_PATH) as f:
+    GOLDEN_CASES = json.load(f)
+
+
+@pytest.mark.parametrize("case", GOLDEN_CASES, ids=lambda case: repr(case["input"][:40]))
+def test_golden(case):
+    assert format_response(case["input"], case["has_structure_constraint"]) == case["expected"]
+
+
+def test_matches_legacy_on_random_responses():
+    rng = random.Random(0)
+    for _ in range(2000):
+        text = random_response(rng, rng.randint(0, 60))
+        structure = rng.random() < 0.5
+        assert format_response(text, structure) == legacy_format_response(text, structure), text
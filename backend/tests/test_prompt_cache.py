@@ -0,0 +1,63 @@
+"""
+The provider-side prompt cache against the stand-in Gemini client from the benchmarks: a long
+enough instruction is cached once it has been reused and later calls reference the cache,
+while a short one is always sent inline.
+
+Run from the backend directory: python -m pytest tests
+"""
+import asyncio
+
+import pytest
+
+import prompt_cache
+from benchmarks.mock_providers import MockGeminiClient, ProviderBehaviour, ProviderStats, Responder
+from prompt_cache import PromptCache, agenerate_content, estimate_tokens, generate_content
+
+MODEL = "gemini-2.0-flash"
+LONG_INSTRUCTION = "Always follow these rules:\n" + "\n".join(f"- Rule {i}: keep the answer on topic." for i in range(400))
+
+
+@pytest.fixture
+def client():
+    behaviour = ProviderBehaviour(latency_ms=0, jitter_ms=0)
+    return MockGeminiClient(behaviour, Responder(behaviour), ProviderStats())
+
+
+@pytest.fixture(autouse=True)
+def cache(monkeypatch):
+    # The production thresholds, with a registry of its own per test
+    cache = PromptCache(enabled=True, min_tokens=1024, min_uses=2)
+    monkeypatch.setattr(prompt_cache, "prompt_cache", cache)
+    return cache
+
+
+def test_long_instruction_is_cached_after_reuse(client):
+    assert estimate_tokens(LONG_INSTRUCTION) >= 1024
+    chats = [generate_content(client, MODEL, ["What is a graph?"], LONG_INSTRUCTION) for _ in range(3)]
+
+    stats = client.stats.snapshot()
+    assert stats[("gemini", "cache_create")] == 1
+    # The first use sends the instruction inline; the next two reference the cache
+    assert stats[("gemini", "cache_hit")] == 2
+    cached = estimate_tokens(LONG_INSTRUCTION)
+    assert [chat.usage_metadata.cached_content_token_count for chat in chats] == [0, cached, cached]
+
+
+def test_async_calls_share_the_cache(client):
+    async def calls():
+        for _ in range(3):
+            await agenerate_content(client, MODEL, ["What is a graph?"], LONG_INSTRUCTION)
+
+    asyncio.run(calls())
+    stats = client.stats.snapshot()
+    assert stats[("gemini", "cache_create")] == 1
+    assert stats[("gemini", "cache_hit")] == 2
+
+
+def test_short_instruction_stays_inline(client):
+    for _ in range(3):
+        generate_content(client, MODEL, ["What is a graph?"], "Answer in one sentence.")
+
+    stats = client.stats.snapshot()
+    assert ("gemini", "cache_create") not in stats
+    assert ("gemini", "cache_hit") not in stats
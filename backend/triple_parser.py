@@ -0,0 +1,258 @@
+import json
+import re
+from typing import List
+
+# Incremental parser for the triples an LLM streams back for knowledge-graph extraction.
+# Understands three output styles, mixed freely line by line:
+#   (entity1, relation, entity2)         - entities may be quoted and may contain commas or parentheses
+#   ["entity1", "relation", "entity2"]   - JSON lines, or {"subject": ..., "relation": ..., "object": ...}
+#   | entity1 | relation | entity2 |     - markdown table rows, with or without a header row
+
+LINE_START, TEXT, TUPLE, JSON_LINE, TABLE_ROW = range(5)
+
+_non_blank = re.compile(r'[^ \t\r]')
+_text_special = re.compile(r'[(\n]')
+_tuple_special = re.compile(r'[(),"\'\n]')
+_table_separator = re.compile(r'^\|?[\s:|-]+\|?$')
+_strip_chars = ' \t\r\n*`'
+
+SUBJECT_KEYS = ("subject", "entity1", "head", "source", "from")
+RELATION_KEYS = ("relation", "predicate", "relationship", "edge", "label")
+OBJECT_KEYS = ("object", "entity2", "tail", "target", "to")
+
+
+def make_triple(fields):
+    """
+    Turn parsed fields into a triple, or None if they do not form one.
+    Extra fields are folded into the object, as the original regex did.
+    """
+    fields = [str(f).strip(_strip_chars) for f in fields]
+    if len(fields) < 3:
+        return None
+    if len(fields) > 3:
+        fields = fields[:2] + [", ".join(fields[2:])]
+    if not all(fields):
+        return None
+    return fields
+
+
+def parse_json_line(line):
+    """
+    Parse one JSON line holding a triple, a list of triples or a triple object.
+    """
+    line = line.strip().rstrip(",")
+    try:
+        value = json.loads(line)
+    except ValueError:
+        return []
+
+    if isinstance(value, dict):
+        value = [value]
+    elif isinstance(value, list) and value and not isinstance(value[0], (list, dict)):
+        value = [value]
+    if not isinstance(value, list):
+        return []
+
+    triples = []
+    for item in value:
+        if isinstance(item, dict):
+            lowered = {str(k).lower(): v for k, v in item.items()}
+            item = [
+                next((lowered[k] for k in keys if k in lowered), "")
+                for keys in (SUBJECT_KEYS, RELATION_KEYS, OBJECT_KEYS)
+            ]
+        if isinstance(item, list):
+            triple = make_triple(item)
+            if triple:
+                triples.append(triple)
+    return triples
+
+
+class TripleStreamParser:
+    """
+    Parse triples out of text that arrives in arbitrary pieces.
+    feed() returns the triples completed by the new text; close() flushes the rest.
+    Each character is looked at once, so feeding token by token costs the same as
+    parsing the finished output.
+    """
+
+    def __init__(self):
+        self._buffer = ""
+        self._pos = 0
+        self._mode = LINE_START
+        self._line_start = 0
+        self._table_columns = None
+        self._reset_tuple()
+
+    def _reset_tuple(self):
+        self._depth = 0
+        self._fields = []
+        self._field = []
+        self._quote = None
+
+    def _end_field(self):
+        self._fields.append("".join(self._field))
+        self._field = []
+
+    def _parse_table_row(self, line):
+        cells = [c.strip(_strip_chars) for c in line.strip().strip("|").split("|")]
+        if _table_separator.match(line.strip()):
+            return []
+
+        # A header row tells us which columns hold the subject, relation and object
+        lowered = [c.lower() for c in cells]
+        if self._table_columns is None and any(
+            any(key in cell for key in SUBJECT_KEYS + RELATION_KEYS + OBJECT_KEYS) for cell in lowered
+        ):
+            columns = []
+            for keys in (SUBJECT_KEYS, RELATION_KEYS, OBJECT_KEYS):
+                columns.append(next((i for i, cell in enumerate(lowered) if any(k in cell for k in keys)), None))
+            self._table_columns = columns if None not in columns and len(set(columns)) == 3 else [0, 1, 2]
+            return []
+
+        columns = self._table_columns or [0, 1, 2]
+        if max(columns) >= len(cells):
+            return []
+        triple = make_triple([cells[i] for i in columns])
+        return [triple] if triple else []
+
+    def feed(self, text: str) -> List[List[str]]:
+        """
+        Add streamed text and return the triples it completed.
+        """
+        self._buffer += text
+        return self._drain(final=False)
+
+    def close(self) -> List[List[str]]:
+        """
+        Finish the stream and return any triple still pending on the last line.
+        """
+        if self._mode in (JSON_LINE, TABLE_ROW):
+            # A line without its newline was scanned to the end and left unparsed; go back to its start
+            self._pos = self._line_start
+        triples = self._drain(final=True)
+        self.__init__()
+        return triples
+
+    def _drain(self, final):
+        triples = []
+        buf = self._buffer
+        n = len(buf)
+        i = self._pos
+
+        while i < n:
+            mode = self._mode
+
+            if mode == LINE_START:
+                match = _non_blank.search(buf, i)
+                if not match:
+                    i = n
+                    break
+                i = match.start()
+                c = buf[i]
+                if c == "\n":
+                    i += 1
+                    continue
+                if c in "[{":
+                    self._mode = JSON_LINE
+                elif c == "|":
+                    self._mode = TABLE_ROW
+                else:
+                    self._mode = TEXT
+                    self._table_columns = None
+                self._line_start = i
+                continue
+
+            if mode in (JSON_LINE, TABLE_ROW):
+                # Line formats are parsed once the whole line is available
+                end = buf.find("\n", i)
+                if end == -1:
+                    if not final:
+                        i = n
+                        break
+                    end = n
+                line = buf[self._line_start:end]
+                triples.extend(parse_json_line(line) if mode == JSON_LINE else self._parse_table_row(line))
+                self._mode = LINE_START
+                i = end + 1
+                continue
+
+            if mode == TEXT:
+                match = _text_special.search(buf, i)
+                if not match:
+                    i = n
+                    break
+                i = match.end()
+                if match.group() == "\n":
+                    self._mode = LINE_START
+                else:
+                    self._mode = TUPLE
+                    self._reset_tuple()
+                    self._depth = 1
+                continue
+
+            # TUPLE: jump to the next character that can change the parse
+            match = _tuple_special.search(buf, i)
+            if not match:
+                self._field.append(buf[i:])
+                i = n
+                break
+            j = match.start()
+            c = buf[j]
+            self._field.append(buf[i:j])
+
+            if self._quote:
+                if c == self._quote:
+                    # A quote only closes the entity when a separator follows it
+                    k = j + 1
+                    while k < n and buf[k] in " \t":
+                        k += 1
+                    if k == n and not final:
+                        i = j
+                        break
+                    if k == n or buf[k] in ",)":
+                        self._quote = None
+                    else:
+                        self._field.append(c)
+                else:
+                    self._field.append(c)
+                i = j + 1
+                continue
+
+            if c in "\"'":
+                if not "".join(self._field).strip():
+                    self._field = []
+                    self._quote = c
+                else:
+                    self._field.append(c)  # an apostrophe inside a word
+            elif c == "(":
+                self._depth += 1
+                self._field.append(c)
+            elif c == ")":
+                self._depth -= 1
+                if self._depth == 0:
+                    self._end_field()
+                    triple = make_triple(self._fields)
+                    if triple:
+                        triples.append(triple)
+                    self._reset_tuple()
+                    self._mode = TEXT
+                else:
+                    self._field.append(c)
+            elif c == ",":
+                if self._depth == 1:
+                    self._end_field()
+                else:
+                    self._field.append(c)
+            else:
+                # Unquoted tuples never span lines, so this was prose in parentheses
+                self._reset_tuple()
+                self._mode = LINE_START
+            i = j + 1
+
+        # Drop consumed text, keeping the start of a line that is still being read
+        keep_from = self._line_start if self._mode in (JSON_LINE, TABLE_ROW) else i
+        self._buffer = buf[keep_from:]
+        self._pos = i - keep_from
+        self._line_start = 0
+        return triples
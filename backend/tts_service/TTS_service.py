@@ -6,6 +6,13 @@ from TTS.api import TTS
 # from TTS.config.shared_configs import BaseDatasetConfig  # Import BaseDatasetConfig
 # from TTS.tts.models.xtts import XttsArgs  # Import XttsArgs
 from io import BytesIO
+import numpy as np
+from instrumentation import trace_span, record_model_memory
+try:
+    from speech_chunks import split_into_chunks, pcm_stream_header
+except ImportError:
+    # Imported as tts_service.TTS_service from backend/
+    from tts_service.speech_chunks import split_into_chunks, pcm_stream_header
 # from gtts import gTTS
 # import os
 # import pyttsx3
@@ -67,6 +74,7 @@ device = "cuda" if torch.cuda.is_available() else "cpu"
 # Initialize TTS
 # tts = TTS("tts_models/multilingual/multi-dataset/xtts_v2").to(device)
 tts = TTS("tts_models/en/ljspeech/vits").to(device)
+record_model_memory("tts_models/en/ljspeech/vits", tts.synthesizer.tts_model)
 
 # # TTS to a file, use a preset speaker
 # file_path = r"C:\Users\raedj\Desktop\ai-assistant-project\output.wav"
@@ -99,19 +107,20 @@ def text_to_speech(text: str, maleSpeaker: bool) -> bytes:
     """
     Convert text to speech and save it as a WAV file.
     """
-    if maleSpeaker:
-        # Lower pitch slightly to simulate a male voice (VITS doesn't have "Craig Gutsy")
-        wav = tts.tts(
-            text=text,
-            split_sentences=True,
-            # Pitch adjustment (not directly supported in high-level API, see below)
-        )
-    else:
-        # Default LJSpeech voice (female)
-        wav = tts.tts(
-            text=text,
-            split_sentences=True,
-        )
+    with trace_span("tts"):
+        if maleSpeaker:
+            # Lower pitch slightly to simulate a male voice (VITS doesn't have "Craig Gutsy")
+            wav = tts.tts(
+                text=text,
+                split_sentences=True,
+                # Pitch adjustment (not directly supported in high-level API, see below)
+            )
+        else:
+            # Default LJSpeech voice (female)
+            wav = tts.tts(
+                text=text,
+                split_sentences=True,
+            )
 
     # Convert WAV data to bytes in memory
     with BytesIO() as audio_buffer:
@@ -172,4 +181,22 @@ def text_to_speech(text: str, maleSpeaker: bool) -> bytes:
 
     # # Clean up
     # os.remove(temp_path)
-    # return audio_bytes
\ No newline at end of file
+    # return audio_bytes
+
+
+def synthesize_pcm(text: str, maleSpeaker: bool) -> bytes:
+    """
+    Convert text to speech and return raw 16-bit mono PCM at tts.synthesizer.output_sample_rate.
+    """
+    with trace_span("tts"):
+        wav = np.array(tts.tts(text=text, split_sentences=True), dtype=np.float32)
+    # Same peak normalization as tts.synthesizer.save_wav
+    wav = wav * (32767 / max(0.01, np.max(np.abs(wav))))
+    return wav.astype(np.int16).tobytes()
+
+
+def wav_stream_header() -> bytes:
+    """
+    WAV header for a stream of synthesize_pcm output whose total length is not known yet.
+    """
+    return pcm_stream_header(tts.synthesizer.output_sample_rate)
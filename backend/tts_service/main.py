@@ -1,9 +1,20 @@
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
 from fastapi.middleware.cors import CORSMiddleware
-from TTS_service import text_to_speech
+from instrumentation import instrument_app
+from structured_logging import configure_logging, add_request_id
+from inference_broker import INFERENCE_MODE, Broker, add_inference_routes
+
+if INFERENCE_MODE == "workers":
+    # VITS runs in worker processes
+    broker = Broker()
+    broker.register("tts", "TTS_service:text_to_speech")
+else:
+    from TTS_service import text_to_speech
 import base64
 
+configure_logging()
+
 app = FastAPI()
 
 app.add_middleware(
@@ -12,8 +23,14 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Server-Timing", "X-Request-ID"],
 )
 
+instrument_app(app, "tts_service")
+add_request_id(app)
+if INFERENCE_MODE == "workers":
+    add_inference_routes(app, broker)
+
 class TextToSpeechRequest(BaseModel):
     text: str
     maleSpeaker: bool
@@ -33,7 +50,10 @@ async def text_to_speech_api(request: TextToSpeechRequest):
     try:
         if not request.text.strip():
             raise HTTPException(status_code=400, detail="Text cannot be empty.")
-        audio_bytes = text_to_speech(request.text, request.maleSpeaker)
+        if INFERENCE_MODE == "workers":
+            audio_bytes = await broker.run("tts", request.text, request.maleSpeaker)
+        else:
+            audio_bytes = text_to_speech(request.text, request.maleSpeaker)
         # Return audio as base64 for frontend playback
         audio_base64= base64.b64encode(audio_bytes).decode("utf-8")
         return {"audio": audio_base64}
@@ -0,0 +1,37 @@
+import re
+import struct
+
+# Text chunking and the streamed WAV header, kept apart from TTS_service.py so the gateway
+# can stream speech from a remote TTS service without loading the model.
+
+
+def split_into_chunks(text: str, max_chars: int = 250) -> list:
+    """
+    Split text into sentence groups small enough to synthesize one at a time.
+    """
+    # Keep point numbers such as "1." attached to the sentence that follows them
+    text = re.sub(r'(\d+\.)\s*\n', r'\1 ', text)
+    sentences = [s.strip() for s in re.split(r'(?<=[.!?])(?<!\d\.)\s+|\n+', text) if s.strip()]
+    chunks = []
+    current = ""
+    for sentence in sentences:
+        if current and len(current) + len(sentence) + 1 > max_chars:
+            chunks.append(current)
+            current = sentence
+        else:
+            current = f"{current} {sentence}".strip()
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def pcm_stream_header(sample_rate: int) -> bytes:
+    """
+    WAV header for a stream of 16-bit mono PCM whose total length is not known yet.
+    """
+    unknown_size = 0xFFFFFFFF
+    return (
+        b"RIFF" + struct.pack("<I", unknown_size) + b"WAVE"
+        + b"fmt " + struct.pack("<IHHIIHH", 16, 1, 1, sample_rate, sample_rate * 2, 2, 16)
+        + b"data" + struct.pack("<I", unknown_size)
+    )
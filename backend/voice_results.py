@@ -0,0 +1,73 @@
+import json
+import os
+import re
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+# Full texts of recent voice pipeline answers, whose headers may be truncated, for
+# GET /api/voice-pipeline/{id}. Without VOICE_RESULTS_DIR they are kept in memory, where only
+# the process that answered can serve them. With it set (the pre-fork launcher sets one up) each
+# result is written there as <id>.json, so any worker or replica sharing the directory serves it.
+
+VOICE_RESULTS_MAX = int(os.getenv("VOICE_RESULTS_MAX", "1000"))  # results kept; the oldest are dropped first
+VOICE_RESULTS_DIR = os.getenv("VOICE_RESULTS_DIR")
+
+# Result IDs are generated here (uuid4 hex) and name files, so anything else is unknown
+_result_id = re.compile(r"^[0-9a-f]{32}$")
+
+
+class VoiceResults:
+    def __init__(self, max_results=VOICE_RESULTS_MAX, store_dir=VOICE_RESULTS_DIR):
+        self.max_results = max_results
+        self.store_dir = store_dir
+        self._results = OrderedDict()
+        self._lock = threading.Lock()
+        if store_dir:
+            os.makedirs(store_dir, exist_ok=True)
+
+    def _path(self, result_id):
+        return os.path.join(self.store_dir, f"{result_id}.json")
+
+    def put(self, result_id, result):
+        if not self.store_dir:
+            with self._lock:
+                self._results[result_id] = result
+                while len(self._results) > self.max_results:
+                    self._results.popitem(last=False)
+            return
+        fd, tmp_path = tempfile.mkstemp(dir=self.store_dir, prefix=f"{result_id}.", suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(result, f)
+        os.replace(tmp_path, self._path(result_id))
+        self._prune()
+
+    def get(self, result_id) -> Optional[dict]:
+        if not _result_id.match(result_id):
+            return None
+        if not self.store_dir:
+            return self._results.get(result_id)
+        try:
+            with open(self._path(result_id)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _prune(self):
+        entries = []
+        for entry in os.scandir(self.store_dir):
+            if entry.name.endswith(".json"):
+                try:
+                    entries.append((entry.stat().st_mtime, entry.path))
+                except FileNotFoundError:
+                    pass  # pruned by another worker meanwhile
+        entries.sort()
+        for _, path in entries[:max(0, len(entries) - self.max_results)]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+voice_results = VoiceResults()